@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+def loop_joint_topic_assignment_counts(topic_assignments_1, topic_assignments_2):
+    # Per-token loop that compute_joint_topic_assignment_counts used to run
+    import numpy as np
+    num_topics_1 = int(topic_assignments_1.max() + 1)
+    num_topics_2 = int(topic_assignments_2.max() + 1)
+    counts = np.zeros((num_topics_1, num_topics_2))
+    for i in range(topic_assignments_1.shape[0]):
+        counts[topic_assignments_1[i], topic_assignments_2[i]] += 1
+    return counts
+
+
+def main():
+    from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+    from timeit import default_timer
+
+    import numpy as np
+
+    from follow_up.evaluation import compute_joint_topic_assignment_counts
+
+    parser = ArgumentParser(
+        description='Benchmark joint topic assignment counts on synthetic assignments',
+        formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--num-tokens', type=int, default=50000000)
+    parser.add_argument('--num-topics', type=int, default=100)
+    parser.add_argument('--num-loop-tokens', type=int, default=1000000,
+                        help='number of tokens to time the per-token loop on')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    topic_assignments_1 = rng.integers(args.num_topics, size=args.num_tokens, dtype=np.uint8)
+    topic_assignments_2 = rng.integers(args.num_topics, size=args.num_tokens, dtype=np.uint8)
+
+    start = default_timer()
+    counts = compute_joint_topic_assignment_counts(topic_assignments_1, topic_assignments_2)
+    vectorized_time = default_timer() - start
+    vectorized_rate = args.num_tokens / vectorized_time
+    print(f'vectorized: {args.num_tokens} tokens in {vectorized_time:.2f} s '
+          f'({vectorized_rate:.3g} tokens/s)')
+
+    num_loop_tokens = min(args.num_loop_tokens, args.num_tokens)
+    start = default_timer()
+    loop_counts = loop_joint_topic_assignment_counts(
+        topic_assignments_1[:num_loop_tokens], topic_assignments_2[:num_loop_tokens])
+    loop_time = default_timer() - start
+    loop_rate = num_loop_tokens / loop_time
+    print(f'loop:       {num_loop_tokens} tokens in {loop_time:.2f} s '
+          f'({loop_rate:.3g} tokens/s)')
+
+    if not np.array_equal(
+            loop_counts,
+            compute_joint_topic_assignment_counts(
+                topic_assignments_1[:num_loop_tokens], topic_assignments_2[:num_loop_tokens])):
+        raise Exception('Vectorized and loop counts differ')
+    print(f'speedup:    {vectorized_rate / loop_rate:.1f}x '
+          f'(total count {counts.sum()})')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+def conllu_parse_tokens(f, split_lemmas=False):
+    # conllu.parse_incr path that parse_udpipe used to run
+    import conllu
+
+    from follow_up.lemmatization import LemmaData
+
+    for sentence in conllu.parse_incr(f):
+        yield [
+            LemmaData(
+                form=token['form'],
+                lemma=(
+                    token['lemma'].strip('+').split('+')[0]
+                    if split_lemmas and token['xpos'] is not None and '+' in token['xpos']
+                    else token['lemma']
+                ) if token['lemma'] != '_' else None,
+                pos=token['upos'])
+            for token in sentence
+        ]
+
+
+def write_sample(path, num_sentences, sentence_len, vocab_size, seed):
+    # Synthetic UDPipe (--tag --input=horizontal) output
+    from random import Random
+
+    rng = Random(seed)
+    with open(path, encoding='utf-8', mode='w') as f:
+        f.write('# newdoc\n# newpar\n')
+        for sent_num in range(num_sentences):
+            f.write(f'# sent_id = {sent_num + 1}\n')
+            words = [f'w{rng.randrange(vocab_size)}' for _ in range(sentence_len)]
+            f.write(f'# text = {" ".join(words)}\n')
+            for (i, word) in enumerate(words):
+                lemma = '_' if i % 7 == 0 else word.upper()
+                f.write(f'{i + 1}\t{word}\t{lemma}\tNOUN\tncn+jca\t_\t_\t_\t_\tSpaceAfter=No\n')
+            f.write('\n')
+
+
+def main():
+    from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+    from itertools import zip_longest
+    from tempfile import TemporaryDirectory
+    from timeit import default_timer
+    from pathlib import Path
+
+    from follow_up.lemmatization import parse_conllu_to_tokens
+
+    parser = ArgumentParser(
+        description='Benchmark reading lemmas from CoNLL-U with conllu and with the '
+                    'lightweight reader',
+        formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--input-path',
+                        help='CoNLL-U file to read (if not given, a synthetic one is written)')
+    parser.add_argument('--num-sentences', type=int, default=200000)
+    parser.add_argument('--sentence-len', type=int, default=20)
+    parser.add_argument('--vocab-size', type=int, default=10000)
+    parser.add_argument('--split-lemmas', action='store_true',
+                        help='split lemmas on + as for Korean')
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as temp_dir:
+        if args.input_path is None:
+            input_path = Path(temp_dir) / 'sample.conllu'
+            write_sample(input_path, args.num_sentences, args.sentence_len, args.vocab_size, 0)
+        else:
+            input_path = Path(args.input_path)
+
+        rates = []
+        for (name, parse) in [('conllu', conllu_parse_tokens), ('fast', parse_conllu_to_tokens)]:
+            with open(input_path, encoding='utf-8') as f:
+                start = default_timer()
+                num_tokens = sum(
+                    len(sentence) for sentence in parse(f, split_lemmas=args.split_lemmas))
+                elapsed = default_timer() - start
+            rate = num_tokens / elapsed
+            print(f'{name + ":":8}{num_tokens} tokens in {elapsed:.2f} s ({rate:.3g} tokens/s)')
+            rates.append(rate)
+
+        with open(input_path, encoding='utf-8') as conllu_f, \
+                open(input_path, encoding='utf-8') as fast_f:
+            conllu_sentences = (
+                sentence
+                for sentence in conllu_parse_tokens(conllu_f, split_lemmas=args.split_lemmas)
+                if sentence
+            )
+            fast_sentences = parse_conllu_to_tokens(fast_f, split_lemmas=args.split_lemmas)
+            missing = object()
+            for (conllu_sentence, fast_sentence) in zip_longest(
+                    conllu_sentences, fast_sentences, fillvalue=missing):
+                if conllu_sentence != fast_sentence:
+                    raise Exception('conllu and fast reader tokens differ')
+
+    (conllu_rate, fast_rate) = rates
+    print(f'speedup: {fast_rate / conllu_rate:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
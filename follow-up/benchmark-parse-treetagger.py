@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+def regex_parse_treetagger(lang, f):
+    # Regex and per-token LemmaData path that parse_treetagger used to run
+    import logging
+    import re
+
+    from follow_up.lemmatization import LemmaData, parse_polyglot_lemmas
+
+    sgml_tag_re = re.compile(r'<.*>')
+    unknown_lemma_re = re.compile(r'<unknown>')
+    sent_start_re = re.compile(r'<s>')
+    sent_end_re = re.compile(r'</s>')
+
+    def parse_treetagger_to_tokens(f):
+        sentence = []
+        for line in f:
+            line = line.strip()
+            if line:
+                if sent_start_re.fullmatch(line):
+                    pass
+
+                elif sent_end_re.fullmatch(line):
+                    if sentence:
+                        yield sentence
+                        sentence = []
+
+                else:
+                    line_tokens = line.split('\t')
+                    if len(line_tokens) == 3:
+                        (form, pos, lemma) = line_tokens
+                        if unknown_lemma_re.fullmatch(lemma):
+                            sentence.append(LemmaData(form=form, pos=pos))
+                        else:
+                            sentence.append(LemmaData(form=form, pos=pos, lemma=lemma))
+                    elif sgml_tag_re.fullmatch(line) is not None:
+                        sentence.append(LemmaData(form=line))
+                    else:
+                        logging.warning(f'Unexpected number of tokens in line: {line_tokens}')
+
+        if sentence:
+            yield sentence
+
+    if lang == 'ko':
+        return parse_polyglot_lemmas(
+            [
+                LemmaData(
+                    form=token.form,
+                    lemma=(
+                        token.lemma.split('_')[0]
+                        if token.lemma is not None and token.pos is not None and '_' in token.pos
+                        else token.lemma
+                    ),
+                    pos=token.pos
+                )
+                for token in section
+            ]
+            for section in parse_treetagger_to_tokens(f)
+        )
+    else:
+        return parse_polyglot_lemmas(parse_treetagger_to_tokens(f))
+
+
+def write_sample(path, num_docs, num_sentences_per_doc, sentence_len, vocab_size, seed):
+    # Synthetic output of a tree-tagger-* wrapper script on a polyglot corpus
+    from random import Random
+
+    rng = Random(seed)
+    with open(path, encoding='utf-8', mode='w') as f:
+        for doc_num in range(num_docs):
+            f.write(f'<s>\n[[{doc_num}]]\tSYM\t[[{doc_num}]]\n</s>\n')
+            for _ in range(num_sentences_per_doc):
+                f.write('<s>\n')
+                for _ in range(sentence_len):
+                    word = f'w{rng.randrange(vocab_size)}'
+                    if rng.random() < 0.1:
+                        f.write(f'{word}\tNN\t<unknown>\n')
+                    else:
+                        f.write(f'{word}\tNN_JKB\t{word}_x\n')
+                f.write('</s>\n')
+
+
+def main():
+    from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+    from itertools import zip_longest
+    from pathlib import Path
+    from tempfile import TemporaryDirectory
+    from timeit import default_timer
+
+    from follow_up.lemmatization import _parse_treetagger
+
+    parser = ArgumentParser(
+        description='Benchmark reading lemmas from TreeTagger output with the old regex '
+                    'parser and the single-pass parser',
+        formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--input-path',
+                        help='TreeTagger output to read (if not given, a synthetic one is '
+                             'written)')
+    parser.add_argument('--lang', default='ko',
+                        help='language (lemmas are only split for ko)')
+    parser.add_argument('--num-docs', type=int, default=20000)
+    parser.add_argument('--num-sentences-per-doc', type=int, default=10)
+    parser.add_argument('--sentence-len', type=int, default=15)
+    parser.add_argument('--vocab-size', type=int, default=10000)
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as temp_dir:
+        if args.input_path is None:
+            input_path = Path(temp_dir) / 'sample.lem-treetagger.txt'
+            write_sample(input_path, args.num_docs, args.num_sentences_per_doc,
+                         args.sentence_len, args.vocab_size, 0)
+        else:
+            input_path = Path(args.input_path)
+
+        rates = []
+        for (name, parse) in [('regex', regex_parse_treetagger), ('fast', _parse_treetagger)]:
+            with open(input_path, encoding='utf-8') as f:
+                start = default_timer()
+                num_tokens = sum(doc.num_tokens for doc in parse(args.lang, f))
+                elapsed = default_timer() - start
+            rate = num_tokens / elapsed
+            print(f'{name + ":":7}{num_tokens} tokens in {elapsed:.2f} s ({rate:.3g} tokens/s)')
+            rates.append(rate)
+
+        with open(input_path, encoding='utf-8') as regex_f, \
+                open(input_path, encoding='utf-8') as fast_f:
+            missing = object()
+            for (regex_doc, fast_doc) in zip_longest(
+                    regex_parse_treetagger(args.lang, regex_f),
+                    _parse_treetagger(args.lang, fast_f),
+                    fillvalue=missing):
+                if regex_doc != fast_doc:
+                    raise Exception('Regex and fast parser docs differ')
+
+    (regex_rate, fast_rate) = rates
+    print(f'speedup: {fast_rate / regex_rate:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
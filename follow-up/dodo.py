@@ -1,21 +1,22 @@
+import os
 import platform
-from itertools import product
-from os import PathLike
 from pathlib import Path
-from typing import Optional
+from typing import Dict
 
 import pycountry  # type: ignore
+from doit.tools import create_folder
 
 from follow_up.util import (
-    subsample, convert_polyglot_to_mallet, lowercase_polyglot, compute_common_words,
-    summarize_corpus, extract_corpus_stats, collect_corpus_stats,
+    subsample, preprocess_polyglot, get_corpus_fingerprint_path, compute_common_words,
+    extract_corpus_stats, collect_corpus_stats, CORPUS_SUMMARY_META_FILENAME,
 )
 from follow_up.evaluation import (
     check_corpus_alignment, check_token_assignment_alignment,
-    compute_coherence_treated, compute_topic_assignment_voi, collect_subtask_scores,
-    compute_coherence, compute_topic_assignments, collect_keys, filter_keys
+    compute_coherence_treated_batch, collect_topic_assignment_voi, collect_subtask_scores,
+    compute_coherence, compute_topic_assignments, collect_keys, filter_keys,
+    convert_topic_state, get_topic_state_arrays_path, get_topic_assignments_doc_offsets_path,
 )
-from follow_up.lemmatization import parse_treetagger, parse_udpipe
+from follow_up.lemmatization import lemmatize_parse_treetagger, lemmatize_parse_udpipe
 from follow_up.translation import translate_words, translate_keys
 
 DATA_ROOT = Path('polyglot')
@@ -41,6 +42,9 @@ MALLET_ROOT = Path('mallet')
 MALLET_PROGRAM = MALLET_ROOT / 'bin' / 'mallet'
 
 MAX_NUM_DOCS = 200000
+SUBSAMPLE_SEED = 0
+
+NUM_PROCESSES = os.cpu_count() or 1
 
 CASED_DATA_SET_FILENAMES = (
     'sub.txt',
@@ -69,141 +73,92 @@ LANGUAGE_NAMES = dict(
 )
 
 
-def task_untar():
-    for lang in LANGUAGES:
-        input_path = DATA_ROOT / f'{lang}_wiki_text.tar.lzma'
-        output_path = DATA_ROOT / lang / 'full.txt'
-        yield {
-            'name': lang,
-            'file_dep': [input_path],
-            'actions': [['tar', '-C', f'{DATA_ROOT}', '-xvJf', f'{input_path}']],
-            'targets': [output_path],
-        }
-
-
 def task_subsample():
     for lang in LANGUAGES:
-        input_path = DATA_ROOT / lang / 'full.txt'
+        input_path = DATA_ROOT / f'{lang}_wiki_text.tar.lzma'
         output_path = DATA_ROOT / lang / 'sub.txt'
         yield {
             'name': lang,
             'file_dep': [input_path],
-            'actions': [(subsample, (), dict(
+            'actions': [(create_folder, [output_path.parent]), (subsample, (), dict(
                 input_path=input_path,
                 output_path=output_path,
                 max_num_docs=MAX_NUM_DOCS,
+                seed=SUBSAMPLE_SEED,
             ))],
             'targets': [output_path],
         }
 
 
-def task_lemmatize_treetagger():
+def task_lemmatize_parse_treetagger():
     for lang in LANGUAGES:
         lang_name = LANGUAGE_NAMES[lang]
         input_path = DATA_ROOT / lang / 'sub.txt'
-        output_path = input_path.with_suffix('.lem-treetagger.txt')
+        output_path = input_path.with_suffix('.lem-treetagger.parsed.txt')
         program_path = f'./tree-tagger-{lang_name}'
         yield {
             'name': lang,
             'file_dep': [input_path],
-            'actions': [
-                f'{program_path} < {input_path} > {output_path}'
-            ],
-            'targets': [output_path],
-        }
-
-
-def task_parse_treetagger():
-    for lang in LANGUAGES:
-        input_path = DATA_ROOT / lang / 'sub.lem-treetagger.txt'
-        output_path = input_path.with_suffix('.parsed.txt')
-        yield {
-            'name': lang,
-            'file_dep': [input_path],
-            'actions': [(parse_treetagger, (), dict(
+            'actions': [(lemmatize_parse_treetagger, (), dict(
                 lang=lang,
+                program_path=program_path,
                 input_path=input_path,
-                output_path=output_path
+                output_path=output_path,
+                num_processes=NUM_PROCESSES,
             ))],
             'targets': [output_path],
         }
 
 
-def task_lemmatize_udpipe():
+def task_lemmatize_parse_udpipe():
     for lang in LANGUAGES:
         input_path = DATA_ROOT / lang / 'sub.txt'
-        output_path = input_path.with_suffix('.lem-udpipe.txt')
+        output_path = input_path.with_suffix('.lem-udpipe.parsed.txt')
         program_path = UDPIPE_BIN / 'udpipe'
         model_path = UDPIPE_MODELS[lang]
         yield {
             'name': lang,
             'file_dep': [input_path, model_path],
-            'actions': [[
-                f'{program_path}',
-                '--tag',
-                '--immediate',
-                '--input=horizontal',
-                f'--outfile={output_path}',
-                f'{model_path}',
-                f'{input_path}',
-            ]],
-            'targets': [output_path],
-        }
-
-
-def task_parse_udpipe():
-    for lang in LANGUAGES:
-        input_path = DATA_ROOT / lang / 'sub.lem-udpipe.txt'
-        output_path = input_path.with_suffix('.parsed.txt')
-        yield {
-            'name': lang,
-            'file_dep': [input_path],
-            'actions': [(parse_udpipe, (), dict(
+            'actions': [(lemmatize_parse_udpipe, (), dict(
                 lang=lang,
+                program_path=str(program_path),
+                model_path=model_path,
                 input_path=input_path,
-                output_path=output_path
+                output_path=output_path,
+                num_processes=NUM_PROCESSES,
             ))],
             'targets': [output_path],
         }
 
 
-def task_lowercase():
+def task_preprocess():
     for lang in LANGUAGES:
         input_paths = [
             DATA_ROOT / lang / filename
             for filename in CASED_DATA_SET_FILENAMES
         ]
         for input_path in input_paths:
-            output_path = input_path.with_suffix('.lower.txt')
-            name = f'{lang}.{input_path.stem}'
-            yield {
-                'name': name,
-                'file_dep': [input_path],
-                'actions': [(lowercase_polyglot, (), dict(
-                    input_path=input_path,
-                    output_path=output_path
-                ))],
-                'targets': [output_path],
-            }
-
-
-def task_summarize_corpus():
-    for lang in LANGUAGES:
-        input_paths = [
-            DATA_ROOT / lang / filename
-            for filename in DATA_SET_FILENAMES
-        ]
-        for input_path in input_paths:
-            output_path = input_path.with_suffix('.summary.npz')
+            lowercase_path = input_path.with_suffix('.lower.txt')
+            mallet_path = lowercase_path.with_suffix('.mallet.txt')
+            summary_path = lowercase_path.with_suffix('.summary')
             name = f'{lang}.{input_path.stem}'
             yield {
                 'name': name,
                 'file_dep': [input_path],
-                'actions': [(summarize_corpus, (), dict(
+                'actions': [(preprocess_polyglot, (), dict(
+                    lang=lang,
                     input_path=input_path,
-                    output_path=output_path,
+                    lowercase_path=lowercase_path,
+                    mallet_path=mallet_path,
+                    summary_path=summary_path,
+                    num_processes=NUM_PROCESSES,
                 ))],
-                'targets': [output_path],
+                'targets': [
+                    lowercase_path,
+                    mallet_path,
+                    summary_path / CORPUS_SUMMARY_META_FILENAME,
+                    get_corpus_fingerprint_path(lowercase_path),
+                ],
             }
 
 
@@ -214,12 +169,12 @@ def task_compute_common_words():
             for filename in DATA_SET_FILENAMES
         ]
         for corpus_path in corpus_paths:
-            input_path = corpus_path.with_suffix('.summary.npz')
+            input_path = corpus_path.with_suffix('.summary')
             output_path = corpus_path.with_suffix('.common-words.txt')
             name = f'{lang}.{corpus_path.stem}'
             yield {
                 'name': name,
-                'file_dep': [input_path],
+                'file_dep': [input_path / CORPUS_SUMMARY_META_FILENAME],
                 'actions': [(compute_common_words, (), dict(
                     input_path=input_path,
                     output_path=output_path,
@@ -241,7 +196,10 @@ def task_check_corpus_alignment():
             is_non_trivial = (input_path != orig_input_path)
             yield {
                 'name': f'{lang}.{input_path.stem}',
-                'file_dep': [orig_input_path, input_path] if is_non_trivial else [input_path],
+                'file_dep': [
+                    orig_input_path, get_corpus_fingerprint_path(orig_input_path),
+                    input_path, get_corpus_fingerprint_path(input_path),
+                ] if is_non_trivial else [input_path],
                 'actions': [(check_corpus_alignment, (), dict(
                     corpus1_path=orig_input_path,
                     corpus2_path=input_path,
@@ -250,28 +208,6 @@ def task_check_corpus_alignment():
             }
 
 
-def task_to_mallet():
-    for lang in LANGUAGES:
-        input_paths = [
-            DATA_ROOT / lang / filename
-            for filename in DATA_SET_FILENAMES
-        ]
-        for input_path in input_paths:
-            output_path = input_path.with_suffix('.mallet.txt')
-            name = f'{lang}.{input_path.stem}'
-            yield {
-                'name': name,
-                'file_dep': [input_path],
-                'task_dep': [f'check_corpus_alignment:{name}'],
-                'actions': [(convert_polyglot_to_mallet, (), dict(
-                    lang=lang,
-                    input_path=input_path,
-                    output_path=output_path
-                ))],
-                'targets': [output_path],
-            }
-
-
 def task_mallet_import():
     for lang in LANGUAGES:
         corpus_paths = [
@@ -285,6 +221,7 @@ def task_mallet_import():
             yield {
                 'name': name,
                 'file_dep': [input_path],
+                'task_dep': [f'check_corpus_alignment:{name}'],
                 'actions': [[
                     f'{MALLET_PROGRAM}',
                     'import-file',
@@ -330,6 +267,29 @@ def task_mallet_train():
                 }
 
 
+def task_convert_topic_state():
+    for lang in LANGUAGES:
+        corpus_paths = [
+            DATA_ROOT / lang / filename
+            for filename in DATA_SET_FILENAMES
+        ]
+        for corpus_path in corpus_paths:
+            for trial in range(NUM_TRIALS):
+                topic_model_name = f'topic-model-{NUM_TOPICS}-{trial}'
+                name = f'{lang}.{corpus_path.stem}.{topic_model_name}'
+                state_path = corpus_path.with_suffix(f'.mallet.{topic_model_name}.state.txt.gz')
+                arrays_path = get_topic_state_arrays_path(state_path)
+                yield {
+                    'name': name,
+                    'file_dep': [state_path],
+                    'actions': [(convert_topic_state, (), dict(
+                        topic_state_path=state_path,
+                        topic_state_arrays_path=arrays_path,
+                    ))],
+                    'targets': [arrays_path],
+                }
+
+
 def task_check_token_assignment_alignment():
     for lang in LANGUAGES:
         corpus_paths = [
@@ -343,7 +303,12 @@ def task_check_token_assignment_alignment():
                 state_path = corpus_path.with_suffix(f'.mallet.{topic_model_name}.state.txt.gz')
                 yield {
                     'name': name,
-                    'file_dep': [corpus_path, state_path],
+                    'file_dep': [
+                        corpus_path,
+                        get_corpus_fingerprint_path(corpus_path),
+                        state_path,
+                        get_topic_state_arrays_path(state_path),
+                    ],
                     'actions': [(check_token_assignment_alignment, (), dict(
                         corpus_path=corpus_path,
                         topic_state_path=state_path,
@@ -359,39 +324,46 @@ def task_compute_coherence():
             for filename in DATA_SET_FILENAMES
         ]
         # First entry in DATA_SET_FILENAMES is unlemmatized corpus
-        untreated_state_path: Optional[PathLike] = None
-        untreated_corpus_summary_path: Optional[PathLike] = None
-        untreated_stop_list_path: Optional[PathLike] = None
+        untreated_corpus_path = corpus_paths[0]
+        untreated_state_path = untreated_corpus_path.with_suffix(
+            f'.mallet.topic-model-{NUM_TOPICS}-0.state.txt.gz')
+        untreated_corpus_summary_path = untreated_corpus_path.with_suffix('.summary')
+        untreated_stop_list_path = untreated_corpus_path.with_suffix('.common-words.txt')
+        state_paths: Dict[str, Path] = {}
+        dep_names = []
         for trial in range(NUM_TRIALS):
             for corpus_path in corpus_paths:
                 topic_model_name = f'topic-model-{NUM_TOPICS}-{trial}'
                 dep_name = f'{lang}.{corpus_path.stem}.{topic_model_name}'
-                name = f'{dep_name}.stop-top-200'
-                state_path = corpus_path.with_suffix(f'.mallet.{topic_model_name}.state.txt.gz')
-                if untreated_state_path is None:
-                    untreated_state_path = state_path
-                if untreated_corpus_summary_path is None:
-                    untreated_corpus_summary_path = corpus_path.with_suffix('.summary.npz')
-                if untreated_stop_list_path is None:
-                    untreated_stop_list_path = corpus_path.with_suffix('.common-words.txt')
-                yield {
-                    'name': name,
-                    'file_dep': [
-                        untreated_corpus_summary_path,
-                        untreated_state_path,
-                        untreated_stop_list_path,
-                        state_path,
-                    ],
-                    'task_dep': [f'check_token_assignment_alignment:{dep_name}'],
-                    'actions': [(
-                        compute_coherence_treated, (), dict(
-                            untreated_corpus_summary_path=untreated_corpus_summary_path,
-                            untreated_topic_state_path=untreated_state_path,
-                            topic_state_path=state_path,
-                            untreated_stop_list_path=untreated_stop_list_path,
-                        ),
-                    )],
-                }
+                state_paths[f'{dep_name}.stop-top-200'] = corpus_path.with_suffix(
+                    f'.mallet.{topic_model_name}.state.txt.gz')
+                dep_names.append(dep_name)
+        yield {
+            'name': lang,
+            'file_dep': [
+                untreated_corpus_summary_path / CORPUS_SUMMARY_META_FILENAME,
+                untreated_state_path,
+                get_topic_state_arrays_path(untreated_state_path),
+                untreated_stop_list_path,
+            ] + [
+                path
+                for state_path in state_paths.values()
+                for path in (state_path, get_topic_state_arrays_path(state_path))
+            ],
+            'task_dep': [
+                f'check_token_assignment_alignment:{dep_name}'
+                for dep_name in dep_names
+            ],
+            'actions': [(
+                compute_coherence_treated_batch, (), dict(
+                    untreated_corpus_summary_path=untreated_corpus_summary_path,
+                    untreated_topic_state_path=untreated_state_path,
+                    topic_state_paths=state_paths,
+                    untreated_stop_list_path=untreated_stop_list_path,
+                    num_processes=NUM_PROCESSES,
+                ),
+            )],
+        }
 
 
 def task_compute_topic_assignments():
@@ -406,42 +378,19 @@ def task_compute_topic_assignments():
                 name = f'{lang}.{corpus_path.stem}.{tm_name}'
                 state_path = corpus_path.with_suffix(f'.mallet.{tm_name}.state.txt.gz')
                 assignments_path = corpus_path.with_suffix(f'.mallet.{tm_name}.assignments.npy')
+                doc_offsets_path = get_topic_assignments_doc_offsets_path(assignments_path)
                 yield {
                     'name': name,
-                    'file_dep': [state_path],
+                    'file_dep': [state_path, get_topic_state_arrays_path(state_path)],
                     'task_dep': [f'check_token_assignment_alignment:{name}'],
                     'actions': [(
                         compute_topic_assignments, (), dict(
                             topic_state_path=state_path,
                             topic_assignments_path=assignments_path,
+                            doc_offsets_path=doc_offsets_path,
                         ),
                     )],
-                    'targets': [assignments_path],
-                }
-
-
-def task_compute_voi():
-    for lang in LANGUAGES:
-        corpus_paths = [
-            DATA_ROOT / lang / filename
-            for filename in DATA_SET_FILENAMES
-        ]
-        for (corpus_1_path, corpus_2_path) in product(corpus_paths, repeat=2):
-            for (trial1, trial2) in product(range(NUM_TRIALS), repeat=2):
-                tm_1_name = f'topic-model-{NUM_TOPICS}-{trial1}'
-                tm_2_name = f'topic-model-{NUM_TOPICS}-{trial2}'
-                name = f'{lang}.{corpus_1_path.stem}.{tm_1_name}.{corpus_2_path.stem}.{tm_2_name}'
-                ta_1_path = corpus_1_path.with_suffix(f'.mallet.{tm_1_name}.assignments.npy')
-                ta_2_path = corpus_2_path.with_suffix(f'.mallet.{tm_2_name}.assignments.npy')
-                yield {
-                    'name': name,
-                    'file_dep': [ta_1_path, ta_2_path],
-                    'actions': [(
-                        compute_topic_assignment_voi, (), dict(
-                            topic_assignments_1_path=ta_1_path,
-                            topic_assignments_2_path=ta_2_path,
-                        ),
-                    )],
+                    'targets': [assignments_path, doc_offsets_path],
                 }
 
 
@@ -456,9 +405,29 @@ def task_collect_coherence():
 
 def task_collect_voi():
     output_path = DATA_ROOT / 'voi.tsv'
+    topic_assignments_paths: Dict[str, Dict[str, Path]] = {}
+    for lang in LANGUAGES:
+        topic_assignments_paths[lang] = {}
+        corpus_paths = [
+            DATA_ROOT / lang / filename
+            for filename in DATA_SET_FILENAMES
+        ]
+        for corpus_path in corpus_paths:
+            for trial in range(NUM_TRIALS):
+                tm_name = f'topic-model-{NUM_TOPICS}-{trial}'
+                topic_assignments_paths[lang][f'{corpus_path.stem}.{tm_name}'] = (
+                    corpus_path.with_suffix(f'.mallet.{tm_name}.assignments.npy'))
     return {
-        'getargs': {'scores': ('compute_voi', 'voi')},
-        'actions': [(collect_subtask_scores, (), dict(output_path=output_path))],
+        'file_dep': [
+            path
+            for lang_paths in topic_assignments_paths.values()
+            for path in lang_paths.values()
+        ],
+        'actions': [(collect_topic_assignment_voi, (), dict(
+            topic_assignments_paths=topic_assignments_paths,
+            output_path=output_path,
+            num_processes=NUM_PROCESSES,
+        ))],
         'targets': [output_path],
     }
 
@@ -476,14 +445,15 @@ def task_compute_coherence_sanity():
                 name = f'{dep_name}.stop-top-200'
                 topic_keys_path = corpus_path.with_suffix(f'.mallet.{topic_model_name}.keys.txt')
                 state_path = corpus_path.with_suffix(f'.mallet.{topic_model_name}.state.txt.gz')
-                corpus_summary_path = corpus_path.with_suffix('.summary.npz')
+                corpus_summary_path = corpus_path.with_suffix('.summary')
                 stop_list_path = corpus_path.with_suffix('.common-words.txt')
                 yield {
                     'name': name,
                     'file_dep': [
-                        corpus_summary_path,
+                        corpus_summary_path / CORPUS_SUMMARY_META_FILENAME,
                         topic_keys_path,
                         state_path,
+                        get_topic_state_arrays_path(state_path),
                         stop_list_path,
                     ],
                     'task_dep': [f'check_token_assignment_alignment:{dep_name}'],
@@ -659,11 +629,11 @@ def task_extract_corpus_stats():
             for filename in DATA_SET_FILENAMES
         ]
         for corpus_path in corpus_paths:
-            input_path = corpus_path.with_suffix('.summary.npz')
+            input_path = corpus_path.with_suffix('.summary')
             name = f'{lang}.{corpus_path.stem}'
             yield {
                 'name': name,
-                'file_dep': [input_path],
+                'file_dep': [input_path / CORPUS_SUMMARY_META_FILENAME],
                 'actions': [(extract_corpus_stats, (), dict(corpus_summary_path=input_path))],
             }
 
@@ -1,19 +1,39 @@
 import gzip
 import logging
-import collections
+import os
+from array import array
+from dataclasses import dataclass
 from difflib import unified_diff
-from math import log
+from functools import cached_property, lru_cache
+from itertools import product, zip_longest
+from multiprocessing.pool import Pool
 from os import PathLike
-from pathlib import PurePath
+from pathlib import Path, PurePath
 from string import ascii_letters
-from typing import Counter, Dict, Iterable, Iterator, List, Optional, NamedTuple, Set, TypeVar
+from typing import (
+    Dict, Iterable, Iterator, List, Literal, Mapping, Optional, NamedTuple, Set, Tuple, TypeVar,
+    Union,
+)
 
 import numpy as np
 
-from .util import Corpus, CorpusSummary, Doc, PolyglotCorpus, load_corpus_summary, load_word_list
+from .util import (
+    Corpus, CorpusFingerprint, CorpusSummary, PolyglotCorpus, Vocabulary,
+    compute_num_tokens_digest, decode_word_list, encode_word_list, get_corpus_fingerprint_path,
+    load_corpus_fingerprint_if_current, load_corpus_summary_cached, load_word_list,
+)
 
 DEFAULT_NUM_KEYS = 5
 
+JOINT_COUNT_CHUNK_SIZE = 2 ** 22
+
+# Number of topic state sidecars kept in memory, so that the untreated topic state shared by
+# the coherence tasks of a language is only loaded once
+TOPIC_STATE_ARRAYS_CACHE_SIZE = 4
+
+ALPHA_PREFIX = '#alpha : '
+BETA_PREFIX = '#beta : '
+
 T = TypeVar('T')
 X = TypeVar('X')
 Y = TypeVar('Y')
@@ -24,7 +44,200 @@ class TokenAssignment(NamedTuple):
     topic: int
 
 
-class TopicState(Corpus[TokenAssignment], Iterable[Doc[TokenAssignment]]):
+class TopicAssignmentDoc:
+    # Single-section doc of token topic assignments, stored as parallel arrays of word ids
+    # (into vocab, which is shared between docs) and topics rather than one object per token.
+    # Read-only: it provides what corpora read of a doc (see ReadOnlyDoc) but not, unlike Doc,
+    # add_section.
+    __slots__ = ('doc_id', 'vocab', 'word_ids', 'topics', '_tokens')
+    doc_id: str
+    vocab: List[str]
+    word_ids: Union[np.ndarray, 'array[int]']
+    topics: Union[np.ndarray, 'array[int]']
+    _tokens: Optional[List[TokenAssignment]]
+
+    def __init__(
+            self,
+            doc_id: str,
+            vocab: List[str],
+            word_ids: Union[np.ndarray, 'array[int]'],
+            topics: Union[np.ndarray, 'array[int]']):
+        self.doc_id = doc_id
+        self.vocab = vocab
+        self.word_ids = word_ids
+        self.topics = topics
+        self._tokens = None
+
+    @property
+    def words(self) -> List[str]:
+        vocab = self.vocab
+        return [vocab[word_id] for word_id in self.word_ids.tolist()]
+
+    @property
+    def tokens(self) -> List[TokenAssignment]:
+        # Built on first use, as most readers only need the arrays
+        if self._tokens is None:
+            self._tokens = [
+                TokenAssignment(word=word, topic=topic)
+                for (word, topic) in zip(self.words, self.topics.tolist())
+            ]
+        return self._tokens
+
+    @property
+    def section_offsets(self) -> List[int]:
+        return [0, self.num_tokens]
+
+    @property
+    def num_tokens(self) -> int:
+        return len(self.topics)
+
+    @property
+    def sections(self) -> List[List[TokenAssignment]]:
+        return [self.tokens]
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, TopicAssignmentDoc):
+            return NotImplemented
+        return (self.doc_id == other.doc_id and self.words == other.words and
+                self.topics.tolist() == other.topics.tolist())
+
+    __hash__ = None  # type: ignore
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}({self.doc_id!r}, {self.sections!r})'
+
+
+@dataclass(frozen=True)
+class TopicStateArrays:
+    alpha: np.ndarray
+    beta: float
+    vocab: List[str]
+    # Tokens of doc i are at positions doc_offsets[i]:doc_offsets[i + 1] of word_ids and topics
+    doc_offsets: np.ndarray
+    word_ids: np.ndarray
+    topics: np.ndarray
+    # Size of the topic state file the arrays were parsed from (None if saved before it was
+    # recorded)
+    topic_state_size: Optional[int] = None
+
+    @property
+    def num_docs(self) -> int:
+        return len(self.doc_offsets) - 1
+
+    @cached_property
+    def vocabulary(self) -> Vocabulary[str]:
+        return Vocabulary(self.vocab)
+
+    def iter_docs(self) -> Iterator[TopicAssignmentDoc]:
+        doc_offsets = self.doc_offsets.tolist()
+        for doc_num in range(self.num_docs):
+            start = doc_offsets[doc_num]
+            end = doc_offsets[doc_num + 1]
+            yield TopicAssignmentDoc(
+                str(doc_num), self.vocab, self.word_ids[start:end], self.topics[start:end])
+
+    def save(self, path: PathLike):
+        np.savez(
+            path,
+            alpha=self.alpha,
+            beta=self.beta,
+            vocab=encode_word_list(self.vocab),
+            doc_offsets=self.doc_offsets,
+            word_ids=self.word_ids,
+            topics=self.topics,
+            topic_state_size=np.int64(
+                -1 if self.topic_state_size is None else self.topic_state_size),
+        )
+
+
+def load_topic_state_arrays(path: PathLike) -> TopicStateArrays:
+    with np.load(path) as archive:
+        return TopicStateArrays(
+            alpha=archive['alpha'],
+            beta=archive['beta'].item(),
+            vocab=decode_word_list(archive['vocab']),
+            doc_offsets=archive['doc_offsets'],
+            word_ids=archive['word_ids'],
+            topics=archive['topics'],
+            topic_state_size=(
+                int(archive['topic_state_size'])
+                if 'topic_state_size' in archive.files and int(archive['topic_state_size']) >= 0
+                else None
+            ),
+        )
+
+
+@lru_cache(maxsize=TOPIC_STATE_ARRAYS_CACHE_SIZE)
+def _load_topic_state_arrays_cached(path: str, mtime_ns: int) -> TopicStateArrays:
+    return load_topic_state_arrays(Path(path))
+
+
+def load_topic_state_arrays_cached(path: PathLike) -> TopicStateArrays:
+    # Keyed by modification time so that a rewritten sidecar is reloaded
+    return _load_topic_state_arrays_cached(os.path.abspath(path), os.stat(path).st_mtime_ns)
+
+
+def parse_topic_state_arrays(topic_state_path: PathLike) -> TopicStateArrays:
+    alpha: Optional[List[float]] = None
+    beta: Optional[float] = None
+    vocabulary: Vocabulary[str] = Vocabulary()
+    doc_offsets = array('q', [0])
+    word_ids = array('i')
+    topics = array('H')
+    prev_doc_num: int = -1
+    topic_state_size = os.path.getsize(topic_state_path)
+    with gzip.open(topic_state_path, mode='rt', encoding='utf-8') as f:
+        for line in f:
+            if line.startswith(ALPHA_PREFIX):
+                alpha = [float(t) for t in line[len(ALPHA_PREFIX):].strip().split()]
+            elif line.startswith(BETA_PREFIX):
+                beta = float(line[len(BETA_PREFIX):].strip())
+            elif not line.startswith('#'):
+                [doc_num_str, _1, _2, _3, word, topic_num_str] = line.strip().split()
+                doc_num = int(doc_num_str)
+                if doc_num != prev_doc_num:
+                    if doc_num != prev_doc_num + 1:
+                        raise Exception(
+                            'Expected successive document numbers, '
+                            f'but got {prev_doc_num} followed by {doc_num}')
+                    if prev_doc_num >= 0:
+                        doc_offsets.append(len(word_ids))
+                    prev_doc_num = doc_num
+                word_ids.append(vocabulary.add(word))
+                topics.append(int(topic_num_str))
+
+    if prev_doc_num >= 0:
+        doc_offsets.append(len(word_ids))
+    if alpha is None:
+        raise Exception(f'Failed to read alpha from topic state file {topic_state_path}')
+    if beta is None:
+        raise Exception(f'Failed to read beta from topic state file {topic_state_path}')
+
+    return TopicStateArrays(
+        alpha=np.array(alpha),
+        beta=beta,
+        vocab=vocabulary.words,
+        doc_offsets=np.array(doc_offsets, dtype=np.int64),
+        word_ids=np.array(word_ids, dtype=np.int32),
+        topics=np.array(topics, dtype=np.uint16),
+        topic_state_size=topic_state_size,
+    )
+
+
+def get_topic_state_arrays_path(topic_state_path: PathLike) -> Path:
+    # foo.state.txt.gz -> foo.state.npz
+    path = Path(topic_state_path)
+    if path.name.endswith('.txt.gz'):
+        return path.with_name(path.name[:-len('.txt.gz')] + '.npz')
+    else:
+        return path.with_name(path.name + '.npz')
+
+
+def convert_topic_state(topic_state_path: PathLike, topic_state_arrays_path: PathLike):
+    parse_topic_state_arrays(topic_state_path).save(topic_state_arrays_path)
+
+
+class TopicState(Corpus[TokenAssignment], Iterable[TopicAssignmentDoc]):
     topic_state_path: PathLike
     _alpha: Optional[List[float]] = None
     _beta: Optional[float] = None
@@ -33,18 +246,57 @@ class TopicState(Corpus[TokenAssignment], Iterable[Doc[TokenAssignment]]):
         self.topic_state_path = topic_state_path
         super().__init__(PurePath(topic_state_path).name, self)
 
-    def __iter__(self) -> Iterator[Doc[TokenAssignment]]:
+    @cached_property
+    def arrays(self) -> Optional[TopicStateArrays]:
+        # Read from the binary sidecar written by convert_topic_state if it is up to date: newer
+        # than the topic state and recording its size, as for the polyglot index (or, if the
+        # topic state has been removed, unconditionally)
+        arrays_path = get_topic_state_arrays_path(self.topic_state_path)
+        if not os.path.exists(arrays_path):
+            return None
+        if not os.path.exists(self.topic_state_path):
+            return load_topic_state_arrays_cached(arrays_path)
+        if os.path.getmtime(arrays_path) < os.path.getmtime(self.topic_state_path):
+            return None
+        arrays = load_topic_state_arrays_cached(arrays_path)
+        if arrays.topic_state_size != os.path.getsize(self.topic_state_path):
+            return None
+        return arrays
+
+    @cached_property
+    def _parsed_arrays(self) -> TopicStateArrays:
+        return parse_topic_state_arrays(self.topic_state_path)
+
+    def load_arrays(self) -> TopicStateArrays:
+        # The binary sidecar if it is up to date, otherwise the topic state parsed in memory
+        return self.arrays if self.arrays is not None else self._parsed_arrays
+
+    def __iter__(self) -> Iterator[TopicAssignmentDoc]:
+        if self.arrays is not None:
+            return self.arrays.iter_docs()
         return iter(load_token_assignments(self.topic_state_path))
 
+    def iter_doc_num_tokens(self) -> Iterator[Tuple[str, int]]:
+        # Read from the doc offsets of the binary sidecar if it is up to date
+        if self.arrays is None:
+            return super().iter_doc_num_tokens()
+        return (
+            (str(doc_num), num_tokens)
+            for (doc_num, num_tokens) in enumerate(np.diff(self.arrays.doc_offsets).tolist())
+        )
+
     def _load(self):
-        alpha_prefix = '#alpha : '
-        beta_prefix = '#beta : '
+        if self.arrays is not None:
+            self._alpha = self.arrays.alpha.tolist()
+            self._beta = self.arrays.beta
+            return
+
         with gzip.open(self.topic_state_path, mode='rt', encoding='utf-8') as f:
             for line in f:
-                if line.startswith(alpha_prefix):
-                    self._alpha = [float(t) for t in line[len(alpha_prefix):].strip().split()]
-                elif line.startswith(beta_prefix):
-                    self._beta = float(line[len(beta_prefix):].strip())
+                if line.startswith(ALPHA_PREFIX):
+                    self._alpha = [float(t) for t in line[len(ALPHA_PREFIX):].strip().split()]
+                elif line.startswith(BETA_PREFIX):
+                    self._beta = float(line[len(BETA_PREFIX):].strip())
                 if self._alpha is not None and self._beta is not None:
                     break
 
@@ -69,49 +321,133 @@ class TopicState(Corpus[TokenAssignment], Iterable[Doc[TokenAssignment]]):
         return len(self.alpha)
 
 
-def compute_topic_assignments(topic_state_path: PathLike, topic_assignments_path: PathLike):
-    np.save(
-        topic_assignments_path,
-        np.array([
-            ta.topic
-            for doc in TopicState(topic_state_path).docs
-            for ta in doc.tokens
-        ], dtype=np.uint))
+def get_topic_assignments_doc_offsets_path(topic_assignments_path: PathLike) -> Path:
+    # foo.assignments.npy -> foo.assignments.doc-offsets.npy
+    path = Path(topic_assignments_path)
+    return path.with_name(path.stem + '.doc-offsets.npy')
 
 
-def check_corpus_alignment(corpus1_path: PathLike, corpus2_path: PathLike):
-    return _check_corpus_alignment(PolyglotCorpus(corpus1_path), PolyglotCorpus(corpus2_path))
+def _save_array(path: PathLike, values: np.ndarray, dtype: np.dtype):
+    if values.size == 0:
+        np.save(path, values.astype(dtype))
+    else:
+        # Write through a memory map to avoid an in-memory copy in the target dtype
+        output = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=values.shape)
+        output[:] = values
+        output.flush()
+        del output
+
+
+def compute_topic_assignments(
+        topic_state_path: PathLike,
+        topic_assignments_path: PathLike,
+        doc_offsets_path: Optional[PathLike] = None):
+    topic_state = TopicState(topic_state_path)
+    dtype = np.min_scalar_type(topic_state.num_topics - 1)
+
+    def check_topics(topics: Union[np.ndarray, 'array[int]']):
+        # Check topics before they are narrowed to dtype
+        max_topic = np.asarray(topics).max() if len(topics) > 0 else 0
+        if max_topic >= topic_state.num_topics:
+            raise Exception(
+                f'Topic state {topic_state_path} has topic {max_topic} '
+                f'but only {topic_state.num_topics} topics')
+
+    if topic_state.arrays is not None:
+        topics = topic_state.arrays.topics
+        doc_offsets = topic_state.arrays.doc_offsets
+        check_topics(topics)
+    else:
+        topics_buffer = array(dtype.char)
+        doc_offsets_buffer = array('q', [0])
+        for doc in topic_state:
+            check_topics(doc.topics)
+            topics_buffer.extend(doc.topics.tolist())
+            doc_offsets_buffer.append(len(topics_buffer))
+        topics = np.frombuffer(topics_buffer, dtype=dtype)
+        doc_offsets = np.frombuffer(doc_offsets_buffer, dtype=np.int64)
+
+    _save_array(topic_assignments_path, topics, dtype)
+    if doc_offsets_path is not None:
+        _save_array(doc_offsets_path, doc_offsets, np.dtype(np.int64))
 
 
-def _check_corpus_alignment(corpus1: Corpus, corpus2: Corpus, check_doc_ids=True):
+def check_corpus_alignment(corpus1_path: PathLike, corpus2_path: PathLike):
+    # Matching fingerprints (cached next to each corpus) imply alignment
+    fingerprint1 = load_corpus_fingerprint_if_current(corpus1_path)
+    fingerprint2 = load_corpus_fingerprint_if_current(corpus2_path)
+    if fingerprint1 is not None and fingerprint1 == fingerprint2:
+        return
+
+    fingerprints = _check_corpus_alignment(
+        PolyglotCorpus(corpus1_path), PolyglotCorpus(corpus2_path))
+    for (corpus_path, fingerprint) in zip((corpus1_path, corpus2_path), fingerprints):
+        fingerprint.save(get_corpus_fingerprint_path(corpus_path), os.path.getsize(corpus_path))
+
+
+def _check_corpus_alignment(
+        corpus1: Corpus,
+        corpus2: Corpus,
+        check_doc_ids=True) -> Tuple[CorpusFingerprint, CorpusFingerprint]:
+    # Compare the corpora doc by doc, fingerprinting them along the way
+    fingerprint1 = CorpusFingerprint()
+    fingerprint2 = CorpusFingerprint()
+    missing_doc = ('', 0)
+    for (doc1, doc2) in zip_longest(
+            corpus1.iter_doc_num_tokens(), corpus2.iter_doc_num_tokens(),
+            fillvalue=missing_doc):
+        (doc_id1, num_tokens1) = doc1
+        (doc_id2, num_tokens2) = doc2
+        if (doc1 is missing_doc or doc2 is missing_doc or num_tokens1 != num_tokens2 or
+                (check_doc_ids and doc_id1 != doc_id2)):
+            _report_corpus_misalignment(corpus1, corpus2, check_doc_ids)
+        fingerprint1.add(doc_id1, num_tokens1)
+        fingerprint2.add(doc_id2, num_tokens2)
+    return (fingerprint1, fingerprint2)
+
+
+def _get_doc_infos(corpus: Corpus, check_doc_ids: bool) -> List[str]:
     if check_doc_ids:
-        corpus1_doc_infos = [f'{doc.doc_id} {doc.num_tokens}' for doc in corpus1.docs]
-        corpus2_doc_infos = [f'{doc.doc_id} {doc.num_tokens}' for doc in corpus2.docs]
+        return [f'{doc_id} {num_tokens}' for (doc_id, num_tokens) in corpus.iter_doc_num_tokens()]
     else:
-        corpus1_doc_infos = [f'{i} {doc.num_tokens}' for (i, doc) in enumerate(corpus1.docs)]
-        corpus2_doc_infos = [f'{i} {doc.num_tokens}' for (i, doc) in enumerate(corpus2.docs)]
-
-    if corpus1_doc_infos != corpus2_doc_infos:
-        logging.warning(
-            f'Corpora {corpus1.corpus_id}, {corpus2.corpus_id} do not align')
-        for diff_line in unified_diff(
-                corpus1_doc_infos, corpus2_doc_infos,
-                fromfile=corpus1.corpus_id, tofile=corpus2.corpus_id):
-            logging.warning(diff_line)
-        raise Exception(
-            f'Corpora {corpus1.corpus_id}, {corpus2.corpus_id} do not align')
+        return [
+            f'{i} {num_tokens}' for (i, (_, num_tokens)) in enumerate(corpus.iter_doc_num_tokens())
+        ]
 
 
-def check_token_assignment_alignment(corpus_path: PathLike, topic_state_path: PathLike):
-    return _check_corpus_alignment(
-        PolyglotCorpus(corpus_path),
-        TopicState(topic_state_path),
-        check_doc_ids=False
-    )
+def _report_corpus_misalignment(corpus1: Corpus, corpus2: Corpus, check_doc_ids: bool):
+    # Re-read both corpora to log the full diff
+    logging.warning(
+        f'Corpora {corpus1.corpus_id}, {corpus2.corpus_id} do not align')
+    for diff_line in unified_diff(
+            _get_doc_infos(corpus1, check_doc_ids), _get_doc_infos(corpus2, check_doc_ids),
+            fromfile=corpus1.corpus_id, tofile=corpus2.corpus_id):
+        logging.warning(diff_line)
+    raise Exception(
+        f'Corpora {corpus1.corpus_id}, {corpus2.corpus_id} do not align')
 
 
-def load_token_assignments(input_path: PathLike) -> Iterable[Doc[TokenAssignment]]:
-    doc: Optional[Doc[TokenAssignment]] = None
+def check_token_assignment_alignment(corpus_path: PathLike, topic_state_path: PathLike):
+    # Compare the token counts in the corpus fingerprint to those in the topic state arrays,
+    # falling back to reading both in full
+    corpus = PolyglotCorpus(corpus_path)
+    topic_state = TopicState(topic_state_path)
+    fingerprint = load_corpus_fingerprint_if_current(corpus_path)
+    if fingerprint is not None and topic_state.arrays is not None and (
+            fingerprint.get('num_tokens_digest') ==
+            compute_num_tokens_digest(np.diff(topic_state.arrays.doc_offsets))):
+        return
+
+    (corpus_fingerprint, _) = _check_corpus_alignment(corpus, topic_state, check_doc_ids=False)
+    if fingerprint is None:
+        corpus_fingerprint.save(
+            get_corpus_fingerprint_path(corpus_path), os.path.getsize(corpus_path))
+
+
+def load_token_assignments(input_path: PathLike) -> Iterable[TopicAssignmentDoc]:
+    vocab: List[str] = []
+    word_ids: Dict[str, int] = {}
+    doc: Optional[TopicAssignmentDoc] = None
     prev_doc_num: int = -1
     with gzip.open(input_path, mode='rt', encoding='utf-8') as f:
         for line in f:
@@ -126,7 +462,9 @@ def load_token_assignments(input_path: PathLike) -> Iterable[Doc[TokenAssignment
                             f'but got {prev_doc_num} followed by {doc_num}')
                     if doc is not None:
                         yield doc
-                    doc = Doc(str(doc_num), [[]])
+                    doc_word_ids = array('i')
+                    doc_topics = array('i')
+                    doc = TopicAssignmentDoc(str(doc_num), vocab, doc_word_ids, doc_topics)
                     prev_doc_num = doc_num
 
                 if doc is None:
@@ -134,7 +472,12 @@ def load_token_assignments(input_path: PathLike) -> Iterable[Doc[TokenAssignment
                         'Encountered token assignment before first doc initialized... '
                         'is first doc id -1?')
 
-                doc.sections[0].append(TokenAssignment(word=word, topic=topic_num))
+                word_id = word_ids.get(word)
+                if word_id is None:
+                    word_id = word_ids[word] = len(vocab)
+                    vocab.append(word)
+                doc_word_ids.append(word_id)
+                doc_topics.append(topic_num)
 
     if doc is not None:
         yield doc
@@ -203,43 +546,160 @@ def load_stop_words(stop_list_paths: Optional[List[PathLike]]) -> Set[str]:
     return stop_words
 
 
+@dataclass(frozen=True)
+class TopicKeyInference:
+    # Untreated topic state and the tokens of it that are not stop words, shared when inferring
+    # the keys of several treated topic states
+    untreated_corpus_id: str
+    untreated_arrays: TopicStateArrays
+    is_key_candidate: np.ndarray
+    num_keys: int
+
+    @classmethod
+    def load(
+            cls,
+            untreated_topic_state: TopicState,
+            num_keys: int = DEFAULT_NUM_KEYS,
+            untreated_stop_list_path: Optional[PathLike] = None) -> 'TopicKeyInference':
+        untreated_arrays = untreated_topic_state.load_arrays()
+        is_stop_word = np.zeros(len(untreated_arrays.vocab), dtype=np.bool_)
+        if untreated_stop_list_path is not None:
+            stop_word_ids = untreated_arrays.vocabulary.to_ids(
+                load_word_list(untreated_stop_list_path))
+            is_stop_word[stop_word_ids[stop_word_ids >= 0]] = True
+        return cls(
+            untreated_corpus_id=untreated_topic_state.corpus_id,
+            untreated_arrays=untreated_arrays,
+            is_key_candidate=~is_stop_word[untreated_arrays.word_ids],
+            num_keys=num_keys,
+        )
+
+    def infer_key_ids(self, topic_state: TopicState) -> List[List[int]]:
+        # Keys are ids in the vocabulary of the untreated topic state
+        arrays = topic_state.load_arrays()
+        untreated_arrays = self.untreated_arrays
+        if not np.array_equal(arrays.doc_offsets, untreated_arrays.doc_offsets):
+            raise Exception(
+                f'Topic states {topic_state.corpus_id}, {self.untreated_corpus_id} '
+                'do not align')
+        is_key_candidate = self.is_key_candidate
+        num_keys = self.num_keys
+        vocab_size = len(untreated_arrays.vocab)
+
+        # Count (topic, word) pairs by their index in the flattened topic x word matrix, noting
+        # where each pair first occurs to break ties in order of first occurrence (as a Counter
+        # would)
+        num_topics = topic_state.num_topics
+        pair_index = arrays.topics[is_key_candidate].astype(np.int64)
+        pair_index *= vocab_size
+        pair_index += untreated_arrays.word_ids[is_key_candidate]
+        (pairs, first_positions, counts) = np.unique(
+            pair_index, return_index=True, return_counts=True)
+        topic_starts = np.searchsorted(pairs, np.arange(num_topics + 1) * vocab_size)
+
+        topic_key_ids = []
+        for topic_num in range(num_topics):
+            start = topic_starts[topic_num]
+            end = topic_starts[topic_num + 1]
+            topic_counts = counts[start:end]
+            if len(topic_counts) > num_keys:
+                # Keep every pair with a count at least the num_keys-th largest, so ties at the
+                # cutoff can be broken by first occurrence
+                cutoff = topic_counts[np.argpartition(-topic_counts, num_keys - 1)[num_keys - 1]]
+                candidates = np.flatnonzero(topic_counts >= cutoff)
+            else:
+                candidates = np.arange(len(topic_counts))
+            order = np.lexsort((first_positions[start:end][candidates], -topic_counts[candidates]))
+            topic_key_ids.append(
+                (pairs[start:end][candidates[order[:num_keys]]] % vocab_size).tolist())
+        return topic_key_ids
+
+
+def infer_topic_key_ids(
+        topic_state: TopicState,
+        untreated_topic_state: TopicState,
+        num_keys: int = DEFAULT_NUM_KEYS,
+        untreated_stop_list_path: Optional[PathLike] = None) -> List[List[int]]:
+    return TopicKeyInference.load(
+        untreated_topic_state, num_keys=num_keys,
+        untreated_stop_list_path=untreated_stop_list_path,
+    ).infer_key_ids(topic_state)
+
+
 def infer_topic_keys(
         topic_state: TopicState,
         untreated_topic_state: TopicState,
         num_keys: int = DEFAULT_NUM_KEYS,
         untreated_stop_list_path: Optional[PathLike] = None) -> List[List[str]]:
-    if untreated_stop_list_path is not None:
-        untreated_stop_words = set(load_word_list(untreated_stop_list_path))
-    else:
-        untreated_stop_words = set()
-
-    num_topics = topic_state.num_topics
-    topic_words: List[Counter[str]] = [collections.Counter() for topic_num in range(num_topics)]
-    for (doc, untr_doc) in zip(topic_state.docs, untreated_topic_state.docs):
-        for (ta, untr_ta) in zip(doc.tokens, untr_doc.tokens):
-            if untr_ta.word not in untreated_stop_words:
-                topic_words[ta.topic][untr_ta.word] += 1
+    vocabulary = untreated_topic_state.load_arrays().vocabulary
+    return [
+        vocabulary.to_words(key_ids)
+        for key_ids in infer_topic_key_ids(
+            topic_state, untreated_topic_state, num_keys=num_keys,
+            untreated_stop_list_path=untreated_stop_list_path)
+    ]
+
+
+def compute_coherence_batch_ids(
+        corpus_summary: CorpusSummary,
+        topic_key_ids_per_topic_batch: List[List[List[int]]],
+        betas: List[float]) -> List[float]:
+    # Gather co-occurrence counts of the key pairs of every topic of every key set at once;
+    # key ids are in the vocabulary of the summary, with -1 for words missing from it, and
+    # words missing from the summary (or from its co-occurrence matrix) count zero times
+    num_cooccur_words = corpus_summary.word_cooccur.shape[0]
+    batch_nums: List[int] = []
+    ell_id_list: List[int] = []
+    m_id_list: List[int] = []
+    for (batch_num, topic_key_ids_per_topic) in enumerate(topic_key_ids_per_topic_batch):
+        for topic_key_ids in topic_key_ids_per_topic:
+            for m in range(1, len(topic_key_ids)):
+                for ell in range(m):
+                    batch_nums.append(batch_num)
+                    ell_id_list.append(topic_key_ids[ell])
+                    m_id_list.append(topic_key_ids[m])
+
+    ell_ids = np.array(ell_id_list, dtype=np.int64)
+    m_ids = np.array(m_id_list, dtype=np.int64)
+    occur = np.zeros(len(ell_ids))
+    occur[ell_ids >= 0] = corpus_summary.word_occur[ell_ids[ell_ids >= 0]]
+    in_cooccur = (
+        (ell_ids >= 0) & (ell_ids < num_cooccur_words) &
+        (m_ids >= 0) & (m_ids < num_cooccur_words)
+    )
+    cooccur = np.zeros(len(ell_ids))
+    cooccur[in_cooccur] = corpus_summary.word_cooccur[ell_ids[in_cooccur], m_ids[in_cooccur]]
+
+    pair_batch_nums = np.array(batch_nums, dtype=np.int64)
+    beta = np.array(betas, dtype=np.float64)[pair_batch_nums]
+    pair_scores = np.log((cooccur + beta) / (occur + beta))
     return [
-        [word for (word, _) in topic_words[topic_num].most_common(num_keys)]
-        for topic_num in range(num_topics)
+        float(score) / len(topic_key_ids_per_topic)
+        for (score, topic_key_ids_per_topic) in zip(
+            np.bincount(
+                pair_batch_nums, weights=pair_scores,
+                minlength=len(topic_key_ids_per_topic_batch)),
+            topic_key_ids_per_topic_batch,
+        )
     ]
 
 
+def compute_coherence_batch(
+        corpus_summary: CorpusSummary[T],
+        topic_keys_per_topic_batch: List[List[List[T]]],
+        betas: List[float]) -> List[float]:
+    vocabulary = corpus_summary.vocabulary
+    return compute_coherence_batch_ids(corpus_summary, [
+        [vocabulary.to_ids(topic_keys).tolist() for topic_keys in topic_keys_per_topic]
+        for topic_keys_per_topic in topic_keys_per_topic_batch
+    ], betas)
+
+
 def _compute_coherence(
         corpus_summary: CorpusSummary[T],
         topic_keys_per_topic: List[List[T]],
         beta: float = 1.) -> float:
-    return sum(
-        sum(
-            log(
-                (corpus_summary.word_cooccur_counter[(topic_keys[ell], topic_keys[m])] + beta) /
-                (corpus_summary.word_occur_counter[topic_keys[ell]] + beta)
-            )
-            for m in range(1, len(topic_keys))
-            for ell in range(m)
-        )
-        for topic_keys in topic_keys_per_topic
-    ) / len(topic_keys_per_topic)
+    return compute_coherence_batch(corpus_summary, [topic_keys_per_topic], [beta])[0]
 
 
 def compute_coherence(
@@ -251,7 +711,7 @@ def compute_coherence(
     topic_state = TopicState(topic_state_path)
     stop_list_paths = ([stop_list_path] if stop_list_path is not None else None)
     return dict(coherence=_compute_coherence(
-        load_corpus_summary(corpus_summary_path),
+        load_corpus_summary_cached(corpus_summary_path),
         load_topic_keys(topic_keys_path, num_keys=num_keys, stop_list_paths=stop_list_paths),
         topic_state.beta,
     ))
@@ -264,15 +724,79 @@ def compute_coherence_treated(
         num_keys: int = DEFAULT_NUM_KEYS,
         untreated_stop_list_path: Optional[PathLike] = None) -> Dict[str, float]:
     topic_state = TopicState(topic_state_path)
-    return dict(coherence=_compute_coherence(
-        load_corpus_summary(untreated_corpus_summary_path),
-        infer_topic_keys(
+    untreated_topic_state = TopicState(untreated_topic_state_path)
+    corpus_summary = load_corpus_summary_cached(untreated_corpus_summary_path)
+    # Map keys from the topic state's vocabulary to the summary's without going through words
+    summary_word_ids = corpus_summary.vocabulary.map_from(
+        untreated_topic_state.load_arrays().vocabulary)
+    topic_key_ids_per_topic = [
+        summary_word_ids[key_ids].tolist()
+        for key_ids in infer_topic_key_ids(
             topic_state,
-            TopicState(untreated_topic_state_path),
+            untreated_topic_state,
             num_keys=num_keys,
             untreated_stop_list_path=untreated_stop_list_path,
-        ),
-        topic_state.beta
+        )
+    ]
+    return dict(coherence=compute_coherence_batch_ids(
+        corpus_summary, [topic_key_ids_per_topic], [topic_state.beta])[0])
+
+
+# Topic key inference shared by the coherence workers of one batch
+_topic_key_inference: List[TopicKeyInference] = []
+
+
+def _set_topic_key_inference(topic_key_inference: TopicKeyInference):
+    _topic_key_inference[:] = [topic_key_inference]
+
+
+def _infer_batch_topic_key_ids(
+        named_topic_state_path: Tuple[str, PathLike]) -> Tuple[str, List[List[int]], float]:
+    (name, topic_state_path) = named_topic_state_path
+    topic_state = TopicState(topic_state_path)
+    return (name, _topic_key_inference[0].infer_key_ids(topic_state), topic_state.beta)
+
+
+def compute_coherence_treated_batch(
+        untreated_corpus_summary_path: PathLike,
+        untreated_topic_state_path: PathLike,
+        topic_state_paths: Dict[str, PathLike],
+        num_keys: int = DEFAULT_NUM_KEYS,
+        untreated_stop_list_path: Optional[PathLike] = None,
+        num_processes: int = 1) -> Dict[str, Dict[str, float]]:
+    # compute_coherence_treated for each of the named topic states, loading the shared
+    # untreated inputs once, in this process (forked workers share them rather than loading
+    # copies of their own), and scoring all keys against the memory-mapped summary in one batch
+    named_paths = list(topic_state_paths.items())
+    topic_key_inference = TopicKeyInference.load(
+        TopicState(untreated_topic_state_path), num_keys=num_keys,
+        untreated_stop_list_path=untreated_stop_list_path)
+    _set_topic_key_inference(topic_key_inference)
+    try:
+        if num_processes <= 1:
+            inferred = [_infer_batch_topic_key_ids(named_path) for named_path in named_paths]
+        else:
+            with Pool(
+                    min(num_processes, len(named_paths)),
+                    initializer=_set_topic_key_inference,
+                    initargs=(topic_key_inference,)) as pool:
+                inferred = pool.map(_infer_batch_topic_key_ids, named_paths)
+    finally:
+        _topic_key_inference.clear()
+
+    corpus_summary = load_corpus_summary_cached(untreated_corpus_summary_path)
+    summary_word_ids = corpus_summary.vocabulary.map_from(
+        topic_key_inference.untreated_arrays.vocabulary)
+    scores = compute_coherence_batch_ids(
+        corpus_summary,
+        [
+            [summary_word_ids[key_ids].tolist() for key_ids in topic_key_ids_per_topic]
+            for (_, topic_key_ids_per_topic, _) in inferred
+        ],
+        [beta for (_, _, beta) in inferred],
+    )
+    return dict(coherence=dict(
+        (name, score) for ((name, _, _), score) in zip(inferred, scores)
     ))
 
 
@@ -308,11 +832,18 @@ def compute_joint_topic_assignment_counts(
             f'Expected flat topic assignments but got shape {topic_assignments_1.shape}')
     num_topics_1 = int(topic_assignments_1.max() + 1)
     num_topics_2 = int(topic_assignments_2.max() + 1)
-    counts: np.ndarray = np.zeros((num_topics_1, num_topics_2))
-    for i in range(topic_assignments_1.shape[0]):
-        counts[topic_assignments_1[i], topic_assignments_2[i]] += 1
+    # Count pairs of topics by their index in the flattened joint count matrix,
+    # chunk by chunk to bound the size of the temporary index array
+    joint_index_dtype = np.min_scalar_type(num_topics_1 * num_topics_2 - 1)
+    counts = np.zeros(num_topics_1 * num_topics_2, dtype=np.int64)
+    for start in range(0, topic_assignments_1.shape[0], JOINT_COUNT_CHUNK_SIZE):
+        end = start + JOINT_COUNT_CHUNK_SIZE
+        joint_index = topic_assignments_1[start:end].astype(joint_index_dtype)
+        joint_index *= num_topics_2
+        joint_index += topic_assignments_2[start:end].astype(joint_index_dtype)
+        counts += np.bincount(joint_index, minlength=num_topics_1 * num_topics_2)
 
-    return counts
+    return counts.reshape((num_topics_1, num_topics_2))
 
 
 def _compute_topic_assignment_voi(
@@ -333,8 +864,77 @@ def compute_topic_assignment_voi(
     ))
 
 
-def collect_subtask_scores(scores: Dict[str, float], output_path: PathLike):
+# Topic assignments loaded once per VOI worker process
+_voi_topic_assignments: List[np.ndarray] = []
+
+
+def _load_voi_topic_assignments(
+        topic_assignments_paths: List[PathLike],
+        mmap_mode: Optional[Literal['r', 'r+', 'c']]):
+    _voi_topic_assignments[:] = [
+        np.load(path, mmap_mode=mmap_mode) for path in topic_assignments_paths
+    ]
+
+
+def _compute_voi_matrix_entry(pair: Tuple[int, int]) -> Tuple[int, int, float]:
+    (i, j) = pair
+    return (i, j, _compute_topic_assignment_voi(
+        _voi_topic_assignments[i],
+        _voi_topic_assignments[j],
+    ))
+
+
+def compute_topic_assignment_voi_matrix(
+        topic_assignments_paths: List[PathLike],
+        num_processes: int = 1,
+        mmap_mode: Optional[Literal['r', 'r+', 'c']] = 'r') -> np.ndarray:
+    # VOI is symmetric, so only pairs (i, j) with i <= j are computed
+    num_paths = len(topic_assignments_paths)
+    pairs = [(i, j) for i in range(num_paths) for j in range(i, num_paths)]
+    voi_matrix = np.zeros((num_paths, num_paths))
+    if num_processes <= 1:
+        topic_assignments = [
+            np.load(path, mmap_mode=mmap_mode) for path in topic_assignments_paths
+        ]
+        for (i, j) in pairs:
+            voi_matrix[i, j] = voi_matrix[j, i] = _compute_topic_assignment_voi(
+                topic_assignments[i], topic_assignments[j])
+    else:
+        with Pool(
+                num_processes,
+                initializer=_load_voi_topic_assignments,
+                initargs=(topic_assignments_paths, mmap_mode)) as pool:
+            for (i, j, voi) in pool.imap_unordered(_compute_voi_matrix_entry, pairs):
+                voi_matrix[i, j] = voi_matrix[j, i] = voi
+
+    return voi_matrix
+
+
+def collect_topic_assignment_voi(
+        topic_assignments_paths: Dict[str, Dict[str, PathLike]],
+        output_path: PathLike,
+        num_processes: int = 1):
+    # Write VOI for every ordered pair of topic assignments within each group
+    # (language), named as f'{group}.{name1}.{name2}'
+    scores: Dict[str, float] = {}
+    for (group, group_paths) in topic_assignments_paths.items():
+        names = list(group_paths)
+        voi_matrix = compute_topic_assignment_voi_matrix(
+            list(group_paths.values()), num_processes=num_processes)
+        for ((i, name_1), (j, name_2)) in product(enumerate(names), repeat=2):
+            scores[f'{group}.{name_1}.{name_2}'] = voi_matrix[i, j]
+    collect_subtask_scores(scores, output_path)
+
+
+def collect_subtask_scores(
+        scores: Mapping[str, Union[float, Dict[str, float]]],
+        output_path: PathLike):
+    # Scores of batched tasks are dicts of subtask scores, which are written in their place
     with open(output_path, encoding='utf-8', mode='w') as f:
         f.write('subtask\tscore\n')
         for (subtask, score) in scores.items():
-            f.write(f'{subtask}\t{score}\n')
+            if isinstance(score, dict):
+                for (batch_subtask, batch_score) in score.items():
+                    f.write(f'{batch_subtask}\t{batch_score}\n')
+            else:
+                f.write(f'{subtask}\t{score}\n')
@@ -1,20 +1,55 @@
+import ctypes
+import io
 import logging
-import re
+import os
+import shutil
+import signal
+import subprocess
+from collections import deque
 from dataclasses import dataclass
+from itertools import chain
+from multiprocessing.pool import AsyncResult, Pool, ThreadPool
+from multiprocessing.sharedctypes import RawArray, RawValue
 from os import PathLike
-from typing import Iterable, List, Optional, TextIO
+from pathlib import PurePath
+from queue import Queue
+from tempfile import TemporaryDirectory
+from threading import Thread
+from typing import (
+    BinaryIO, Callable, Deque, Iterable, Iterator, List, Optional, TextIO, Tuple, Union
+)
 
-import conllu
+import numpy as np
+from conllu.parser import DEFAULT_FIELDS as CONLLU_DEFAULT_FIELDS, parse_line as conllu_parse_line
 
-from .util import save_polyglot, Doc, get_doc_id
+from .util import (
+    save_polyglot, Doc, build_polyglot_index, get_doc_id, load_polyglot_index_if_current
+)
 
-# treetagger treats <> as SGML, so we allow for that here as well:
-SGML_TAG_RE = re.compile(r'<.*>')
+UNKNOWN_LEMMA = '<unknown>'
 
-UNKNOWN_LEMMA_RE = re.compile(r'<unknown>')
+SENT_START_TAG = '<s>'
+SENT_END_TAG = '</s>'
 
-SENT_START_RE = re.compile(r'<s>')
-SENT_END_RE = re.compile(r'</s>')
+# Number of docs before and after each chunk that are also tagged, so that the tagger sees
+# the same context at chunk boundaries as it does when tagging the whole corpus
+TREETAGGER_CONTEXT_NUM_DOCS = 1
+COPY_BLOCK_SIZE = 2 ** 20
+
+# Number of shards per UDPipe process, so that a slow shard does not leave the other
+# processes idle for long
+UDPIPE_NUM_SHARDS_PER_PROCESS = 4
+
+SENT_ID_COMMENT_PREFIX = b'# sent_id = '
+NEWDOC_COMMENT_PREFIX = b'# newdoc'
+
+# In _lemmatize_parse_chunks pool workers: the shared array in which _run_tagger_parser
+# records the process group id of each chunk's tagger (or 0 when it is not running), and the
+# shared flag set when a chunk has failed, so that the parent can kill the running taggers
+# and no more are started; and the index of the current chunk
+_tagger_pgids: Optional['ctypes.Array[ctypes.c_int]'] = None
+_taggers_stopped: Optional['ctypes.c_bool'] = None
+_chunk_num: Optional[int] = None
 
 
 @dataclass
@@ -31,60 +66,362 @@ class LemmaData(object):
         return self.lemma if self.lemma is not None else self.form
 
 
+def _get_polyglot_chunks(
+        input_path: PathLike,
+        num_chunks: int,
+        context_num_docs: int = 0) -> List[Tuple[int, int, Optional[str], Optional[str]]]:
+    # Split the corpus at doc boundaries into chunks of about equal size, returning the byte
+    # range to tag for each (including context docs) and the doc ids of the first doc of the
+    # chunk and of the next chunk (None at the start and end of the corpus)
+    size = os.path.getsize(input_path)
+    # The index is only built in memory here, since the lemmatization tasks do not own it
+    index = load_polyglot_index_if_current(input_path) or build_polyglot_index(input_path)
+    offsets = index.offsets.tolist()
+    chunk_doc_nums = sorted(set(
+        int(doc_num)
+        for doc_num in np.searchsorted(
+            index.offsets, [size * chunk_num // num_chunks for chunk_num in range(1, num_chunks)])
+        if 0 < doc_num < len(offsets)
+    ))
+    boundaries = [0] + chunk_doc_nums + [len(offsets)]
+    chunks = []
+    for (start_doc_num, end_doc_num) in zip(boundaries, boundaries[1:]):
+        if start_doc_num == 0:
+            (start, start_doc_id) = (0, None)
+        else:
+            start = offsets[max(start_doc_num - context_num_docs, 0)]
+            start_doc_id = index.doc_ids[start_doc_num]
+        if end_doc_num == len(offsets):
+            (end, end_doc_id) = (size, None)
+        else:
+            end_context_doc_num = end_doc_num + context_num_docs
+            end = offsets[end_context_doc_num] if end_context_doc_num < len(offsets) else size
+            end_doc_id = index.doc_ids[end_doc_num]
+        chunks.append((start, end, start_doc_id, end_doc_id))
+    return chunks
+
+
+def _copy_byte_range(in_f: BinaryIO, out_f: BinaryIO, start: int, end: int):
+    in_f.seek(start)
+    for block_start in range(start, end, COPY_BLOCK_SIZE):
+        out_f.write(in_f.read(min(COPY_BLOCK_SIZE, end - block_start)))
+
+
+def _write_byte_range(input_path: PathLike, start: int, end: int, out_f: BinaryIO):
+    # Write bytes [start, end) of a file to a stream (e.g., a subprocess's standard input) and
+    # close the stream; if the reader goes away, its exit status tells what went wrong
+    try:
+        with open(input_path, mode='rb') as in_f:
+            _copy_byte_range(in_f, out_f, start, end)
+    except BrokenPipeError:
+        pass
+    finally:
+        try:
+            out_f.close()
+        except BrokenPipeError:
+            pass
+
+
+class _IterableReader(io.RawIOBase):
+    # Read a binary stream from an iterable of chunks
+
+    def __init__(self, chunks: Iterable[bytes]):
+        super().__init__()
+        self._chunks = iter(chunks)
+        self._chunk = memoryview(b'')
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while not self._chunk:
+            item = next(self._chunks, None)
+            if item is None:
+                return 0
+            self._chunk = memoryview(item)
+        n = min(len(b), len(self._chunk))
+        b[:n] = self._chunk[:n]
+        self._chunk = self._chunk[n:]
+        return n
+
+
+def _open_byte_lines(lines: Iterable[bytes]) -> TextIO:
+    return io.TextIOWrapper(io.BufferedReader(_IterableReader(lines)), encoding='utf-8')
+
+
+def _run_tagger_parser(
+        command: List[str],
+        input_path: PathLike,
+        start: int,
+        end: int,
+        parse_lines: Callable[[Iterable[bytes]], Iterable[Doc[str]]],
+        output_path: PathLike):
+    # Pipe bytes [start, end) of a polyglot corpus through a tagger subprocess and save the
+    # docs parsed from its standard output as it is produced.  Only the OS pipe buffers sit
+    # between the tagger and the parser, so a slow parser blocks the tagger and vice versa.
+    # The tagger (often a shell pipeline) gets a process group of its own so that all of it
+    # can be killed if the parse fails or another chunk does
+    process = subprocess.Popen(
+        command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, start_new_session=True)
+    if _tagger_pgids is not None and _chunk_num is not None:
+        _tagger_pgids[_chunk_num] = process.pid
+    if _taggers_stopped is not None and _taggers_stopped.value:
+        _kill_process_group(process.pid)
+    writer = Thread(
+        target=_write_byte_range, args=(input_path, start, end, process.stdin), daemon=True)
+    writer.start()
+    try:
+        assert process.stdout is not None
+        save_polyglot(output_path, parse_lines(process.stdout))
+        # Discard any output the parser did not need (e.g., trailing context) so that the
+        # tagger can finish
+        while process.stdout.read(COPY_BLOCK_SIZE):
+            pass
+    except BaseException:
+        _kill_process_group(process.pid)
+        raise
+    finally:
+        if process.stdout is not None:
+            process.stdout.close()
+        writer.join()
+        if _tagger_pgids is not None and _chunk_num is not None:
+            _tagger_pgids[_chunk_num] = 0
+        process.wait()
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, process.args)
+
+
+def _kill_process_group(pgid: int):
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def _init_lemmatize_parse_chunk_worker(
+        tagger_pgids: 'ctypes.Array[ctypes.c_int]',
+        taggers_stopped: 'ctypes.c_bool'):
+    global _tagger_pgids, _taggers_stopped
+    _tagger_pgids = tagger_pgids
+    _taggers_stopped = taggers_stopped
+
+
+def _run_lemmatize_parse_chunk(
+        args: Tuple[Callable[[tuple], None], int, tuple]):
+    global _chunk_num
+    (lemmatize_parse_chunk, chunk_num, chunk) = args
+    _chunk_num = chunk_num
+    try:
+        lemmatize_parse_chunk(chunk)
+    finally:
+        _chunk_num = None
+
+
+def _lemmatize_parse_chunks(
+        lemmatize_parse_chunk: Callable[[tuple], None],
+        chunks: List[tuple],
+        output_path: PathLike,
+        num_processes: int):
+    # Run lemmatize_parse_chunk(chunk + (chunk_output_path,)) on each chunk, num_processes at
+    # a time, and concatenate the parsed chunks in order.  A chunk is only started when
+    # another finishes, and the first failure (in any chunk) is raised as soon as it happens,
+    # after killing the running taggers, without starting more chunks.
+    if len(chunks) == 1:
+        lemmatize_parse_chunk(chunks[0] + (output_path,))
+        return
+
+    tagger_pgids = RawArray(ctypes.c_int, len(chunks))
+    taggers_stopped = RawValue(ctypes.c_bool, False)
+    with TemporaryDirectory(dir=PurePath(output_path).parent) as temp_dir:
+        chunk_output_paths = [
+            os.path.join(temp_dir, f'{chunk_num}.parsed.txt') for chunk_num in range(len(chunks))
+        ]
+        finished_chunks: 'Queue[Tuple[int, Optional[BaseException]]]' = Queue()
+        num_started_chunks = 0
+        # The pool is closed and joined, once the taggers have been killed, rather than
+        # terminated (as on leaving a with block): terminating it while a worker is sending a
+        # result, as the workers whose taggers were killed are, can leave the result queue
+        # locked and hang
+        pool = Pool(num_processes, initializer=_init_lemmatize_parse_chunk_worker,
+                    initargs=(tagger_pgids, taggers_stopped))
+
+        def start_next_chunk():
+            nonlocal num_started_chunks
+            if num_started_chunks < len(chunks):
+                chunk_num = num_started_chunks
+                pool.apply_async(
+                    _run_lemmatize_parse_chunk,
+                    ((lemmatize_parse_chunk, chunk_num,
+                      chunks[chunk_num] + (chunk_output_paths[chunk_num],)),),
+                    callback=lambda _: finished_chunks.put((chunk_num, None)),
+                    error_callback=lambda e: finished_chunks.put((chunk_num, e)))
+                num_started_chunks += 1
+
+        try:
+            for _ in range(num_processes):
+                start_next_chunk()
+            finished_chunk_nums = set()
+            with open(output_path, mode='wb') as out_f:
+                for (chunk_num, chunk_output_path) in enumerate(chunk_output_paths):
+                    while chunk_num not in finished_chunk_nums:
+                        (finished_chunk_num, error) = finished_chunks.get()
+                        if error is not None:
+                            raise error
+                        finished_chunk_nums.add(finished_chunk_num)
+                        start_next_chunk()
+                    with open(chunk_output_path, mode='rb') as f:
+                        shutil.copyfileobj(f, out_f, COPY_BLOCK_SIZE)
+                    os.remove(chunk_output_path)
+        except BaseException:
+            # Taggers started from here on kill themselves
+            taggers_stopped.value = True
+            for pgid in tagger_pgids:
+                if pgid:
+                    _kill_process_group(pgid)
+            raise
+        finally:
+            pool.close()
+            pool.join()
+
+
+def _trim_treetagger_chunk_output(
+        lines: Iterable[bytes],
+        start_doc_id: Optional[str],
+        end_doc_id: Optional[str]) -> Iterator[bytes]:
+    # Yield the tagged sentences from the doc id sentence of start_doc_id (or the beginning)
+    # up to that of end_doc_id (or the end)
+    start_form = None if start_doc_id is None else f'[[{start_doc_id}]]'.encode('utf-8')
+    end_form = None if end_doc_id is None else f'[[{end_doc_id}]]'.encode('utf-8')
+    copying = start_form is None
+    # A sentence start tag is held back until we know whether a doc id follows it
+    sent_start_line: Optional[bytes] = None
+    for line in lines:
+        if sent_start_line is not None:
+            form = line.split(b'\t', 1)[0].rstrip(b'\r\n')
+            if not copying and form == start_form:
+                copying = True
+            elif copying and form == end_form:
+                return
+            if copying:
+                yield sent_start_line
+            sent_start_line = None
+        if line.rstrip(b'\r\n') == b'<s>':
+            sent_start_line = line
+        elif copying:
+            yield line
+    if copying and sent_start_line is not None:
+        yield sent_start_line
+
+
+def lemmatize_treetagger(
+        program_path: str,
+        input_path: PathLike,
+        output_path: PathLike,
+        num_processes: int = 1,
+        context_num_docs: int = TREETAGGER_CONTEXT_NUM_DOCS):
+    # Run a TreeTagger wrapper script (which tags its standard input) on num_processes chunks
+    # of a polyglot corpus at once and concatenate the tagged chunks
+    chunks = _get_polyglot_chunks(input_path, num_processes, context_num_docs)
+    with TemporaryDirectory(dir=PurePath(output_path).parent) as temp_dir:
+        processes = []
+        with open(input_path, mode='rb') as in_f:
+            for (chunk_num, (start, end, _, _)) in enumerate(chunks):
+                chunk_path = os.path.join(temp_dir, f'{chunk_num}.txt')
+                with open(chunk_path, mode='wb') as chunk_f:
+                    _copy_byte_range(in_f, chunk_f, start, end)
+                with open(chunk_path, mode='rb') as chunk_in_f, \
+                        open(chunk_path + '.tagged', mode='wb') as chunk_out_f:
+                    processes.append(subprocess.Popen(
+                        [program_path], stdin=chunk_in_f, stdout=chunk_out_f))
+
+        for process in processes:
+            if process.wait() != 0:
+                raise subprocess.CalledProcessError(process.returncode, process.args)
+
+        with open(output_path, mode='wb') as out_f:
+            for (chunk_num, (_, _, start_doc_id, end_doc_id)) in enumerate(chunks):
+                with open(os.path.join(temp_dir, f'{chunk_num}.txt.tagged'), mode='rb') as f:
+                    out_f.writelines(_trim_treetagger_chunk_output(f, start_doc_id, end_doc_id))
+
+
+def _lemmatize_parse_treetagger_chunk(
+        chunk: Tuple[str, str, PathLike, int, int, Optional[str], Optional[str], PathLike]):
+    (lang, program_path, input_path, start, end, start_doc_id, end_doc_id, output_path) = chunk
+
+    def parse_lines(lines: Iterable[bytes]) -> Iterable[Doc[str]]:
+        return _parse_treetagger(lang, _open_byte_lines(
+            _trim_treetagger_chunk_output(lines, start_doc_id, end_doc_id)))
+
+    _run_tagger_parser([program_path], input_path, start, end, parse_lines, output_path)
+
+
+def lemmatize_parse_treetagger(
+        lang: str,
+        program_path: str,
+        input_path: PathLike,
+        output_path: PathLike,
+        num_processes: int = 1,
+        context_num_docs: int = TREETAGGER_CONTEXT_NUM_DOCS):
+    # Like lemmatize_treetagger followed by parse_treetagger, without writing the tagged text:
+    # each chunk is tagged and parsed in a pipeline of its own
+    chunks = _get_polyglot_chunks(input_path, num_processes, context_num_docs)
+    _lemmatize_parse_chunks(_lemmatize_parse_treetagger_chunk, [
+        (lang, program_path, input_path, start, end, start_doc_id, end_doc_id)
+        for (start, end, start_doc_id, end_doc_id) in chunks
+    ], output_path, num_processes)
+
+
 def parse_treetagger(lang: str, input_path: PathLike, output_path: PathLike):
     with open(input_path, encoding='utf-8') as f:
         save_polyglot(output_path, _parse_treetagger(lang, f))
 
 
 def _parse_treetagger(lang: str, f: TextIO) -> Iterable[Doc[str]]:
-    if lang == 'ko':
-        return parse_polyglot_lemmas(
-            [
-                LemmaData(
-                    form=token.form,
-                    lemma=(
-                        token.lemma.split('_')[0]
-                        if token.lemma is not None and token.pos is not None and '_' in token.pos
-                        else token.lemma
-                    ),
-                    pos=token.pos
-                )
-                for token in section
-            ]
-            for section in parse_treetagger_to_tokens(f)
-        )
-    else:
-        return parse_polyglot_lemmas(parse_treetagger_to_tokens(f))
-
-
-def parse_treetagger_to_tokens(f: TextIO) -> Iterable[List[LemmaData]]:
-    sentence: List[LemmaData] = []
-    for line in f:
+    # Read the lemmas (or, if unknown, the forms) of the tagged tokens and SGML tags in
+    # TreeTagger output, splitting lemmas on _ where the POS has one (as in Korean), and group
+    # the sentences into docs at doc id sentences, in one pass with plain string comparisons.
+    # A sentence's forms are only kept, to check for a doc id, if it starts with '['.
+    split_lemmas = (lang == 'ko')
+    doc: Optional[Doc[str]] = None
+    lemmas: List[str] = []
+    doc_id_forms: List[str] = []
+    for line in chain(f, (SENT_END_TAG,)):
         line = line.strip()
-        if line:
-            if SENT_START_RE.fullmatch(line):
-                pass
+        if not line or line == SENT_START_TAG:
+            continue
 
-            elif SENT_END_RE.fullmatch(line):
-                if sentence:
-                    yield sentence
-                    sentence = []
+        if line == SENT_END_TAG:
+            if lemmas:
+                doc_id = get_doc_id(''.join(doc_id_forms)) if doc_id_forms else None
+                if doc_id is not None:
+                    if doc is not None and doc.tokens:
+                        yield doc
+                    doc = Doc(doc_id)
+                elif doc is not None:
+                    doc.add_section(lemmas)
+                lemmas.clear()
+                doc_id_forms.clear()
+            continue
 
-            else:
-                line_tokens = line.split('\t')
-                if len(line_tokens) == 3:
-                    (form, pos, lemma) = line_tokens
-                    if UNKNOWN_LEMMA_RE.fullmatch(lemma):
-                        sentence.append(LemmaData(form=form, pos=pos))
-                    else:
-                        sentence.append(LemmaData(form=form, pos=pos, lemma=lemma))
-                elif SGML_TAG_RE.fullmatch(line) is not None:
-                    sentence.append(LemmaData(form=line))
-                else:
-                    logging.warning(f'Unexpected number of tokens in line: {line_tokens}')
+        line_tokens = line.split('\t')
+        if len(line_tokens) == 3:
+            (form, pos, lemma) = line_tokens
+            if lemma == UNKNOWN_LEMMA:
+                lemma = form
+            elif split_lemmas and '_' in pos:
+                lemma = lemma.split('_', 1)[0]
+        elif line[0] == '<' and line[-1] == '>':
+            # treetagger treats <> as SGML, so we allow for that here as well
+            form = lemma = line
+        else:
+            logging.warning(f'Unexpected number of tokens in line: {line_tokens}')
+            continue
+        if doc_id_forms or (not lemmas and form[0] == '['):
+            doc_id_forms.append(form)
+        lemmas.append(lemma)
 
-    if sentence:
-        yield sentence
+    if doc is not None and doc.tokens:
+        yield doc
 
 
 def parse_polyglot_lemmas(tokens: Iterable[List[LemmaData]]) -> Iterable[Doc[str]]:
@@ -94,20 +431,172 @@ def parse_polyglot_lemmas(tokens: Iterable[List[LemmaData]]) -> Iterable[Doc[str
         if doc_id is not None:
             if doc is not None and doc.tokens:
                 yield doc
-            doc = Doc(doc_id, [])
+            doc = Doc(doc_id)
         elif doc is not None and sent_tokens:
-            doc.sections.append([token.get_lemma() for token in sent_tokens])
+            doc.add_section(token.get_lemma() for token in sent_tokens)
 
     if doc is not None and doc.tokens:
         yield doc
 
 
-def _parse_conllu_sentence(sentence: conllu.TokenList) -> Iterable[LemmaData]:
-    for token in sentence:
-        if token['lemma'] == '_':
-            yield LemmaData(form=token['form'], pos=token['upos'])
-        else:
-            yield LemmaData(form=token['form'], pos=token['upos'], lemma=token['lemma'])
+def parse_conllu_to_tokens(f: TextIO, split_lemmas: bool = False) -> Iterable[List[LemmaData]]:
+    # Read the form, lemma and UPOS (and, if split_lemmas, split the lemma on the + separators
+    # given in the XPOS, as in Korean) of each token, as read with conllu.parse_incr, without
+    # parsing the other fields or building token lists; multiword and empty nodes are kept, as
+    # conllu does
+    sentence: List[LemmaData] = []
+    for line in f:
+        line = line.strip()
+        if not line:
+            if sentence:
+                yield sentence
+                sentence = []
+
+        elif line[0] != '#':
+            fields = line.split('\t', 5)
+            if len(fields) >= 5 and '  ' not in line:
+                (_, form, lemma, upos, xpos) = fields[:5]
+            else:
+                # Columns may also be separated by runs of spaces, and may be missing
+                token = conllu_parse_line(line, CONLLU_DEFAULT_FIELDS)
+                (form, lemma, upos) = (token['form'], token['lemma'], token['upos'])
+                xpos = token['xpos'] if split_lemmas else ''
+            if lemma == '_':
+                sentence.append(LemmaData(form=form, pos=upos))
+            elif split_lemmas and xpos is not None and '+' in xpos:
+                sentence.append(LemmaData(
+                    form=form, pos=upos, lemma=lemma.strip('+').split('+')[0]))
+            else:
+                sentence.append(LemmaData(form=form, pos=upos, lemma=lemma))
+
+    if sentence:
+        yield sentence
+
+
+def _run_udpipe_shard(
+        shard: Tuple[str, Union[str, PathLike], Union[str, PathLike], int, int, str]) -> str:
+    # Tag bytes [start, end) of a polyglot corpus with UDPipe and return the path of the
+    # CoNLL-U output
+    (program_path, model_path, input_path, start, end, shard_path) = shard
+    if start == 0 and end == os.path.getsize(input_path):
+        shard_input_path = os.fspath(input_path)
+    else:
+        shard_input_path = shard_path + '.txt'
+        with open(input_path, mode='rb') as in_f, \
+                open(shard_input_path, mode='wb') as shard_input_f:
+            _copy_byte_range(in_f, shard_input_f, start, end)
+    shard_output_path = shard_path + '.conllu'
+    subprocess.run(
+        [
+            program_path,
+            '--tag',
+            '--immediate',
+            '--input=horizontal',
+            f'--outfile={shard_output_path}',
+            os.fspath(model_path),
+            shard_input_path,
+        ],
+        check=True)
+    if shard_input_path != os.fspath(input_path):
+        os.remove(shard_input_path)
+    return shard_output_path
+
+
+def iter_udpipe_output(
+        program_path: str,
+        model_path: PathLike,
+        input_path: PathLike,
+        num_processes: int = 1,
+        num_shards: Optional[int] = None,
+        temp_dir_parent: Optional[PathLike] = None) -> Iterator[bytes]:
+    # Run UDPipe on num_shards doc-aligned shards of a polyglot corpus, at most num_processes
+    # at a time, and yield the lines of the CoNLL-U output in corpus order.  Sentence ids are
+    # renumbered and only the first newdoc comment is kept, as in a single run over the corpus.
+    # Only num_processes shards are started ahead of the one being yielded, and each shard's
+    # output is deleted once it has been yielded, so at most num_processes + 1 shard outputs
+    # are on disk at a time.
+    if num_shards is None:
+        num_shards = num_processes * UDPIPE_NUM_SHARDS_PER_PROCESS if num_processes > 1 else 1
+    chunks = _get_polyglot_chunks(input_path, num_shards)
+    with TemporaryDirectory(dir=temp_dir_parent) as temp_dir, \
+            ThreadPool(num_processes) as pool:
+        shards = iter([
+            (program_path, model_path, input_path, start, end,
+             os.path.join(temp_dir, str(shard_num)))
+            for (shard_num, (start, end, _, _)) in enumerate(chunks)
+        ])
+        pending_shards: Deque[AsyncResult] = deque()
+
+        def start_next_shard():
+            shard = next(shards, None)
+            if shard is not None:
+                pending_shards.append(pool.apply_async(_run_udpipe_shard, (shard,)))
+
+        for _ in range(num_processes):
+            start_next_shard()
+        num_sents = 0
+        shard_num = 0
+        while pending_shards:
+            shard_output_path = pending_shards.popleft().get()
+            start_next_shard()
+            shard_num_sents = 0
+            with open(shard_output_path, mode='rb') as f:
+                for line in f:
+                    if line.startswith(SENT_ID_COMMENT_PREFIX):
+                        sent_id = line[len(SENT_ID_COMMENT_PREFIX):].strip()
+                        if sent_id.isdigit():
+                            line = SENT_ID_COMMENT_PREFIX + b'%d\n' % (num_sents + int(sent_id))
+                    elif shard_num > 0 and line.startswith(NEWDOC_COMMENT_PREFIX):
+                        continue
+                    elif not line.strip():
+                        shard_num_sents += 1
+                    yield line
+            num_sents += shard_num_sents
+            shard_num += 1
+            os.remove(shard_output_path)
+
+
+def lemmatize_udpipe(
+        program_path: str,
+        model_path: PathLike,
+        input_path: PathLike,
+        output_path: PathLike,
+        num_processes: int = 1):
+    with open(output_path, mode='wb') as f:
+        f.writelines(iter_udpipe_output(
+            program_path, model_path, input_path,
+            num_processes=num_processes, temp_dir_parent=PurePath(output_path).parent))
+
+
+def _lemmatize_parse_udpipe_chunk(
+        chunk: Tuple[str, str, PathLike, PathLike, int, int, PathLike]):
+    (lang, program_path, model_path, input_path, start, end, output_path) = chunk
+
+    def parse_lines(lines: Iterable[bytes]) -> Iterable[Doc[str]]:
+        return _parse_udpipe(lang, _open_byte_lines(lines))
+
+    _run_tagger_parser(
+        [program_path, '--tag', '--immediate', '--input=horizontal', os.fspath(model_path)],
+        input_path, start, end, parse_lines, output_path)
+
+
+def lemmatize_parse_udpipe(
+        lang: str,
+        program_path: str,
+        model_path: PathLike,
+        input_path: PathLike,
+        output_path: PathLike,
+        num_processes: int = 1,
+        num_shards: Optional[int] = None):
+    # Like lemmatize_udpipe followed by parse_udpipe, without writing the CoNLL-U output:
+    # each shard is tagged and parsed in a pipeline of its own
+    if num_shards is None:
+        num_shards = num_processes * UDPIPE_NUM_SHARDS_PER_PROCESS if num_processes > 1 else 1
+    chunks = _get_polyglot_chunks(input_path, num_shards)
+    _lemmatize_parse_chunks(_lemmatize_parse_udpipe_chunk, [
+        (lang, program_path, model_path, input_path, start, end)
+        for (start, end, _, _) in chunks
+    ], output_path, num_processes)
 
 
 def parse_udpipe(lang: str, input_path: PathLike, output_path: PathLike):
@@ -116,27 +605,4 @@ def parse_udpipe(lang: str, input_path: PathLike, output_path: PathLike):
 
 
 def _parse_udpipe(lang: str, f: TextIO) -> Iterable[Doc[str]]:
-    if lang == 'ko':
-        return parse_polyglot_lemmas(
-            [
-                LemmaData(
-                    form=token['form'],
-                    lemma=(
-                        token['lemma'].strip('+').split('+')[0]
-                        if (
-                            token['lemma'] is not None and
-                            token['xpos'] is not None and
-                            '+' in token['xpos']
-                        ) else token['lemma']
-                    ) if token['lemma'] != '_' else None,
-                    pos=token['upos']
-                )
-                for token in sentence
-            ]
-            for sentence in conllu.parse_incr(f)
-        )
-    else:
-        return parse_polyglot_lemmas(
-            list(_parse_conllu_sentence(sentence))
-            for sentence in conllu.parse_incr(f)
-        )
+    return parse_polyglot_lemmas(parse_conllu_to_tokens(f, split_lemmas=(lang == 'ko')))
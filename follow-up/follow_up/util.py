@@ -1,38 +1,119 @@
 import collections
+import hashlib
+import io
+import json
+import lzma
+import mmap
 import numpy as np
+import os
+import queue
 import re
+import scipy.sparse
+import sys
+import tarfile
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
 from dataclasses import dataclass
 from itertools import product
-from functools import cached_property
+from multiprocessing.pool import Pool
+from functools import cached_property, reduce
+from operator import add
 from os import PathLike
-from pathlib import PurePath
-from random import sample
-from typing import Counter, Dict, Generic, Iterable, Iterator, List, Optional, Tuple, TypeVar
+from pathlib import Path, PurePath
+from random import Random
+from tempfile import NamedTemporaryFile, TemporaryDirectory
+from threading import Event, Lock, Thread
+from typing import (
+    IO, Any, Callable, ContextManager, Counter, Dict, Generic, Iterable, Iterator, List, Literal,
+    Optional, Protocol, Sequence, Tuple, TypeVar, Union,
+)
 
+LINE_BREAK_RE = re.compile(r'\r\n|\r|\n')
 DOC_ID_RE = re.compile(r'\[\[(?P<doc_id>\d+)\]\]')
 DOC_LOG_INTERVAL = 10
 
+CORPUS_SUMMARY_META_FILENAME = 'meta.json'
+CORPUS_SUMMARY_VOCAB_FILENAME = 'vocab.txt'
+CORPUS_SUMMARY_WORD_OCCUR_FILENAME = 'word_occur.npy'
+CORPUS_SUMMARY_WORD_COOCCUR_FILENAME = 'word_cooccur.npy'
+
+DEFAULT_CORPUS_SUMMARY_CACHE_MAX_BYTES = 2 ** 32
+
 MAX_COOCCUR_NUM_WORDS = 10000
+# Bound on the number of (word, word) products computed per sparse batch
+MAX_COOCCUR_BATCH_NUM_PAIRS = 2 ** 24
+
+POLYGLOT_ARCHIVE_SUFFIXES = ('.tar.lzma', '.tar.xz')
+ARCHIVE_READ_CHUNK_SIZE = 2 ** 20
+ARCHIVE_READ_MAX_NUM_CHUNKS = 16
+
+# Number of docs per word id spill when preprocessing, so co-occurrences can be counted in
+# parallel
+PREPROCESS_SPILL_NUM_DOCS = 2 ** 14
 
 T = TypeVar('T')
+T_co = TypeVar('T_co', covariant=True)
+
+
+class ReadOnlyDoc(Protocol[T_co]):
+    # What corpora read of a doc, which Doc and docs stored otherwise (such as the topic
+    # assignment docs of a topic state) provide
+    @property
+    def doc_id(self) -> str: ...
+
+    @property
+    def tokens(self) -> Sequence[T_co]: ...
+
+    @property
+    def section_offsets(self) -> List[int]: ...
+
+    @property
+    def num_tokens(self) -> int: ...
 
 
-@dataclass
 class Doc(Generic[T]):
+    # Tokens are stored flat, with section i at tokens[section_offsets[i]:section_offsets[i + 1]]
+    __slots__ = ('doc_id', '_tokens', '_section_offsets')
     doc_id: str
-    sections: List[List[T]]
+    _tokens: List[T]
+    _section_offsets: List[int]
+
+    def __init__(self, doc_id: str, sections: Iterable[Iterable[T]] = ()):
+        self.doc_id = doc_id
+        self._tokens = []
+        self._section_offsets = [0]
+        for section in sections:
+            self.add_section(section)
+
+    @classmethod
+    def from_tokens(cls, doc_id: str, tokens: List[T], section_offsets: List[int]) -> 'Doc[T]':
+        doc: Doc[T] = cls(doc_id)
+        doc._tokens = tokens
+        doc._section_offsets = section_offsets
+        return doc
+
+    def add_section(self, section: Iterable[T]):
+        self._tokens.extend(section)
+        self._section_offsets.append(len(self._tokens))
+
+    @property
+    def tokens(self) -> List[T]:
+        return self._tokens
+
+    @property
+    def section_offsets(self) -> List[int]:
+        return self._section_offsets
 
     @property
     def num_tokens(self) -> int:
-        return len(self.tokens)
+        return len(self._tokens)
 
     @property
-    def tokens(self) -> List[T]:
-        return [
-            token
-            for section in self.sections
-            for token in section
-        ]
+    def sections(self) -> List[List[T]]:
+        tokens = self.tokens
+        offsets = self.section_offsets
+        return [tokens[start:end] for (start, end) in zip(offsets, offsets[1:])]
 
     @property
     def text(self) -> str:
@@ -51,6 +132,63 @@ class Doc(Generic[T]):
     def to_polyglot(self) -> str:
         return f'[[{self.doc_id}]]\n{self.text}'
 
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Doc):
+            return NotImplemented
+        return (self.doc_id == other.doc_id and self.tokens == other.tokens and
+                self.section_offsets == other.section_offsets)
+
+    __hash__ = None  # type: ignore
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}({self.doc_id!r}, {self.sections!r})'
+
+
+class Vocabulary(Generic[T]):
+    # Dense integer ids of words, in order of addition; the vocabulary of a corpus summary
+    # numbers words by document frequency rank, which also indexes its count arrays
+    __slots__ = ('words', 'word_ids')
+    words: List[T]
+    word_ids: Dict[T, int]
+
+    def __init__(self, words: Iterable[T] = ()):
+        self.words = []
+        self.word_ids = {}
+        for word in words:
+            self.add(word)
+
+    def add(self, word: T) -> int:
+        word_id = self.word_ids.get(word)
+        if word_id is None:
+            word_id = self.word_ids[word] = len(self.words)
+            self.words.append(word)
+        return word_id
+
+    def __len__(self) -> int:
+        return len(self.words)
+
+    def __contains__(self, word: object) -> bool:
+        return word in self.word_ids
+
+    def get_id(self, word: T, default: int = -1) -> int:
+        return self.word_ids.get(word, default)
+
+    def to_ids(self, words: Iterable[T]) -> np.ndarray:
+        # Words not in the vocabulary get id -1
+        word_ids = self.word_ids
+        return np.array([word_ids.get(word, -1) for word in words], dtype=np.int64)
+
+    def to_words(self, word_ids: Iterable[int]) -> List[T]:
+        words = self.words
+        return [words[word_id] for word_id in word_ids]
+
+    def map_from(self, other: 'Vocabulary[T]') -> np.ndarray:
+        # Array mapping ids of other to ids of this vocabulary (-1 if missing)
+        return self.to_ids(other.words)
+
+    def save(self, path: PathLike):
+        save_word_list(path, self.words)
+
 
 @dataclass(frozen=True)
 class CorpusSummary(Generic[T]):
@@ -62,8 +200,12 @@ class CorpusSummary(Generic[T]):
     word_cooccur: np.ndarray
 
     @cached_property
+    def vocabulary(self) -> Vocabulary[T]:
+        return Vocabulary(self.vocab)
+
+    @property
     def word_index(self) -> Dict[T, int]:
-        return dict((word, i) for (i, word) in enumerate(self.vocab))
+        return self.vocabulary.word_ids
 
     @cached_property
     def word_occur_counter(self) -> Counter[T]:
@@ -78,19 +220,168 @@ class CorpusSummary(Generic[T]):
             for (i1, i2) in product(range(self.word_cooccur.shape[0]), repeat=2)
         ))
 
-    def save(self, path: PathLike):
-        np.savez_compressed(
-            path,
+    @property
+    def meta(self) -> Dict[str, Any]:
+        return dict(
             corpus_id=self.corpus_id,
             num_docs=self.num_docs,
             num_tokens=self.num_tokens,
-            vocab=self.vocab,
-            word_occur=self.word_occur,
-            word_cooccur=self.word_cooccur,
+            num_word_types=len(self.vocab),
         )
 
+    def save(self, path: PathLike):
+        # Paths ending in .npz get a compressed archive; anything else becomes a
+        # directory of uncompressed arrays that can be memory-mapped
+        if PurePath(path).suffix == '.npz':
+            np.savez_compressed(
+                path,
+                corpus_id=self.corpus_id,
+                num_docs=self.num_docs,
+                num_tokens=self.num_tokens,
+                vocab=np.array(self.vocab),
+                word_occur=self.word_occur,
+                word_cooccur=self.word_cooccur,
+            )
+        else:
+            os.makedirs(path, exist_ok=True)
+            self.vocabulary.save(Path(path, CORPUS_SUMMARY_VOCAB_FILENAME))
+            np.save(Path(path, CORPUS_SUMMARY_WORD_OCCUR_FILENAME), self.word_occur)
+            np.save(Path(path, CORPUS_SUMMARY_WORD_COOCCUR_FILENAME), self.word_cooccur)
+            # meta is written last so that its presence marks a complete summary
+            with open(Path(path, CORPUS_SUMMARY_META_FILENAME), mode='w') as f:
+                json.dump(self.meta, f)
+
+
+class CooccurrenceBatcher:
+    # Collects the distinct word ids of documents and passes the (row, col, count) triples of
+    # the word pairs that co-occur in them, with row < col, to add_pairs a batch at a time
+    num_words: int
+    max_batch_num_pairs: int
+    add_pairs: Callable[[np.ndarray, np.ndarray, np.ndarray], None]
+    _batch_word_ids: List[np.ndarray]
+    _batch_num_pairs: int
+
+    def __init__(
+            self,
+            num_words: int,
+            add_pairs: Callable[[np.ndarray, np.ndarray, np.ndarray], None],
+            max_batch_num_pairs: int = MAX_COOCCUR_BATCH_NUM_PAIRS):
+        self.num_words = num_words
+        self.max_batch_num_pairs = max_batch_num_pairs
+        self.add_pairs = add_pairs
+        self._batch_word_ids = []
+        self._batch_num_pairs = 0
+
+    def add(self, doc_word_ids: np.ndarray):
+        # Word ids must be distinct within a document; ids past num_words are ignored
+        doc_word_ids = doc_word_ids[doc_word_ids < self.num_words]
+        self._batch_word_ids.append(doc_word_ids)
+        self._batch_num_pairs += len(doc_word_ids) ** 2
+        if self._batch_num_pairs >= self.max_batch_num_pairs:
+            self.flush()
+
+    def flush(self):
+        if not self._batch_word_ids:
+            return
+
+        indptr = np.zeros(len(self._batch_word_ids) + 1, dtype=np.int64)
+        np.cumsum([len(word_ids) for word_ids in self._batch_word_ids], out=indptr[1:])
+        indices = np.concatenate(self._batch_word_ids)
+        incidence = scipy.sparse.csr_matrix(
+            (np.ones(len(indices), dtype=np.int32), indices, indptr),
+            shape=(len(self._batch_word_ids), self.num_words))
+        batch_cooccur = scipy.sparse.triu(incidence.transpose() @ incidence, k=1, format='coo')
+        # Entries of a sparse product are unique
+        self.add_pairs(batch_cooccur.row, batch_cooccur.col, batch_cooccur.data)
+
+        self._batch_word_ids = []
+        self._batch_num_pairs = 0
+
+
+class CooccurrenceCounter:
+    # Counts co-occurring pairs in a dense array, to build the co-occurrence matrix of a summary
+    num_words: int
+    # Strict upper triangle of the co-occurrence matrix, packed row by row
+    upper: np.ndarray
+    _batcher: CooccurrenceBatcher
+
+    def __init__(
+            self,
+            num_words: int,
+            max_count: int,
+            max_batch_num_pairs: int = MAX_COOCCUR_BATCH_NUM_PAIRS):
+        self.num_words = num_words
+        self.upper = np.zeros(
+            num_words * (num_words - 1) // 2, dtype=np.min_scalar_type(max_count))
+        self._batcher = CooccurrenceBatcher(num_words, self.add_pairs, max_batch_num_pairs)
+
+    def _row_offsets(self, rows: np.ndarray) -> np.ndarray:
+        # Position of (row, row + 1) in the packed upper triangle
+        return rows * (2 * self.num_words - rows - 1) // 2
+
+    def add(self, doc_word_ids: np.ndarray):
+        self._batcher.add(doc_word_ids)
+
+    def add_pairs(self, rows: np.ndarray, cols: np.ndarray, counts: np.ndarray):
+        # Pairs must be distinct (so that fancy-indexed += does not drop updates) with row < col
+        rows = rows.astype(np.int64)
+        cols = cols.astype(np.int64)
+        self.upper[self._row_offsets(rows) + cols - rows - 1] += counts.astype(self.upper.dtype)
+
+    def to_array(self, word_occur: np.ndarray) -> np.ndarray:
+        self._batcher.flush()
+        word_cooccur = np.zeros((self.num_words, self.num_words), dtype=np.uint)
+        for (i, offset) in enumerate(self._row_offsets(np.arange(self.num_words))):
+            row = self.upper[offset:offset + self.num_words - i - 1]
+            word_cooccur[i, i + 1:] = row
+            word_cooccur[i + 1:, i] = row
+        word_cooccur[np.diag_indices(self.num_words)] = word_occur[:self.num_words]
+        return word_cooccur
+
+
+class SparseCooccurrenceCounter:
+    # Counts co-occurring pairs in a sparse matrix, whose size does not depend on the number of
+    # words but on the pairs seen (such as those of one spill in a worker)
+    num_words: int
+    _cooccur: scipy.sparse.csr_matrix
+    _batcher: CooccurrenceBatcher
+
+    def __init__(self, num_words: int, max_batch_num_pairs: int = MAX_COOCCUR_BATCH_NUM_PAIRS):
+        self.num_words = num_words
+        self._cooccur = scipy.sparse.csr_matrix((num_words, num_words), dtype=np.int64)
+        self._batcher = CooccurrenceBatcher(num_words, self.add_pairs, max_batch_num_pairs)
+
+    def add(self, doc_word_ids: np.ndarray):
+        self._batcher.add(doc_word_ids)
+
+    def add_pairs(self, rows: np.ndarray, cols: np.ndarray, counts: np.ndarray):
+        # Pairs must have row < col; repeated pairs are summed
+        self._cooccur = self._cooccur + scipy.sparse.csr_matrix(
+            (counts.astype(np.int64), (rows, cols)), shape=self._cooccur.shape)
+
+    def to_pairs(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # Distinct (row, col) pairs with row < col and their counts
+        self._batcher.flush()
+        cooccur = self._cooccur.tocoo()
+        return (cooccur.row, cooccur.col, cooccur.data)
+
+
+def load_corpus_summary(
+        path: PathLike,
+        mmap_mode: Optional[Literal['r', 'r+', 'c']] = 'r') -> CorpusSummary:
+    if os.path.isdir(path):
+        meta = load_corpus_summary_meta(path)
+        return CorpusSummary(
+            corpus_id=meta['corpus_id'],
+            num_docs=meta['num_docs'],
+            num_tokens=meta['num_tokens'],
+            vocab=load_word_list(Path(path, CORPUS_SUMMARY_VOCAB_FILENAME)),
+            word_occur=np.load(
+                Path(path, CORPUS_SUMMARY_WORD_OCCUR_FILENAME), mmap_mode=mmap_mode),
+            word_cooccur=np.load(
+                Path(path, CORPUS_SUMMARY_WORD_COOCCUR_FILENAME), mmap_mode=mmap_mode),
+        )
 
-def load_corpus_summary(path: PathLike) -> CorpusSummary:
     archive = np.load(path)
     return CorpusSummary(
         corpus_id=archive['corpus_id'].item(),
@@ -102,53 +393,242 @@ def load_corpus_summary(path: PathLike) -> CorpusSummary:
     )
 
 
-@dataclass(frozen=True)
-class Corpus(Generic[T]):
-    corpus_id: str
-    docs: Iterable[Doc[T]]
+def load_vocabulary(path: PathLike) -> Vocabulary[str]:
+    # Load the vocabulary of a corpus summary without its counts, or a word list file
+    if os.path.isdir(path):
+        return Vocabulary(load_word_list(Path(path, CORPUS_SUMMARY_VOCAB_FILENAME)))
+    elif PurePath(path).suffix == '.npz':
+        with np.load(path) as archive:
+            return Vocabulary(archive['vocab'].tolist())
+    else:
+        return Vocabulary(load_word_list(path))
 
-    @cached_property
-    def summary(self) -> CorpusSummary[T]:
-        num_docs: int = 0
-        num_tokens: int = 0
-        word_occur_counter: Counter[T] = collections.Counter()
-        for doc in self.docs:
-            num_docs += 1
-            num_tokens += doc.num_tokens
-            for word in set(doc.tokens):
-                word_occur_counter[word] += 1
 
-        # vocab contains words in order of document frequency (decreasing)
-        vocab = [word for (word, c) in word_occur_counter.most_common()]
-        word_index = dict((word, i) for (i, word) in enumerate(vocab))
-        assert len(word_index) == len(vocab)
-        assert len(word_occur_counter) == len(vocab)
-
-        word_occur = np.array([word_occur_counter[word] for word in vocab], dtype=np.uint)
-        cooccur_num_words = min(len(vocab), MAX_COOCCUR_NUM_WORDS)
-        word_cooccur = np.zeros((cooccur_num_words, cooccur_num_words), dtype=np.uint)
-        for doc in self.docs:
-            doc_word_ids = [
-                i
-                for i in sorted(word_index[word] for word in set(doc.tokens))
-                if i < cooccur_num_words
-            ]
-            for i in doc_word_ids:
-                word_cooccur[i, doc_word_ids[i + 1:]] += 1
-        word_cooccur = (
-            word_cooccur + word_cooccur.transpose() + np.diag(word_occur[:cooccur_num_words])
+@dataclass
+class WordIdSpill(Generic[T]):
+    # Distinct word ids of each document, stored as int32 in a file on disk;
+    # ids index into vocab, which is in order of first occurrence
+    path: str
+    vocab: List[T]
+    doc_num_words: List[int]
+
+    def add_to(
+            self,
+            cooccur_counter: Union[CooccurrenceCounter, SparseCooccurrenceCounter],
+            word_ranks: np.ndarray):
+        if sum(self.doc_num_words) > 0:
+            spilled_word_ids = np.memmap(self.path, dtype=np.int32, mode='r')
+            doc_end = 0
+            for doc_num_words in self.doc_num_words:
+                doc_start = doc_end
+                doc_end += doc_num_words
+                cooccur_counter.add(word_ranks[spilled_word_ids[doc_start:doc_end]])
+            del spilled_word_ids
+
+    def remove(self):
+        os.remove(self.path)
+
+
+def _count_spill_cooccur(
+        args: Tuple[WordIdSpill, np.ndarray, int]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Return the co-occurring pairs of a spill sparsely, so that only the pairs it contains are
+    # sent back to the parent
+    (spill, word_ranks, num_words) = args
+    cooccur_counter = SparseCooccurrenceCounter(num_words)
+    spill.add_to(cooccur_counter, word_ranks)
+    return cooccur_counter.to_pairs()
+
+
+@dataclass
+class PartialCorpusSummary(Generic[T]):
+    num_docs: int
+    num_tokens: int
+    # Keys are in order of first occurrence, so merging partial summaries in
+    # corpus order reproduces the tie-breaking of a serial summary
+    word_occur_counter: Counter[T]
+    spills: List[WordIdSpill[T]]
+
+    def __add__(self, other: 'PartialCorpusSummary[T]') -> 'PartialCorpusSummary[T]':
+        return PartialCorpusSummary(
+            num_docs=self.num_docs + other.num_docs,
+            num_tokens=self.num_tokens + other.num_tokens,
+            word_occur_counter=self.word_occur_counter + other.word_occur_counter,
+            spills=self.spills + other.spills,
         )
 
+    def build(self, corpus_id: str, pool: Optional[Pool] = None) -> CorpusSummary[T]:
+        # vocab contains words in order of document frequency (decreasing)
+        vocab = [word for (word, c) in self.word_occur_counter.most_common()]
+        vocabulary = Vocabulary(vocab)
+        word_occur = np.array([self.word_occur_counter[word] for word in vocab], dtype=np.uint)
+
+        cooccur_counter = CooccurrenceCounter(
+            min(len(vocab), MAX_COOCCUR_NUM_WORDS), max_count=self.num_docs)
+        spill_word_ranks = [vocabulary.to_ids(spill.vocab) for spill in self.spills]
+        if pool is None:
+            for (spill, word_ranks) in zip(self.spills, spill_word_ranks):
+                spill.add_to(cooccur_counter, word_ranks)
+        else:
+            for (rows, cols, counts) in pool.imap_unordered(_count_spill_cooccur, [
+                (spill, word_ranks, cooccur_counter.num_words)
+                for (spill, word_ranks) in zip(self.spills, spill_word_ranks)
+            ]):
+                cooccur_counter.add_pairs(rows, cols, counts)
+        for spill in self.spills:
+            spill.remove()
+        word_cooccur = cooccur_counter.to_array(word_occur)
+
         return CorpusSummary(
-            corpus_id=self.corpus_id,
-            num_docs=num_docs,
-            num_tokens=num_tokens,
+            corpus_id=corpus_id,
+            num_docs=self.num_docs,
+            num_tokens=self.num_tokens,
             vocab=vocab,
             word_occur=word_occur,
             word_cooccur=word_cooccur,
         )
 
 
+class CorpusSummaryCache:
+    max_bytes: int
+    _summaries: 'OrderedDict[Tuple[str, int], Tuple[CorpusSummary, int]]'
+    _num_bytes: int
+    _lock: Lock
+
+    def __init__(self, max_bytes: int = DEFAULT_CORPUS_SUMMARY_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._summaries = OrderedDict()
+        self._num_bytes = 0
+        self._lock = Lock()
+
+    @staticmethod
+    def _get_key(path: PathLike) -> Tuple[str, int]:
+        # The meta file of a summary directory is rewritten whenever the summary is saved
+        stat_path = Path(path, CORPUS_SUMMARY_META_FILENAME) if os.path.isdir(path) else path
+        return (os.path.abspath(path), os.stat(stat_path).st_mtime_ns)
+
+    @staticmethod
+    def _get_num_bytes(summary: CorpusSummary) -> int:
+        return (
+            summary.word_occur.nbytes +
+            summary.word_cooccur.nbytes +
+            sum(sys.getsizeof(word) for word in summary.vocab)
+        )
+
+    def _pop(self, key: Tuple[str, int]):
+        (_, num_bytes) = self._summaries.pop(key)
+        self._num_bytes -= num_bytes
+
+    def load(self, path: PathLike) -> CorpusSummary:
+        key = self._get_key(path)
+        with self._lock:
+            if key in self._summaries:
+                self._summaries.move_to_end(key)
+                return self._summaries[key][0]
+
+        summary = load_corpus_summary(path)
+        num_bytes = self._get_num_bytes(summary)
+        with self._lock:
+            for stale_key in [k for k in self._summaries if k[0] == key[0]]:
+                self._pop(stale_key)
+            self._summaries[key] = (summary, num_bytes)
+            self._num_bytes += num_bytes
+            while self._summaries and self._num_bytes > self.max_bytes:
+                self._pop(next(iter(self._summaries)))
+        return summary
+
+    def clear(self):
+        with self._lock:
+            self._summaries.clear()
+            self._num_bytes = 0
+
+
+# Shared by all tasks doit runs in this process
+CORPUS_SUMMARY_CACHE = CorpusSummaryCache()
+
+
+def load_corpus_summary_cached(path: PathLike) -> CorpusSummary:
+    return CORPUS_SUMMARY_CACHE.load(path)
+
+
+def load_corpus_summary_meta(path: PathLike) -> Dict[str, Any]:
+    if os.path.isdir(path):
+        with open(Path(path, CORPUS_SUMMARY_META_FILENAME)) as f:
+            return json.load(f)
+
+    # Members of an npz archive are only decompressed when accessed
+    archive = np.load(path)
+    return dict(
+        corpus_id=archive['corpus_id'].item(),
+        num_docs=archive['num_docs'].item(),
+        num_tokens=archive['num_tokens'].item(),
+        num_word_types=len(archive['vocab']),
+    )
+
+
+class CorpusSummaryBuilder(Generic[T]):
+    # Word ids are spilled to a file in spill_dir, which the caller should remove (e.g., as a
+    # TemporaryDirectory) once the summary is built or the build fails
+    corpus_id: str
+    num_docs: int
+    num_tokens: int
+    word_occur_counter: Counter[T]
+    # Words are numbered in order of first occurrence until the vocab order is known
+    _vocabulary: Vocabulary[T]
+    _doc_num_words: List[int]
+    _spill: IO[bytes]
+
+    def __init__(self, corpus_id: str, spill_dir: PathLike):
+        self.corpus_id = corpus_id
+        self.num_docs = 0
+        self.num_tokens = 0
+        self.word_occur_counter = collections.Counter()
+        self._vocabulary = Vocabulary()
+        self._doc_num_words = []
+        self._spill = NamedTemporaryFile(dir=os.fspath(spill_dir), suffix='.word-ids', delete=False)
+
+    def add(self, doc: ReadOnlyDoc[T]):
+        tokens = doc.tokens
+        self.num_docs += 1
+        self.num_tokens += len(tokens)
+        doc_word_ids = []
+        for word in set(tokens):
+            self.word_occur_counter[word] += 1
+            doc_word_ids.append(self._vocabulary.add(word))
+        self._spill.write(np.array(doc_word_ids, dtype=np.int32).tobytes())
+        self._doc_num_words.append(len(doc_word_ids))
+
+    def partial(self) -> PartialCorpusSummary[T]:
+        self._spill.close()
+        return PartialCorpusSummary(
+            num_docs=self.num_docs,
+            num_tokens=self.num_tokens,
+            word_occur_counter=self.word_occur_counter,
+            spills=[WordIdSpill(self._spill.name, self._vocabulary.words, self._doc_num_words)],
+        )
+
+    def build(self) -> CorpusSummary[T]:
+        return self.partial().build(self.corpus_id)
+
+
+@dataclass(frozen=True)
+class Corpus(Generic[T]):
+    corpus_id: str
+    docs: Iterable[ReadOnlyDoc[T]]
+
+    @cached_property
+    def summary(self) -> CorpusSummary[T]:
+        with TemporaryDirectory() as spill_dir:
+            builder: CorpusSummaryBuilder[T] = CorpusSummaryBuilder(
+                self.corpus_id, Path(spill_dir))
+            for doc in self.docs:
+                builder.add(doc)
+            return builder.build()
+
+    def iter_doc_num_tokens(self) -> Iterator[Tuple[str, int]]:
+        # Doc ids and token counts, for checks that need only those
+        return ((doc.doc_id, doc.num_tokens) for doc in self.docs)
+
+
 class PolyglotCorpus(Corpus[str], Iterable[Doc[str]]):
     corpus_path: PathLike
 
@@ -159,6 +639,66 @@ class PolyglotCorpus(Corpus[str], Iterable[Doc[str]]):
     def __iter__(self) -> Iterator[Doc[str]]:
         return iter(load_polyglot(self.corpus_path))
 
+    @cached_property
+    def index(self) -> 'PolyglotIndex':
+        # Build and save the index on first use if there is no current one (if the index cannot
+        # be saved, e.g. next to a read-only corpus, it is only kept in memory)
+        index = load_polyglot_index_if_current(self.corpus_path)
+        if index is None:
+            index = build_polyglot_index(self.corpus_path)
+            try:
+                index.save(get_polyglot_index_path(self.corpus_path))
+            except OSError:
+                pass
+        return index
+
+    @cached_property
+    def _doc_nums(self) -> Dict[str, int]:
+        doc_nums: Dict[str, int] = {}
+        for (doc_num, doc_id) in enumerate(self.index.doc_ids):
+            doc_nums.setdefault(doc_id, doc_num)
+        return doc_nums
+
+    @cached_property
+    def _buffer(self) -> mmap.mmap:
+        with open(self.corpus_path, mode='rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _get_doc(self, doc_num: int) -> Doc[str]:
+        offset = int(self.index.offsets[doc_num])
+        return _parse_polyglot_doc(
+            self.index.doc_ids[doc_num],
+            self._buffer[offset:offset + int(self.index.lengths[doc_num])])
+
+    def iter_doc_num_tokens(self) -> Iterator[Tuple[str, int]]:
+        # Read from the index, without decoding and splitting the docs, if there is a current
+        # one (but do not build it, as reading the docs once is faster)
+        index = load_polyglot_index_if_current(self.corpus_path)
+        if index is None:
+            return super().iter_doc_num_tokens()
+        return zip(index.doc_ids, index.num_tokens.tolist())
+
+    def num_docs(self) -> int:
+        # Not __len__, so that list(corpus) and the like do not build the index
+        return len(self.index.doc_ids)
+
+    def __getitem__(self, doc_id: str) -> Doc[str]:
+        return self._get_doc(self._doc_nums[doc_id])
+
+    def __contains__(self, doc_id: object) -> bool:
+        return doc_id in self._doc_nums
+
+    def get_doc_range(self, start: int, stop: Optional[int] = None) -> List[Doc[str]]:
+        # Docs by position in the corpus, as in a slice
+        return [self._get_doc(doc_num) for doc_num in range(self.num_docs())[start:stop]]
+
+    def sample(self, k: int, seed: Optional[int] = None) -> List[Doc[str]]:
+        # A uniform random sample of k docs, in corpus order
+        return [
+            self._get_doc(doc_num)
+            for doc_num in sorted(Random(seed).sample(range(self.num_docs()), k=k))
+        ]
+
 
 def get_doc_id(line: str) -> Optional[str]:
     match = DOC_ID_RE.fullmatch(line)
@@ -168,35 +708,437 @@ def get_doc_id(line: str) -> Optional[str]:
         return match.group('doc_id')
 
 
-def load_polyglot(input_path: PathLike) -> Iterable[Doc[str]]:
-    with open(input_path, encoding='utf-8') as f:
-        prev_line = None
-        doc: Optional[Doc[str]] = None
-        for line in f:
-            line = line.strip()
-            doc_id = get_doc_id(line)
-            if not prev_line and doc_id is not None:
-                if doc is not None and doc.tokens:
-                    yield doc
-                doc = Doc(doc_id, [])
-            elif doc is not None and line:
-                doc.sections.append(line.split())
+def _find_line_start(buffer: mmap.mmap, pos: int) -> int:
+    # Lines end with \n, \r\n or \r, as in a universal newlines read
+    line_start = buffer.rfind(b'\n', 0, pos) + 1
+    return buffer.rfind(b'\r', line_start, pos) + 1 or line_start
+
+
+def _find_line_end(buffer: mmap.mmap, pos: int) -> int:
+    # Offset of the line break ending the line containing pos (or of the end of the buffer)
+    line_end = buffer.find(b'\n', pos)
+    if line_end < 0:
+        line_end = len(buffer)
+    carriage_return = buffer.find(b'\r', pos, line_end)
+    return line_end if carriage_return < 0 else carriage_return
+
 
-            prev_line = line
+def _iter_polyglot_doc_headers(
+        buffer: mmap.mmap,
+        start: int = 0,
+        end: Optional[int] = None) -> Iterator[Tuple[str, int]]:
+    # Yield the doc id and offset of each doc id line starting in [start, end).
+    # As in a line-by-line read, a doc id line must follow a blank line (or start the file);
+    # only lines containing a [[ marker are decoded.  As in a universal newlines read, lines
+    # may end with \n, \r\n or \r.
+    if end is None:
+        end = len(buffer)
+    pos = start
+    while True:
+        marker = buffer.find(b'[[', pos, end)
+        if marker < 0:
+            break
+        line_start = _find_line_start(buffer, marker)
+        line_end = _find_line_end(buffer, marker)
+        pos = line_end + 1
+        if line_start < start:
+            continue
+        doc_id = get_doc_id(buffer[line_start:line_end].decode('utf-8').strip())
+        if doc_id is None:
+            continue
+        if line_start > 0:
+            prev_line_end = line_start - 1
+            if buffer[prev_line_end - 1:line_start] == b'\r\n':
+                prev_line_end -= 1
+            prev_line_start = _find_line_start(buffer, prev_line_end)
+            if buffer[prev_line_start:prev_line_end].decode('utf-8').strip():
+                continue
+        yield (doc_id, line_start)
 
-        if doc is not None and doc.tokens:
+
+def _iter_polyglot_doc_spans(
+        buffer: mmap.mmap,
+        start: int = 0,
+        end: Optional[int] = None) -> Iterator[Tuple[str, int, int]]:
+    # Yield the doc id, offset and length of each doc whose doc id line starts in [start, end);
+    # the last doc extends to the end of the line containing end
+    if end is None or end >= len(buffer):
+        end = len(buffer)
+        last_doc_end = end
+    else:
+        last_doc_end = _find_line_end(buffer, max(end - 1, 0))
+        last_doc_end += 2 if buffer[last_doc_end:last_doc_end + 2] == b'\r\n' else 1
+        last_doc_end = min(last_doc_end, len(buffer))
+    prev_doc_id: Optional[str] = None
+    prev_doc_start = 0
+    for (doc_id, doc_start) in _iter_polyglot_doc_headers(buffer, start, end):
+        if prev_doc_id is not None:
+            yield (prev_doc_id, prev_doc_start, doc_start - prev_doc_start)
+        (prev_doc_id, prev_doc_start) = (doc_id, doc_start)
+    if prev_doc_id is not None:
+        yield (prev_doc_id, prev_doc_start, last_doc_end - prev_doc_start)
+
+
+def _parse_polyglot_doc(doc_id: str, doc_bytes: bytes) -> Doc[str]:
+    # The first line is the doc id line; each remaining non-blank line is a section
+    tokens: List[str] = []
+    section_offsets = [0]
+    text = doc_bytes.decode('utf-8')
+    # Lines end with \n, \r\n or \r, as in a universal newlines read
+    lines = text.split('\n') if '\r' not in text else LINE_BREAK_RE.split(text)
+    for line in lines[1:]:
+        section = line.split()
+        if section:
+            tokens.extend(section)
+            section_offsets.append(len(tokens))
+    return Doc.from_tokens(doc_id, tokens, section_offsets)
+
+
+@contextmanager
+def _open_mmap(input_path: PathLike) -> Iterator[Optional[mmap.mmap]]:
+    with open(input_path, mode='rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            # empty files cannot be memory-mapped
+            yield None
+        else:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                yield buffer
+
+
+class BackgroundReader(io.RawIOBase):
+    # Read a binary stream in a background thread, handing chunks over through a bounded queue
+    # so that reading (e.g., decompression, which releases the GIL) overlaps with consumption
+
+    def __init__(
+            self,
+            open_stream: Callable[[], ContextManager[IO[bytes]]],
+            chunk_size: int = ARCHIVE_READ_CHUNK_SIZE,
+            max_num_chunks: int = ARCHIVE_READ_MAX_NUM_CHUNKS):
+        super().__init__()
+        self._open_stream = open_stream
+        self._chunk_size = chunk_size
+        self._chunks: queue.Queue[Union[bytes, BaseException]] = queue.Queue(max_num_chunks)
+        self._stopped = Event()
+        self._chunk = memoryview(b'')
+        self._eof = False
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            with self._open_stream() as f:
+                while not self._stopped.is_set():
+                    chunk = f.read(self._chunk_size)
+                    self._put(chunk)
+                    if not chunk:
+                        break
+        except BaseException as ex:
+            self._put(ex)
+
+    def _put(self, item: Union[bytes, BaseException]):
+        # Give up if the reader is closed while the queue is full
+        while not self._stopped.is_set():
+            try:
+                self._chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        if not self._chunk:
+            if self._eof:
+                return 0
+            item = self._chunks.get()
+            if isinstance(item, BaseException):
+                raise item
+            if not item:
+                self._eof = True
+                return 0
+            self._chunk = memoryview(item)
+        n = min(len(b), len(self._chunk))
+        b[:n] = self._chunk[:n]
+        self._chunk = self._chunk[n:]
+        return n
+
+    def close(self):
+        self._stopped.set()
+        super().close()
+
+
+def is_polyglot_archive(input_path: PathLike) -> bool:
+    return str(input_path).endswith(POLYGLOT_ARCHIVE_SUFFIXES)
+
+
+@contextmanager
+def _open_tar_member(archive_path: PathLike) -> Iterator[IO[bytes]]:
+    # Open the first regular file in an xz or legacy lzma compressed tar archive as a stream
+    # (tarfile's own detection only recognizes lzma streams with some dictionary sizes)
+    with lzma.open(archive_path) as compressed_f, \
+            tarfile.open(fileobj=compressed_f, mode='r|') as tar:
+        for member in tar:
+            if member.isfile():
+                f = tar.extractfile(member)
+                if f is not None:
+                    yield f
+                    return
+        raise ValueError(f'No regular file found in archive {archive_path}')
+
+
+@contextmanager
+def open_polyglot_archive(archive_path: PathLike) -> Iterator[IO[str]]:
+    # Stream the text of the polyglot corpus in archive_path (such as en_wiki_text.tar.lzma),
+    # decompressing it in a background thread
+    reader = BackgroundReader(lambda: _open_tar_member(archive_path))
+    with io.TextIOWrapper(
+            io.BufferedReader(reader, buffer_size=ARCHIVE_READ_CHUNK_SIZE),
+            encoding='utf-8') as f:
+        yield f
+
+
+def _parse_polyglot_lines(lines: Iterable[str]) -> Iterator[Doc[str]]:
+    prev_line = None
+    doc: Optional[Doc[str]] = None
+    for line in lines:
+        line = line.strip()
+        doc_id = get_doc_id(line)
+        if not prev_line and doc_id is not None:
+            if doc is not None and doc.tokens:
+                yield doc
+            doc = Doc(doc_id)
+        elif doc is not None and line:
+            doc.add_section(line.split())
+
+        prev_line = line
+
+    if doc is not None and doc.tokens:
+        yield doc
+
+
+def load_polyglot(
+        input_path: PathLike,
+        start: int = 0,
+        end: Optional[int] = None) -> Iterable[Doc[str]]:
+    # start and end, if given, should be doc boundaries such as those from
+    # find_polyglot_shard_offsets; archives can only be streamed from the start
+    if is_polyglot_archive(input_path):
+        if start != 0 or end is not None:
+            raise ValueError('Polyglot archives can only be read in full')
+        with open_polyglot_archive(input_path) as f:
+            yield from _parse_polyglot_lines(f)
+        return
+
+    with _open_mmap(input_path) as buffer:
+        if buffer is None:
+            return
+        for (doc, _, _) in _iter_polyglot_docs(input_path, buffer, start, end):
             yield doc
 
 
+def _iter_polyglot_docs(
+        input_path: PathLike,
+        buffer: mmap.mmap,
+        start: int = 0,
+        end: Optional[int] = None) -> Iterator[Tuple[Doc[str], int, int]]:
+    # Yield each doc with at least one token along with its offset and length in buffer
+    index = load_polyglot_index_if_current(input_path)
+    if index is not None:
+        doc_spans: Iterable[Tuple[str, int, int]] = index.iter_doc_spans(start, end)
+    else:
+        doc_spans = _iter_polyglot_doc_spans(buffer, start, end)
+    for (doc_id, offset, length) in doc_spans:
+        doc = _parse_polyglot_doc(doc_id, buffer[offset:offset + length])
+        if doc.tokens:
+            yield (doc, offset, length)
+
+
+@dataclass(frozen=True)
+class PolyglotIndex:
+    # Doc ids, byte offsets, byte lengths and token counts of the docs
+    # (with at least one token) of a polyglot corpus file, and the size of the file
+    # (None for indexes saved before it was recorded)
+    doc_ids: List[str]
+    offsets: np.ndarray
+    lengths: np.ndarray
+    num_tokens: np.ndarray
+    corpus_size: Optional[int] = None
+
+    def iter_doc_spans(
+            self,
+            start: int = 0,
+            end: Optional[int] = None) -> Iterator[Tuple[str, int, int]]:
+        first = int(np.searchsorted(self.offsets, start))
+        last = len(self.offsets) if end is None else int(np.searchsorted(self.offsets, end))
+        return zip(
+            self.doc_ids[first:last],
+            self.offsets[first:last].tolist(),
+            self.lengths[first:last].tolist(),
+        )
+
+    def save(self, path: PathLike):
+        # np.savez would append .npz to the path, so write through a file object
+        with open(path, mode='wb') as f:
+            np.savez(
+                f,
+                doc_ids=encode_word_list(self.doc_ids),
+                offsets=self.offsets,
+                lengths=self.lengths,
+                num_tokens=self.num_tokens,
+                corpus_size=np.int64(-1 if self.corpus_size is None else self.corpus_size),
+            )
+
+
+def get_polyglot_index_path(corpus_path: PathLike) -> Path:
+    # foo.txt -> foo.txt.idx
+    path = Path(corpus_path)
+    return path.with_name(path.name + '.idx')
+
+
+def load_polyglot_index(path: PathLike) -> PolyglotIndex:
+    with np.load(path) as archive:
+        return PolyglotIndex(
+            doc_ids=decode_word_list(archive['doc_ids']),
+            offsets=archive['offsets'],
+            lengths=archive['lengths'],
+            num_tokens=archive['num_tokens'],
+            corpus_size=(
+                int(archive['corpus_size'])
+                if 'corpus_size' in archive.files and int(archive['corpus_size']) >= 0
+                else None
+            ),
+        )
+
+
+def load_polyglot_index_if_current(corpus_path: PathLike) -> Optional[PolyglotIndex]:
+    # The index must be newer than the corpus and record its size, which catches rewrites
+    # within the mtime resolution and copies that preserve the corpus mtime
+    index_path = get_polyglot_index_path(corpus_path)
+    if (os.path.exists(index_path) and
+            os.path.getmtime(index_path) >= os.path.getmtime(corpus_path)):
+        index = load_polyglot_index(index_path)
+        if index.corpus_size == os.path.getsize(corpus_path):
+            return index
+    return None
+
+
+def build_polyglot_index(input_path: PathLike) -> PolyglotIndex:
+    doc_ids: List[str] = []
+    offsets = array('q')
+    lengths = array('q')
+    num_tokens = array('q')
+    with _open_mmap(input_path) as buffer:
+        corpus_size = 0 if buffer is None else len(buffer)
+        if buffer is not None:
+            for (doc_id, offset, length) in _iter_polyglot_doc_spans(buffer):
+                doc = _parse_polyglot_doc(doc_id, buffer[offset:offset + length])
+                if doc.tokens:
+                    doc_ids.append(doc_id)
+                    offsets.append(offset)
+                    lengths.append(length)
+                    num_tokens.append(doc.num_tokens)
+    return PolyglotIndex(
+        doc_ids=doc_ids,
+        offsets=np.array(offsets, dtype=np.int64),
+        lengths=np.array(lengths, dtype=np.int64),
+        num_tokens=np.array(num_tokens, dtype=np.int64),
+        corpus_size=corpus_size,
+    )
+
+
+def index_polyglot(input_path: PathLike, index_path: Optional[PathLike] = None):
+    build_polyglot_index(input_path).save(
+        index_path if index_path is not None else get_polyglot_index_path(input_path))
+
+
+def find_polyglot_shard_offsets(input_path: PathLike, num_shards: int) -> List[int]:
+    # Return byte offsets of doc id lines splitting the corpus into at most num_shards
+    # pieces of about equal size, preceded by 0 and followed by the file size
+    size = os.path.getsize(input_path)
+    offsets = [0]
+    with _open_mmap(input_path) as buffer:
+        if buffer is not None:
+            for shard_num in range(1, num_shards):
+                header = next(_iter_polyglot_doc_headers(
+                    buffer, max(size * shard_num // num_shards, offsets[-1] + 1)), None)
+                if header is None:
+                    break
+                offsets.append(header[1])
+    offsets.append(size)
+    return offsets
+
+
 def save_polyglot(output_path: PathLike, docs: Iterable[Doc[str]]):
     with open(output_path, encoding='utf-8', mode='w') as f:
         for doc in docs:
             f.write(doc.to_polyglot() + '\n')
 
 
-def subsample(input_path: PathLike, output_path: PathLike, max_num_docs: int):
-    doc_ids = set(sample([doc.doc_id for doc in load_polyglot(input_path)], k=max_num_docs))
-    save_polyglot(output_path, (doc for doc in load_polyglot(input_path) if doc.doc_id in doc_ids))
+class _Reservoir(Generic[T]):
+    # Uniform sample of up to k offered items (Algorithm R); each item is only made if it
+    # enters the reservoir
+
+    def __init__(self, k: int, seed: Optional[int] = None):
+        self.k = k
+        self.num_offered = 0
+        self._items: List[Tuple[int, T]] = []
+        self._rng = Random(seed)
+
+    def offer(self, make_item: Callable[[], T]):
+        if self.num_offered < self.k:
+            self._items.append((self.num_offered, make_item()))
+        else:
+            i = self._rng.randrange(self.num_offered + 1)
+            if i < self.k:
+                self._items[i] = (self.num_offered, make_item())
+        self.num_offered += 1
+
+    def items(self) -> List[T]:
+        # The sampled items in the order they were offered
+        return [item for (_, item) in sorted(self._items, key=lambda p: p[0])]
+
+
+def _write_spilled_doc(f: IO[bytes], doc: Doc[str]) -> Tuple[str, int, int]:
+    offset = f.tell()
+    f.write((doc.to_polyglot() + '\n').encode('utf-8'))
+    return (doc.doc_id, offset, f.tell() - offset)
+
+
+def subsample(
+        input_path: PathLike,
+        output_path: PathLike,
+        max_num_docs: int,
+        seed: Optional[int] = None):
+    # Reservoir-sample max_num_docs docs in one pass over the input, keeping only their byte
+    # spans, then write them in their original order.  Docs streamed from an archive are
+    # spilled to a temporary file next to the output as they enter the reservoir.
+    if max_num_docs < 0:
+        raise ValueError('Sample larger than population or is negative')
+    reservoir: _Reservoir[Tuple[str, int, int]] = _Reservoir(max_num_docs, seed)
+
+    def save_sample(buffer: Optional[mmap.mmap]):
+        if reservoir.num_offered < max_num_docs:
+            raise ValueError('Sample larger than population or is negative')
+        save_polyglot(output_path, (
+            _parse_polyglot_doc(doc_id, (buffer or b'')[offset:offset + length])
+            for (doc_id, offset, length) in reservoir.items()
+        ))
+
+    if is_polyglot_archive(input_path):
+        with NamedTemporaryFile(
+                dir=PurePath(output_path).parent, suffix='.spill.txt') as spill_file:
+            for doc in load_polyglot(input_path):
+                reservoir.offer(lambda: _write_spilled_doc(spill_file, doc))
+            spill_file.flush()
+            with _open_mmap(Path(spill_file.name)) as buffer:
+                save_sample(buffer)
+    else:
+        with _open_mmap(input_path) as buffer:
+            if buffer is not None:
+                for (doc, offset, length) in _iter_polyglot_docs(input_path, buffer):
+                    reservoir.offer(lambda: (doc.doc_id, offset, length))
+            save_sample(buffer)
 
 
 def convert_polyglot_to_mallet(lang: str, input_path: PathLike, output_path: PathLike):
@@ -205,21 +1147,150 @@ def convert_polyglot_to_mallet(lang: str, input_path: PathLike, output_path: Pat
             f.write(doc.to_mallet(lang) + '\n')
 
 
+def lowercase_doc(doc: Doc[str]) -> Doc[str]:
+    return Doc.from_tokens(
+        doc.doc_id, [token.lower() for token in doc.tokens], list(doc.section_offsets))
+
+
 def lowercase_polyglot(input_path: PathLike, output_path: PathLike):
-    save_polyglot(output_path, (
-        Doc(doc.doc_id, [[token.lower() for token in section] for section in doc.sections])
-        for doc in load_polyglot(input_path)
-    ))
+    save_polyglot(output_path, (lowercase_doc(doc) for doc in load_polyglot(input_path)))
+
+
+class CorpusFingerprint:
+    # Rolling digests of a corpus's doc ids and token counts, which is what corpus alignment
+    # checks.  num_tokens_digest covers only the token counts so corpora can be compared to
+    # topic states, whose doc ids are doc numbers.
+    num_docs: int
+    num_tokens: int
+
+    def __init__(self):
+        self.num_docs = 0
+        self.num_tokens = 0
+        self._hash = hashlib.blake2b(digest_size=16)
+        self._num_tokens_hash = hashlib.blake2b(digest_size=16)
+
+    def add(self, doc_id: str, num_tokens: int):
+        self.num_docs += 1
+        self.num_tokens += num_tokens
+        self._hash.update(f'{doc_id} {num_tokens}\n'.encode('utf-8'))
+        self._num_tokens_hash.update(num_tokens.to_bytes(8, 'little'))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(num_docs=self.num_docs, num_tokens=self.num_tokens,
+                    digest=self._hash.hexdigest(),
+                    num_tokens_digest=self._num_tokens_hash.hexdigest())
+
+    def save(self, path: PathLike, corpus_size: int):
+        # corpus_size is the size of the corpus file fingerprinted, which
+        # load_corpus_fingerprint_if_current checks
+        with open(path, encoding='utf-8', mode='w') as f:
+            json.dump(dict(self.to_dict(), corpus_size=corpus_size), f)
+
+
+def compute_num_tokens_digest(doc_num_tokens: np.ndarray) -> str:
+    # The num_tokens_digest of a CorpusFingerprint of docs with the given token counts
+    return hashlib.blake2b(
+        doc_num_tokens.astype('<u8').tobytes(), digest_size=16).hexdigest()
+
+
+def get_corpus_fingerprint_path(corpus_path: PathLike) -> Path:
+    return Path(corpus_path).with_suffix('.fingerprint.json')
+
+
+def load_corpus_fingerprint_if_current(corpus_path: PathLike) -> Optional[Dict[str, Any]]:
+    # As for the polyglot index, the fingerprint must be newer than the corpus and record its
+    # size.  The recorded size is dropped from the result, which is compared across corpora.
+    fingerprint_path = get_corpus_fingerprint_path(corpus_path)
+    if (os.path.exists(fingerprint_path) and
+            os.path.getmtime(fingerprint_path) >= os.path.getmtime(corpus_path)):
+        with open(fingerprint_path, encoding='utf-8') as f:
+            fingerprint = json.load(f)
+        if fingerprint.pop('corpus_size', None) == os.path.getsize(corpus_path):
+            return fingerprint
+    return None
 
 
-def summarize_corpus(input_path: PathLike, output_path: PathLike):
-    PolyglotCorpus(input_path).summary.save(output_path)
+def preprocess_polyglot(
+        lang: str,
+        input_path: PathLike,
+        lowercase_path: PathLike,
+        mallet_path: PathLike,
+        summary_path: PathLike,
+        num_processes: int = 1):
+    # Lowercase a polyglot corpus, writing the lowercased corpus, its MALLET conversion, its
+    # summary and its fingerprint from a single pass over the input.  Outputs are the same as
+    # those of lowercase_polyglot, convert_polyglot_to_mallet and summarize_corpus.
+    corpus_id = PurePath(lowercase_path).name
+    fingerprint = CorpusFingerprint()
+    # Word id spills go next to the summary and are removed even if preprocessing fails
+    with TemporaryDirectory(dir=PurePath(summary_path).parent) as temp_dir:
+        spill_dir = Path(temp_dir)
+        partials: List[PartialCorpusSummary[str]] = []
+        summary_builder: CorpusSummaryBuilder[str] = CorpusSummaryBuilder(corpus_id, spill_dir)
+        with open(lowercase_path, encoding='utf-8', mode='w') as lowercase_f, \
+                open(mallet_path, encoding='utf-8', mode='w') as mallet_f:
+            for doc in load_polyglot(input_path):
+                doc = lowercase_doc(doc)
+                lowercase_f.write(doc.to_polyglot() + '\n')
+                mallet_f.write(doc.to_mallet(lang) + '\n')
+                summary_builder.add(doc)
+                fingerprint.add(doc.doc_id, doc.num_tokens)
+                if summary_builder.num_docs == PREPROCESS_SPILL_NUM_DOCS:
+                    partials.append(summary_builder.partial())
+                    summary_builder = CorpusSummaryBuilder(corpus_id, spill_dir)
+        partials.append(summary_builder.partial())
+
+        partial = reduce(add, partials)
+        if num_processes <= 1:
+            summary = partial.build(corpus_id)
+        else:
+            with Pool(num_processes) as pool:
+                summary = partial.build(corpus_id, pool=pool)
+    summary.save(summary_path)
+    # Written last, so that it is newer than the lowercased corpus
+    fingerprint.save(get_corpus_fingerprint_path(lowercase_path), os.path.getsize(lowercase_path))
+
+
+def _summarize_polyglot_shard(
+        shard: Tuple[PathLike, int, int, PathLike]) -> PartialCorpusSummary[str]:
+    (input_path, start, end, spill_dir) = shard
+    builder: CorpusSummaryBuilder[str] = CorpusSummaryBuilder(
+        PurePath(input_path).name, spill_dir)
+    for doc in load_polyglot(input_path, start=start, end=end):
+        builder.add(doc)
+    return builder.partial()
+
+
+def summarize_polyglot(input_path: PathLike, num_processes: int = 1) -> CorpusSummary[str]:
+    if num_processes <= 1:
+        return PolyglotCorpus(input_path).summary
+
+    offsets = find_polyglot_shard_offsets(input_path, num_processes)
+    with TemporaryDirectory() as spill_dir, Pool(num_processes) as pool:
+        partials = pool.map(_summarize_polyglot_shard, [
+            (input_path, start, end, Path(spill_dir))
+            for (start, end) in zip(offsets, offsets[1:])
+        ])
+        return reduce(add, partials).build(PurePath(input_path).name, pool=pool)
+
+
+def summarize_corpus(input_path: PathLike, output_path: PathLike, num_processes: int = 1):
+    summarize_polyglot(input_path, num_processes=num_processes).save(output_path)
 
 
 def compute_common_words(input_path: PathLike, output_path: PathLike, num_words: int):
-    with open(output_path, encoding='utf-8', mode='w') as f:
-        for (word, _) in load_corpus_summary(input_path).word_occur_counter.most_common(num_words):
-            f.write(word + '\n')
+    # vocab is already in order of document frequency (decreasing)
+    save_word_list(output_path, load_corpus_summary(input_path).vocab[:num_words])
+
+
+def encode_word_list(words: List[str]) -> np.ndarray:
+    # Store words compactly as newline-separated UTF-8 bytes (rather than a fixed-width array)
+    return np.frombuffer('\n'.join(words).encode('utf-8'), dtype=np.uint8)
+
+
+def decode_word_list(encoded_words: np.ndarray) -> List[str]:
+    words_bytes = encoded_words.tobytes()
+    return words_bytes.decode('utf-8').split('\n') if words_bytes else []
 
 
 def load_word_list(path: PathLike) -> List[str]:
@@ -227,12 +1298,18 @@ def load_word_list(path: PathLike) -> List[str]:
         return [line.strip() for line in f]
 
 
+def save_word_list(path: PathLike, words: Iterable):
+    with open(path, encoding='utf-8', mode='w') as f:
+        for word in words:
+            f.write(f'{word}\n')
+
+
 def extract_corpus_stats(corpus_summary_path: PathLike) -> Dict[str, int]:
-    summary = load_corpus_summary(corpus_summary_path)
+    meta = load_corpus_summary_meta(corpus_summary_path)
     return dict(
-        num_docs=summary.num_docs,
-        num_word_types=len(summary.vocab),
-        num_word_tokens=summary.num_tokens,
+        num_docs=meta['num_docs'],
+        num_word_types=meta['num_word_types'],
+        num_word_tokens=meta['num_tokens'],
     )
 
 
@@ -1,17 +1,131 @@
+import collections
+import fnmatch
+import gzip
+import io
+import json
+import lzma
+import os
+import subprocess
+import sys
+import tarfile
+import time
 from math import log
+from random import Random
 
+import conllu
 import numpy as np
-from numpy.testing import assert_allclose
+import pytest
+from numpy.testing import assert_allclose, assert_array_equal
 
+from follow_up import evaluation, util
+from follow_up.lemmatization import (
+    LemmaData, iter_udpipe_output, lemmatize_parse_treetagger, lemmatize_parse_udpipe,
+    lemmatize_treetagger, lemmatize_udpipe, parse_conllu_to_tokens, parse_polyglot_lemmas,
+    parse_treetagger, parse_udpipe
+)
 from follow_up.evaluation import (
+    TopicKeyInference,
+    TopicState,
+    _compute_coherence,
+    collect_topic_assignment_voi,
+    compute_coherence_batch,
     compute_entropy,
     compute_pmf,
     compute_mi,
     compute_voi,
     compute_joint_topic_assignment_counts,
+    compute_topic_assignment_voi,
+    compute_topic_assignment_voi_matrix,
+    collect_subtask_scores,
+    compute_coherence_treated,
+    compute_coherence_treated_batch,
+    compute_topic_assignments,
+    check_corpus_alignment,
+    check_token_assignment_alignment,
+    convert_topic_state,
+    get_topic_state_arrays_path,
+    infer_topic_keys,
+    load_token_assignments,
+)
+from follow_up.util import (
+    Corpus, CooccurrenceBatcher, CooccurrenceCounter, CorpusFingerprint, CorpusSummaryCache, Doc,
+    PolyglotCorpus, Vocabulary, build_polyglot_index, compute_common_words,
+    convert_polyglot_to_mallet, extract_corpus_stats, find_polyglot_shard_offsets,
+    get_corpus_fingerprint_path, get_doc_id, get_polyglot_index_path, index_polyglot,
+    load_corpus_fingerprint_if_current, load_corpus_summary, load_polyglot, load_polyglot_index,
+    load_polyglot_index_if_current, load_vocabulary, load_word_list, lowercase_polyglot,
+    preprocess_polyglot, save_polyglot, save_word_list, SparseCooccurrenceCounter, subsample,
+    summarize_corpus, summarize_polyglot,
+)
+
+
+def make_random_docs(num_docs=50, vocab_size=30, seed=0):
+    rng = Random(seed)
+    return [
+        Doc(str(doc_num), [
+            [f'w{rng.randrange(vocab_size)}' for _ in range(rng.randrange(1, 8))]
+            for _ in range(rng.randrange(1, 4))
+        ])
+        for doc_num in range(num_docs)
+    ]
+
+
+def write_random_polyglot(path, num_docs=50, seed=0):
+    docs = make_random_docs(num_docs=num_docs, seed=seed)
+    # a doc id line not preceded by a blank line is text, not a doc boundary
+    docs[3].add_section(['[[1234]]'])
+    save_polyglot(path, docs)
+    return docs
+
+
+def write_random_topic_state(path, docs, num_topics=7, seed=0):
+    rng = Random(seed)
+    with gzip.open(path, mode='wt', encoding='utf-8') as f:
+        f.write('#doc source pos typeindex type topic\n')
+        f.write('#alpha : ' + ' '.join(str(0.1 * (t + 1)) for t in range(num_topics)) + '\n')
+        f.write('#beta : 0.01\n')
+        for (doc_num, doc) in enumerate(docs):
+            for (pos, word) in enumerate(doc.tokens):
+                f.write(f'{doc_num} NA {pos} 0 {word} {rng.randrange(num_topics)}\n')
+
+
+def load_polyglot_line_by_line(input_path):
+    # Reference implementation of load_polyglot
+    with open(input_path, encoding='utf-8') as f:
+        prev_line = None
+        doc = None
+        for line in f:
+            line = line.strip()
+            doc_id = get_doc_id(line)
+            if not prev_line and doc_id is not None:
+                if doc is not None and doc.tokens:
+                    yield doc
+                doc = Doc(doc_id)
+            elif doc is not None and line:
+                doc.add_section(line.split())
+
+            prev_line = line
+
+        if doc is not None and doc.tokens:
+            yield doc
+
+
+POLYGLOT_EDGE_CASES = (
+    'preamble [[1]]\n\n[[2]]\nfirst doc\n  \n [[3]] \nsecond doc\n'
+    '\u3000\n[[4]]\r\nsecond\u00a0doc [[ x ]]\r\n\r\n[[5]]\n\n[[6]]\n'
+    'non-empty doc after empty doc\n\n[[\u06f1\u06f2]]\nlast doc without newline'
 )
 
 
+def brute_force_cooccur(docs, vocab, num_words):
+    word_cooccur = np.zeros((num_words, num_words), dtype=np.uint)
+    for doc in docs:
+        for (i, j) in np.ndindex(num_words, num_words):
+            if vocab[i] in doc.tokens and vocab[j] in doc.tokens:
+                word_cooccur[i, j] += 1
+    return word_cooccur
+
+
 def test_entropy():
     assert_allclose(compute_entropy(np.array([1.])), 0)
     assert_allclose(compute_entropy(np.array([1., 0.])), 0)
@@ -134,3 +248,1152 @@ def test_joint_topic_assignment_counts():
             np.array([2, 1]),
             np.array([0, 1])),
         np.array([[0, 0], [0, 1], [1, 0]]))
+
+
+def test_joint_topic_assignment_counts_chunked(monkeypatch):
+    monkeypatch.setattr(evaluation, 'JOINT_COUNT_CHUNK_SIZE', 7)
+    rng = np.random.default_rng(0)
+    topic_assignments_1 = rng.integers(5, size=100).astype(np.uint)
+    topic_assignments_2 = rng.integers(300, size=100).astype(np.uint16)
+    expected_counts = np.zeros((topic_assignments_1.max() + 1, topic_assignments_2.max() + 1))
+    for (t1, t2) in zip(topic_assignments_1, topic_assignments_2):
+        expected_counts[t1, t2] += 1
+    counts = compute_joint_topic_assignment_counts(topic_assignments_1, topic_assignments_2)
+    assert counts.dtype == np.int64
+    assert_array_equal(counts, expected_counts)
+
+
+def test_cooccurrence_counter():
+    counter = CooccurrenceCounter(4, max_count=3, max_batch_num_pairs=1)
+    counter.add(np.array([0, 2, 3]))
+    counter.add(np.array([3, 1, 5]))
+    counter.add(np.array([2, 3]))
+    assert counter.upper.dtype == np.uint8
+    assert_array_equal(
+        counter.to_array(np.array([2, 1, 2, 3, 1], dtype=np.uint)),
+        np.array([[2, 0, 1, 1], [0, 1, 0, 1], [1, 0, 2, 2], [1, 1, 2, 3]]))
+
+    sparse_counter = SparseCooccurrenceCounter(4, max_batch_num_pairs=1)
+    sparse_counter.add(np.array([0, 2, 3]))
+    sparse_counter.add(np.array([3, 1, 5]))
+    sparse_counter.add(np.array([2, 3]))
+    (rows, cols, counts) = sparse_counter.to_pairs()
+    assert sorted(zip(rows.tolist(), cols.tolist(), counts.tolist())) == [
+        (0, 2, 1), (0, 3, 1), (1, 3, 1), (2, 3, 2)]
+    counter = CooccurrenceCounter(4, max_count=3)
+    counter.add_pairs(rows, cols, counts)
+    assert_array_equal(
+        counter.to_array(np.array([2, 1, 2, 3, 1], dtype=np.uint)),
+        np.array([[2, 0, 1, 1], [0, 1, 0, 1], [1, 0, 2, 2], [1, 1, 2, 3]]))
+
+    batches = []
+    batcher = CooccurrenceBatcher(
+        4, lambda rows, cols, counts: batches.append(
+            sorted(zip(rows.tolist(), cols.tolist(), counts.tolist()))),
+        max_batch_num_pairs=10)
+    batcher.add(np.array([0, 2, 3]))
+    batcher.add(np.array([3, 1, 5]))
+    batcher.add(np.array([2, 3]))
+    assert batches == [[(0, 2, 1), (0, 3, 1), (1, 3, 1), (2, 3, 1)]]
+    batcher.flush()
+    batcher.flush()
+    assert batches == [[(0, 2, 1), (0, 3, 1), (1, 3, 1), (2, 3, 1)], [(2, 3, 1)]]
+
+    # pairs from several sources add up
+    counter = CooccurrenceCounter(4, max_count=3)
+    counter.add(np.array([3, 1, 5]))
+    counter.add_pairs(np.array([0, 0, 2]), np.array([2, 3, 3]), np.array([1, 1, 2]))
+    assert_array_equal(
+        counter.to_array(np.array([2, 1, 2, 3, 1], dtype=np.uint)),
+        np.array([[2, 0, 1, 1], [0, 1, 0, 1], [1, 0, 2, 2], [1, 1, 2, 3]]))
+
+
+def test_corpus_summary_cooccur(monkeypatch):
+    monkeypatch.setattr(util, 'MAX_COOCCUR_NUM_WORDS', 20)
+    docs = make_random_docs()
+    summary = Corpus('random', docs).summary
+    assert summary.num_docs == len(docs)
+    assert summary.num_tokens == sum(doc.num_tokens for doc in docs)
+    assert summary.word_cooccur.dtype == np.uint
+    assert_array_equal(
+        summary.word_cooccur,
+        brute_force_cooccur(docs, summary.vocab, 20))
+
+
+def test_corpus_summary_single_pass():
+    docs = make_random_docs()
+    word_occur_counter = collections.Counter(word for doc in docs for word in set(doc.tokens))
+    summary = Corpus('random', (doc for doc in docs)).summary
+    assert summary.num_docs == len(docs)
+    assert summary.vocab == [word for (word, _) in word_occur_counter.most_common()]
+    assert_array_equal(
+        summary.word_occur,
+        np.array([word_occur_counter[word] for word in summary.vocab], dtype=np.uint))
+    assert_array_equal(
+        summary.word_cooccur,
+        brute_force_cooccur(docs, summary.vocab, len(summary.vocab)))
+
+
+def test_load_polyglot(tmp_path):
+    path = tmp_path / 'corpus.txt'
+    docs = write_random_polyglot(path)
+    assert list(load_polyglot(path)) == docs
+    offsets = find_polyglot_shard_offsets(path, 4)
+    assert offsets[0] == 0 and offsets[-1] == path.stat().st_size
+    assert [
+        doc
+        for (start, end) in zip(offsets, offsets[1:])
+        for doc in load_polyglot(path, start=start, end=end)
+    ] == docs
+
+
+def test_summarize_polyglot_parallel(tmp_path):
+    path = tmp_path / 'corpus.txt'
+    write_random_polyglot(path, num_docs=200)
+    serial_summary = PolyglotCorpus(path).summary
+    for num_processes in (2, 3, 7):
+        summary = summarize_polyglot(path, num_processes=num_processes)
+        assert summary.corpus_id == serial_summary.corpus_id
+        assert summary.num_docs == serial_summary.num_docs
+        assert summary.num_tokens == serial_summary.num_tokens
+        assert summary.vocab == serial_summary.vocab
+        assert_array_equal(summary.word_occur, serial_summary.word_occur)
+        assert_array_equal(summary.word_cooccur, serial_summary.word_cooccur)
+
+
+def test_corpus_summary_save_load(tmp_path):
+    summary = Corpus('random', make_random_docs()).summary
+    for path in (tmp_path / 'corpus.summary.npz', tmp_path / 'corpus.summary'):
+        summary.save(path)
+        loaded_summary = load_corpus_summary(path)
+        assert loaded_summary.corpus_id == summary.corpus_id
+        assert loaded_summary.num_docs == summary.num_docs
+        assert loaded_summary.num_tokens == summary.num_tokens
+        assert loaded_summary.vocab == summary.vocab
+        assert_array_equal(loaded_summary.word_occur, summary.word_occur)
+        assert_array_equal(loaded_summary.word_cooccur, summary.word_cooccur)
+        assert extract_corpus_stats(path) == dict(
+            num_docs=summary.num_docs,
+            num_word_types=len(summary.vocab),
+            num_word_tokens=summary.num_tokens,
+        )
+        compute_common_words(path, tmp_path / 'common-words.txt', 5)
+        assert load_word_list(tmp_path / 'common-words.txt') == [
+            word for (word, _) in summary.word_occur_counter.most_common(5)
+        ]
+
+    assert isinstance(load_corpus_summary(tmp_path / 'corpus.summary').word_cooccur, np.memmap)
+
+
+def test_coherence(monkeypatch):
+    monkeypatch.setattr(util, 'MAX_COOCCUR_NUM_WORDS', 20)
+    summary = Corpus('random', make_random_docs()).summary
+    rng = Random(1)
+    # include words outside the co-occurrence matrix and outside the vocab
+    words = summary.vocab + ['unseen1', 'unseen2']
+    topic_keys_per_topic_batch = [
+        [rng.sample(words, k=5) for _ in range(4)]
+        for _ in range(3)
+    ]
+    betas = [0.01, 0.1, 1.]
+    expected_coherences = [
+        sum(
+            sum(
+                log(
+                    (summary.word_cooccur_counter[(topic_keys[ell], topic_keys[m])] + beta) /
+                    (summary.word_occur_counter[topic_keys[ell]] + beta)
+                )
+                for m in range(1, len(topic_keys))
+                for ell in range(m)
+            )
+            for topic_keys in topic_keys_per_topic
+        ) / len(topic_keys_per_topic)
+        for (topic_keys_per_topic, beta) in zip(topic_keys_per_topic_batch, betas)
+    ]
+    assert_allclose(
+        compute_coherence_batch(summary, topic_keys_per_topic_batch, betas),
+        expected_coherences)
+    assert_allclose(
+        _compute_coherence(summary, topic_keys_per_topic_batch[0], betas[0]),
+        expected_coherences[0])
+
+
+def test_corpus_summary_cache(tmp_path):
+    summary = Corpus('random', make_random_docs()).summary
+    paths = [tmp_path / f'corpus{i}.summary' for i in range(3)]
+    for path in paths:
+        summary.save(path)
+    num_bytes = CorpusSummaryCache._get_num_bytes(load_corpus_summary(paths[0]))
+    cache = CorpusSummaryCache(max_bytes=2 * num_bytes)
+
+    summary0 = cache.load(paths[0])
+    assert cache.load(paths[0]) is summary0
+    summary1 = cache.load(paths[1])
+    assert cache.load(paths[0]) is summary0
+    # least recently used summary (1) is evicted
+    cache.load(paths[2])
+    assert cache.load(paths[0]) is summary0
+    assert cache.load(paths[1]) is not summary1
+
+    # summaries are reloaded when their files change
+    summary.save(paths[0])
+    os.utime(paths[0] / 'meta.json', ns=(0, 0))
+    assert cache.load(paths[0]) is not summary0
+
+
+def test_topic_state_arrays(tmp_path):
+    state_path = tmp_path / 'model.state.txt.gz'
+    arrays_path = tmp_path / 'model.state.npz'
+    write_random_topic_state(state_path, make_random_docs())
+    expected_docs = list(load_token_assignments(state_path))
+    topic_state = TopicState(state_path)
+    assert topic_state.arrays is None
+    expected_alpha = topic_state.alpha
+
+    assert get_topic_state_arrays_path(state_path) == arrays_path
+    convert_topic_state(state_path, arrays_path)
+    topic_state = TopicState(state_path)
+    assert topic_state.arrays is not None
+    assert topic_state.arrays.topics.dtype == np.uint16
+    assert list(topic_state.docs) == expected_docs
+    doc = next(iter(topic_state.docs))
+    assert doc.tokens is doc.tokens
+    assert doc.sections == [doc.tokens]
+    assert doc.section_offsets == [0, doc.num_tokens]
+    assert not hasattr(doc, 'add_section')
+    assert topic_state.alpha == expected_alpha
+    assert topic_state.beta == 0.01
+
+    # stale sidecars are ignored
+    os.utime(arrays_path, ns=(0, 0))
+    assert TopicState(state_path).arrays is None
+    # including a newer sidecar of a topic state of a different size
+    convert_topic_state(state_path, arrays_path)
+    arrays_mtime_ns = arrays_path.stat().st_mtime_ns
+    write_random_topic_state(state_path, make_random_docs()[:-1])
+    os.utime(state_path, ns=(arrays_mtime_ns, arrays_mtime_ns))
+    assert TopicState(state_path).arrays is None
+    # but a sidecar whose topic state has been removed is used
+    state_path.unlink()
+    assert TopicState(state_path).arrays is not None
+
+
+def test_topic_assignment_voi_matrix(tmp_path):
+    rng = np.random.default_rng(0)
+    paths = [tmp_path / f'{i}.assignments.npy' for i in range(4)]
+    for path in paths:
+        np.save(path, rng.integers(5, size=100))
+    expected_voi_matrix = np.array([
+        [compute_topic_assignment_voi(path_1, path_2)['voi'] for path_2 in paths]
+        for path_1 in paths
+    ])
+    for num_processes in (1, 3):
+        assert_allclose(
+            compute_topic_assignment_voi_matrix(paths, num_processes=num_processes),
+            expected_voi_matrix)
+
+    output_path = tmp_path / 'voi.tsv'
+    collect_topic_assignment_voi(
+        dict(en=dict(a=paths[0], b=paths[1]), ko=dict(c=paths[2])), output_path)
+    with open(output_path) as f:
+        lines = [line.rstrip('\n').split('\t') for line in f]
+    assert [subtask for (subtask, _) in lines] == [
+        'subtask', 'en.a.a', 'en.a.b', 'en.b.a', 'en.b.b', 'ko.c.c',
+    ]
+    assert_allclose(float(lines[2][1]), expected_voi_matrix[0, 1])
+    assert_allclose(float(lines[3][1]), expected_voi_matrix[0, 1])
+
+
+def test_compute_topic_assignments(tmp_path):
+    state_path = tmp_path / 'model.state.txt.gz'
+    docs = make_random_docs()
+    write_random_topic_state(state_path, docs)
+    expected_docs = list(load_token_assignments(state_path))
+    expected_topics = [ta.topic for doc in expected_docs for ta in doc.tokens]
+    expected_doc_offsets = np.cumsum([0] + [doc.num_tokens for doc in expected_docs])
+
+    assignments_path = tmp_path / 'text.assignments.npy'
+    doc_offsets_path = tmp_path / 'text.assignments.doc-offsets.npy'
+    compute_topic_assignments(state_path, assignments_path, doc_offsets_path)
+    convert_topic_state(state_path, get_topic_state_arrays_path(state_path))
+    arrays_assignments_path = tmp_path / 'arrays.assignments.npy'
+    arrays_doc_offsets_path = tmp_path / 'arrays.assignments.doc-offsets.npy'
+    compute_topic_assignments(state_path, arrays_assignments_path, arrays_doc_offsets_path)
+
+    for (path, offsets_path) in (
+            (assignments_path, doc_offsets_path),
+            (arrays_assignments_path, arrays_doc_offsets_path)):
+        topics = np.load(path)
+        assert topics.dtype == np.uint8
+        assert_array_equal(topics, expected_topics)
+        assert_array_equal(np.load(offsets_path), expected_doc_offsets)
+
+
+def test_compute_topic_assignments_out_of_range(tmp_path):
+    state_path = tmp_path / 'model.state.txt.gz'
+    docs = make_random_docs()
+    write_random_topic_state(state_path, docs)
+    with gzip.open(state_path, mode='at', encoding='utf-8') as f:
+        f.write(f'{len(docs)} NA 0 0 w 300\n')
+
+    # checked before topics are narrowed to uint8
+    with pytest.raises(Exception, match='has topic 300 but only 7 topics'):
+        compute_topic_assignments(state_path, tmp_path / 'text.assignments.npy')
+    convert_topic_state(state_path, get_topic_state_arrays_path(state_path))
+    with pytest.raises(Exception, match='has topic 300 but only 7 topics'):
+        compute_topic_assignments(state_path, tmp_path / 'text.assignments.npy')
+    assert not (tmp_path / 'text.assignments.npy').exists()
+
+
+def test_load_polyglot_edge_cases(tmp_path):
+    path = tmp_path / 'corpus.txt'
+    path.write_bytes(POLYGLOT_EDGE_CASES.encode('utf-8'))
+    expected_docs = list(load_polyglot_line_by_line(path))
+    assert [doc.doc_id for doc in expected_docs] == ['2', '3', '4', '6', '\u06f1\u06f2']
+    assert list(load_polyglot(path)) == expected_docs
+
+    empty_path = tmp_path / 'empty.txt'
+    empty_path.write_bytes(b'')
+    assert list(load_polyglot(empty_path)) == []
+    assert find_polyglot_shard_offsets(empty_path, 3) == [0, 0]
+
+
+def test_polyglot_index(tmp_path):
+    path = tmp_path / 'corpus.txt'
+    docs = write_random_polyglot(path)
+    index = build_polyglot_index(path)
+    assert index.doc_ids == [doc.doc_id for doc in docs]
+    assert_array_equal(index.num_tokens, [doc.num_tokens for doc in docs])
+    assert_array_equal(index.offsets[1:], index.offsets[:-1] + index.lengths[:-1])
+
+    index_polyglot(path)
+    index_path = get_polyglot_index_path(path)
+    assert index_path.name == 'corpus.txt.idx'
+    loaded_index = load_polyglot_index(index_path)
+    assert loaded_index.doc_ids == index.doc_ids
+    assert_array_equal(loaded_index.offsets, index.offsets)
+    assert loaded_index.corpus_size == path.stat().st_size
+    assert load_polyglot_index_if_current(path) is not None
+    # load_polyglot reads doc spans from the index when it is current
+    assert list(load_polyglot(path)) == docs
+    offsets = find_polyglot_shard_offsets(path, 3)
+    assert [
+        doc
+        for (start, end) in zip(offsets, offsets[1:])
+        for doc in load_polyglot(path, start=start, end=end)
+    ] == docs
+
+
+def test_load_polyglot_line_breaks(tmp_path):
+    path = tmp_path / 'corpus.txt'
+    path.write_bytes(
+        b'preamble\r\r[[1]]\ra b\rc\r\n\r\n[[2]]\r\nd e\r[[3]]\r\n\r'
+        b'[[4]]\nf\r\rg  h\n\n[[5]]\r\n\r\n[[6]]\ri\r')
+    with open(path, encoding='utf-8') as f:
+        expected = list(util._parse_polyglot_lines(f))
+    assert expected == [
+        Doc('1', [['a', 'b'], ['c']]),
+        Doc('2', [['d', 'e'], ['[[3]]']]),
+        Doc('4', [['f'], ['g', 'h']]),
+        Doc('6', [['i']]),
+    ]
+    assert list(load_polyglot(path)) == expected
+    offsets = find_polyglot_shard_offsets(path, 4)
+    assert [
+        doc
+        for (start, end) in zip(offsets, offsets[1:])
+        for doc in load_polyglot(path, start=start, end=end)
+    ] == expected
+    index_polyglot(path)
+    assert list(load_polyglot(path)) == expected
+    assert PolyglotCorpus(path).get_doc_range(0) == expected
+
+
+def test_polyglot_index_staleness(tmp_path):
+    path = tmp_path / 'corpus.txt'
+    write_random_polyglot(path)
+    index_polyglot(path)
+    index_mtime = get_polyglot_index_path(path).stat().st_mtime
+    # a rewrite (or a copy preserving mtimes) that leaves the corpus older than the index
+    docs = write_random_polyglot(path, num_docs=30)
+    os.utime(path, (index_mtime - 10, index_mtime - 10))
+    assert load_polyglot_index_if_current(path) is None
+    assert list(load_polyglot(path)) == docs
+    assert PolyglotCorpus(path).get_doc_range(0) == docs
+
+
+def test_polyglot_corpus_read_only(tmp_path):
+    path = tmp_path / 'corpus.txt'
+    docs = write_random_polyglot(path)
+    tmp_path.chmod(0o555)
+    try:
+        if os.access(tmp_path, os.W_OK):
+            pytest.skip('directory permissions are not enforced')
+        corpus = PolyglotCorpus(path)
+        assert corpus.num_docs() == len(docs)
+        assert corpus['7'] == docs[7]
+    finally:
+        tmp_path.chmod(0o755)
+    assert not get_polyglot_index_path(path).exists()
+
+
+def test_polyglot_corpus_random_access(tmp_path):
+    path = tmp_path / 'corpus.txt'
+    docs = write_random_polyglot(path)
+    corpus = PolyglotCorpus(path)
+    assert list(corpus) == docs
+    assert not get_polyglot_index_path(path).exists()
+    assert corpus.num_docs() == len(docs)
+    assert get_polyglot_index_path(path).exists()
+    assert corpus['7'] == docs[7]
+    assert '7' in corpus and 'missing' not in corpus
+    with pytest.raises(KeyError):
+        corpus['missing']
+    assert corpus.get_doc_range(10, 13) == docs[10:13]
+    assert corpus.get_doc_range(-2) == docs[-2:]
+    sample = corpus.sample(5, seed=1)
+    assert sample == corpus.sample(5, seed=1)
+    assert [docs.index(doc) for doc in sample] == sorted(docs.index(doc) for doc in sample)
+    assert PolyglotCorpus(path).index.doc_ids == corpus.index.doc_ids
+
+
+def test_subsample(tmp_path):
+    input_path = tmp_path / 'full.txt'
+    docs = write_random_polyglot(input_path)
+
+    subsample(input_path, tmp_path / 'sub-1.txt', 10, seed=1)
+    subsample(input_path, tmp_path / 'sub-2.txt', 10, seed=1)
+    assert (tmp_path / 'sub-1.txt').read_bytes() == (tmp_path / 'sub-2.txt').read_bytes()
+    sub_docs = list(load_polyglot(tmp_path / 'sub-1.txt'))
+    assert len(sub_docs) == 10
+    doc_nums = [docs.index(doc) for doc in sub_docs]
+    assert doc_nums == sorted(set(doc_nums))
+
+    subsample(input_path, tmp_path / 'sub-all.txt', len(docs), seed=1)
+    assert list(load_polyglot(tmp_path / 'sub-all.txt')) == docs
+    with pytest.raises(ValueError):
+        subsample(input_path, tmp_path / 'sub-too-many.txt', len(docs) + 1)
+
+
+def test_subsample_uniform(tmp_path):
+    input_path = tmp_path / 'full.txt'
+    save_polyglot(input_path, [Doc(str(i), [['a']]) for i in range(10)])
+    counts = collections.Counter()
+    for seed in range(2000):
+        subsample(input_path, tmp_path / 'sub.txt', 3, seed=seed)
+        counts.update(doc.doc_id for doc in load_polyglot(tmp_path / 'sub.txt'))
+    assert sorted(counts) == [str(i) for i in range(10)]
+    assert all(500 < count < 700 for count in counts.values())
+
+
+def write_polyglot_archive(archive_path, corpus_path, format=lzma.FORMAT_XZ, preset=6):
+    tar_f = io.BytesIO()
+    with tarfile.open(fileobj=tar_f, mode='w') as tar:
+        tar.add(corpus_path.parent, arcname='xx', recursive=False)
+        tar.add(corpus_path, arcname='xx/full.txt')
+    archive_path.write_bytes(lzma.compress(tar_f.getvalue(), format=format, preset=preset))
+
+
+@pytest.mark.parametrize('archive_name,format,preset', [
+    ('xx_wiki_text.tar.xz', lzma.FORMAT_XZ, 6),
+    ('xx_wiki_text.tar.lzma', lzma.FORMAT_ALONE, 6),
+    ('xx_wiki_text.tar.lzma', lzma.FORMAT_ALONE, 9),
+])
+def test_polyglot_archive(tmp_path, monkeypatch, archive_name, format, preset):
+    monkeypatch.setattr(util, 'ARCHIVE_READ_CHUNK_SIZE', 256)
+    corpus_path = tmp_path / 'corpus' / 'full.txt'
+    corpus_path.parent.mkdir()
+    docs = write_random_polyglot(corpus_path)
+    archive_path = tmp_path / archive_name
+    write_polyglot_archive(archive_path, corpus_path, format=format, preset=preset)
+
+    assert list(load_polyglot(archive_path)) == docs
+    # stopping early must not leave the decompression thread blocked
+    assert next(iter(load_polyglot(archive_path))) == docs[0]
+
+    subsample(corpus_path, tmp_path / 'sub-text.txt', 10, seed=2)
+    subsample(archive_path, tmp_path / 'sub-archive.txt', 10, seed=2)
+    assert (tmp_path / 'sub-text.txt').read_bytes() == (tmp_path / 'sub-archive.txt').read_bytes()
+    assert [path.name for path in tmp_path.iterdir() if 'spill' in path.name] == []
+
+
+def test_polyglot_archive_errors(tmp_path):
+    archive_path = tmp_path / 'xx_wiki_text.tar.lzma'
+    archive_path.write_bytes(b'not an archive')
+    with pytest.raises(lzma.LZMAError):
+        list(load_polyglot(archive_path))
+    archive_path.write_bytes(lzma.compress(b'not a tar file', format=lzma.FORMAT_ALONE))
+    with pytest.raises(tarfile.ReadError):
+        list(load_polyglot(archive_path))
+
+
+def test_preprocess_polyglot(tmp_path, monkeypatch):
+    monkeypatch.setattr(util, 'PREPROCESS_SPILL_NUM_DOCS', 7)
+    input_path = tmp_path / 'sub.txt'
+    save_polyglot(input_path, [
+        Doc(doc.doc_id, [
+            [token.upper() if i % 3 == 0 else token for (i, token) in enumerate(section)]
+            for section in doc.sections
+        ])
+        for doc in make_random_docs()
+    ])
+    (tmp_path / 'fused').mkdir()
+    (tmp_path / 'separate').mkdir()
+
+    preprocess_polyglot(
+        'xx', input_path,
+        lowercase_path=tmp_path / 'fused' / 'sub.lower.txt',
+        mallet_path=tmp_path / 'fused' / 'sub.lower.mallet.txt',
+        summary_path=tmp_path / 'fused' / 'sub.lower.summary',
+        num_processes=2,
+    )
+    separate_path = tmp_path / 'separate' / 'sub.lower.txt'
+    lowercase_polyglot(input_path, separate_path)
+    convert_polyglot_to_mallet('xx', separate_path, separate_path.with_suffix('.mallet.txt'))
+    summarize_corpus(separate_path, separate_path.with_suffix('.summary'))
+
+    for filename in ('sub.lower.txt', 'sub.lower.mallet.txt'):
+        assert (tmp_path / 'fused' / filename).read_bytes() == \
+            (tmp_path / 'separate' / filename).read_bytes()
+    summary = load_corpus_summary(tmp_path / 'fused' / 'sub.lower.summary')
+    expected_summary = load_corpus_summary(tmp_path / 'separate' / 'sub.lower.summary')
+    assert summary.meta == expected_summary.meta
+    assert summary.vocab == expected_summary.vocab
+    assert_array_equal(summary.word_occur, expected_summary.word_occur)
+    assert_array_equal(summary.word_cooccur, expected_summary.word_cooccur)
+    assert get_corpus_fingerprint_path(tmp_path / 'fused' / 'sub.lower.txt').exists()
+    assert sorted(path.name for path in (tmp_path / 'fused').iterdir()) == [
+        'sub.lower.fingerprint.json', 'sub.lower.mallet.txt', 'sub.lower.summary', 'sub.lower.txt']
+
+
+def test_preprocess_polyglot_failure(tmp_path, monkeypatch):
+    monkeypatch.setattr(util, 'PREPROCESS_SPILL_NUM_DOCS', 7)
+    input_path = tmp_path / 'sub.txt'
+    save_polyglot(input_path, make_random_docs())
+    lowercase_doc = util.lowercase_doc
+
+    def failing_lowercase_doc(doc):
+        if doc.doc_id == '30':
+            raise RuntimeError('failed')
+        return lowercase_doc(doc)
+
+    monkeypatch.setattr(util, 'lowercase_doc', failing_lowercase_doc)
+    (tmp_path / 'out').mkdir()
+    with pytest.raises(RuntimeError):
+        preprocess_polyglot(
+            'xx', input_path,
+            lowercase_path=tmp_path / 'out' / 'sub.lower.txt',
+            mallet_path=tmp_path / 'out' / 'sub.lower.mallet.txt',
+            summary_path=tmp_path / 'out' / 'sub.lower.summary',
+        )
+    # the word id spills of the partial summaries are removed
+    assert sorted(path.name for path in (tmp_path / 'out').iterdir()) == [
+        'sub.lower.mallet.txt', 'sub.lower.txt']
+
+
+def test_check_corpus_alignment_fingerprints(tmp_path):
+    docs = make_random_docs()
+    paths = [tmp_path / f'{name}.txt' for name in ('sub', 'sub.lem', 'sub.misaligned')]
+    save_polyglot(paths[0], docs)
+    save_polyglot(paths[1], [
+        Doc(doc.doc_id, [[token[:1] for token in section] for section in doc.sections])
+        for doc in docs
+    ])
+    save_polyglot(paths[2], docs[:-1])
+    for path in paths:
+        preprocess_polyglot(
+            'xx', path,
+            lowercase_path=path.with_suffix('.lower.txt'),
+            mallet_path=path.with_suffix('.lower.mallet.txt'),
+            summary_path=path.with_suffix('.lower.summary'),
+        )
+
+    check_corpus_alignment(paths[0].with_suffix('.lower.txt'), paths[1].with_suffix('.lower.txt'))
+    with pytest.raises(Exception, match='do not align'):
+        check_corpus_alignment(
+            paths[0].with_suffix('.lower.txt'), paths[2].with_suffix('.lower.txt'))
+
+    # a fingerprint is stale if the corpus size changed, even if the fingerprint is newer
+    lem_path = paths[1].with_suffix('.lower.txt')
+    fingerprint_mtime_ns = get_corpus_fingerprint_path(lem_path).stat().st_mtime_ns
+    save_polyglot(lem_path, docs[:-1])
+    os.utime(lem_path, ns=(fingerprint_mtime_ns, fingerprint_mtime_ns))
+    assert load_corpus_fingerprint_if_current(lem_path) is None
+    with pytest.raises(Exception, match='do not align'):
+        check_corpus_alignment(paths[0].with_suffix('.lower.txt'), lem_path)
+
+
+def test_check_corpus_alignment_streaming(tmp_path, caplog):
+    docs = make_random_docs()
+    paths = [tmp_path / f'{name}.txt' for name in ('sub', 'sub.lem', 'sub.misaligned')]
+    save_polyglot(paths[0], docs)
+    save_polyglot(paths[1], [
+        Doc(doc.doc_id, [[token.upper() for token in section] for section in doc.sections])
+        for doc in docs
+    ])
+    save_polyglot(paths[2], docs[:10] + [Doc(docs[10].doc_id, [['x']])] + docs[11:])
+
+    check_corpus_alignment(paths[0], paths[1])
+    fingerprint = load_corpus_fingerprint_if_current(paths[0])
+    assert fingerprint == load_corpus_fingerprint_if_current(paths[1])
+    assert fingerprint is not None and fingerprint['num_docs'] == len(docs)
+    assert json.loads(get_corpus_fingerprint_path(paths[0]).read_text())['corpus_size'] == (
+        paths[0].stat().st_size)
+
+    with pytest.raises(Exception, match='do not align'):
+        check_corpus_alignment(paths[0], paths[2])
+    assert f'-{docs[10].doc_id} {docs[10].num_tokens}' in caplog.text
+    assert f'+{docs[10].doc_id} 1' in caplog.text
+    assert not get_corpus_fingerprint_path(paths[2]).exists()
+
+
+def test_check_corpus_alignment_index(tmp_path, monkeypatch, caplog):
+    docs = make_random_docs()
+    paths = [tmp_path / f'{name}.txt' for name in ('sub', 'sub.lem', 'sub.misaligned')]
+    save_polyglot(paths[0], docs)
+    save_polyglot(paths[1], [
+        Doc(doc.doc_id, [[token.upper() for token in section] for section in doc.sections])
+        for doc in docs
+    ])
+    save_polyglot(paths[2], docs[:10] + [Doc(docs[10].doc_id, [['x']])] + docs[11:])
+    for path in paths:
+        index_polyglot(path)
+
+    # with current indexes, the docs are not read
+    def load_polyglot_unexpectedly(*args, **kwargs):
+        raise AssertionError('docs read')
+
+    monkeypatch.setattr(util, 'load_polyglot', load_polyglot_unexpectedly)
+    check_corpus_alignment(paths[0], paths[1])
+    assert load_corpus_fingerprint_if_current(paths[0]) == (
+        load_corpus_fingerprint_if_current(paths[1]))
+    with pytest.raises(Exception, match='do not align'):
+        check_corpus_alignment(paths[0], paths[2])
+    assert f'-{docs[10].doc_id} {docs[10].num_tokens}' in caplog.text
+    assert f'+{docs[10].doc_id} 1' in caplog.text
+
+    state_path = tmp_path / 'sub.state.txt.gz'
+    write_random_topic_state(state_path, docs)
+    convert_topic_state(state_path, get_topic_state_arrays_path(state_path))
+    get_corpus_fingerprint_path(paths[0]).unlink()
+    check_token_assignment_alignment(paths[0], state_path)
+    assert load_corpus_fingerprint_if_current(paths[0]) is not None
+
+
+def test_check_token_assignment_alignment(tmp_path, monkeypatch):
+    docs = make_random_docs()
+    corpus_path = tmp_path / 'sub.txt'
+    save_polyglot(corpus_path, docs)
+    state_path = tmp_path / 'sub.state.txt.gz'
+    misaligned_state_path = tmp_path / 'sub.misaligned.state.txt.gz'
+    write_random_topic_state(state_path, docs)
+    write_random_topic_state(misaligned_state_path, docs[:-1])
+
+    # without fingerprint or arrays, both are read in full and the corpus is fingerprinted
+    check_token_assignment_alignment(corpus_path, state_path)
+    assert get_corpus_fingerprint_path(corpus_path).exists()
+    with pytest.raises(Exception, match='do not align'):
+        check_token_assignment_alignment(corpus_path, misaligned_state_path)
+
+    # with both, the check does not read the docs
+    convert_topic_state(state_path, get_topic_state_arrays_path(state_path))
+    convert_topic_state(misaligned_state_path, get_topic_state_arrays_path(misaligned_state_path))
+    full_checks = []
+
+    def check_corpus_alignment_in_full(corpus1, corpus2, check_doc_ids=True):
+        full_checks.append((corpus1, corpus2))
+        return (CorpusFingerprint(), CorpusFingerprint())
+
+    monkeypatch.setattr(evaluation, '_check_corpus_alignment', check_corpus_alignment_in_full)
+    check_token_assignment_alignment(corpus_path, state_path)
+    assert full_checks == []
+    check_token_assignment_alignment(corpus_path, misaligned_state_path)
+    assert len(full_checks) == 1
+
+
+def test_doc():
+    doc = Doc('1', [['a', 'b'], [], ['c']])
+    doc.add_section(['d'])
+    assert doc.tokens == ['a', 'b', 'c', 'd']
+    assert doc.section_offsets == [0, 2, 2, 3, 4]
+    assert doc.sections == [['a', 'b'], [], ['c'], ['d']]
+    assert doc.num_tokens == 4
+    assert doc.to_polyglot() == '[[1]]\na b\n\nc\nd\n'
+    assert doc.to_mallet('xx') == '1 xx a b c d'
+    assert doc == Doc.from_tokens('1', ['a', 'b', 'c', 'd'], [0, 2, 2, 3, 4])
+    assert doc != Doc('1', [['a', 'b', 'c', 'd']])
+    assert not hasattr(doc, '__dict__')
+
+
+def test_topic_assignment_docs(tmp_path):
+    docs = make_random_docs()
+    state_path = tmp_path / 'sub.state.txt.gz'
+    write_random_topic_state(state_path, docs)
+    text_docs = list(load_token_assignments(state_path))
+    convert_topic_state(state_path, get_topic_state_arrays_path(state_path))
+    array_docs = list(TopicState(state_path))
+    assert text_docs == array_docs
+    for (doc, text_doc, array_doc) in zip(docs, text_docs, array_docs):
+        assert text_doc.words == array_doc.words == doc.tokens
+        assert text_doc.num_tokens == doc.num_tokens
+        assert [ta.topic for ta in text_doc.tokens] == array_doc.topics.tolist()
+
+
+def test_vocabulary(tmp_path):
+    vocabulary = Vocabulary(['b', 'a', 'b'])
+    assert vocabulary.words == ['b', 'a']
+    assert vocabulary.add('c') == 2
+    assert len(vocabulary) == 3 and 'a' in vocabulary and 'd' not in vocabulary
+    assert vocabulary.to_ids(['a', 'd', 'c']).tolist() == [1, -1, 2]
+    assert vocabulary.to_words([2, 0]) == ['c', 'b']
+    assert Vocabulary(['c', 'x', 'b']).map_from(vocabulary).tolist() == [2, -1, 0]
+
+    summary = Corpus('random', make_random_docs()).summary
+    for path in (tmp_path / 'corpus.summary.npz', tmp_path / 'corpus.summary'):
+        summary.save(path)
+        assert load_vocabulary(path).words == summary.vocab
+
+
+def test_infer_topic_keys(tmp_path):
+    docs = make_random_docs()
+    treated_docs = [
+        Doc(doc.doc_id, [[token[:1] for token in section] for section in doc.sections])
+        for doc in docs
+    ]
+    state_path = tmp_path / 'sub.state.txt.gz'
+    untreated_state_path = tmp_path / 'sub.untreated.state.txt.gz'
+    write_random_topic_state(state_path, treated_docs, seed=1)
+    write_random_topic_state(untreated_state_path, docs, seed=2)
+    stop_list_path = tmp_path / 'stop.txt'
+    stop_words = sorted(set(docs[0].tokens))[:3] + ['unseen']
+    save_word_list(stop_list_path, stop_words)
+
+    # Reference implementation over token assignment strings
+    topic_words = [collections.Counter() for _ in range(7)]
+    for (doc, untr_doc) in zip(load_token_assignments(state_path),
+                               load_token_assignments(untreated_state_path)):
+        for (ta, untr_ta) in zip(doc.tokens, untr_doc.tokens):
+            if untr_ta.word not in stop_words:
+                topic_words[ta.topic][untr_ta.word] += 1
+    expected_keys = [[word for (word, _) in c.most_common(5)] for c in topic_words]
+
+    topic_state = TopicState(state_path)
+    untreated_topic_state = TopicState(untreated_state_path)
+    assert infer_topic_keys(
+        topic_state, untreated_topic_state, untreated_stop_list_path=stop_list_path,
+    ) == expected_keys
+    for path in (state_path, untreated_state_path):
+        convert_topic_state(path, get_topic_state_arrays_path(path))
+    assert infer_topic_keys(
+        TopicState(state_path), TopicState(untreated_state_path),
+        untreated_stop_list_path=stop_list_path,
+    ) == expected_keys
+
+    summary_path = tmp_path / 'sub.summary'
+    summary = Corpus('random', docs).summary
+    summary.save(summary_path)
+    assert compute_coherence_treated(
+        summary_path, untreated_state_path, state_path,
+        untreated_stop_list_path=stop_list_path,
+    ) == dict(coherence=pytest.approx(_compute_coherence(
+        summary, expected_keys, topic_state.beta)))
+
+
+def test_infer_topic_keys_ties(tmp_path):
+    # topic 0 has b, c, a tied at 2 (in order of first occurrence) and d at 1; topic 1 has a
+    # at 3
+    docs = [Doc('0', [['b', 'a', 'c', 'd', 'a', 'c', 'b', 'a', 'a', 'a']])]
+    topics = [0, 1, 0, 0, 1, 0, 0, 0, 1, 0]
+    state_path = tmp_path / 'sub.state.txt.gz'
+    with gzip.open(state_path, mode='wt', encoding='utf-8') as f:
+        f.write('#alpha : 0.1 0.1\n#beta : 0.01\n')
+        for (pos, (word, topic)) in enumerate(zip(docs[0].tokens, topics)):
+            f.write(f'0 NA {pos} 0 {word} {topic}\n')
+    topic_state = TopicState(state_path)
+    assert infer_topic_keys(topic_state, topic_state, num_keys=2) == [['b', 'c'], ['a']]
+    assert infer_topic_keys(topic_state, topic_state, num_keys=3) == [['b', 'c', 'a'], ['a']]
+    assert infer_topic_keys(topic_state, topic_state, num_keys=9) == [['b', 'c', 'a', 'd'], ['a']]
+
+
+def test_topic_state_arrays_cache(tmp_path):
+    state_path = tmp_path / 'sub.state.txt.gz'
+    write_random_topic_state(state_path, make_random_docs())
+    arrays_path = get_topic_state_arrays_path(state_path)
+    convert_topic_state(state_path, arrays_path)
+    arrays = TopicState(state_path).arrays
+    assert arrays is not None
+    assert TopicState(state_path).arrays is arrays
+
+    os.utime(arrays_path, ns=(os.stat(arrays_path).st_atime_ns,
+                              os.stat(arrays_path).st_mtime_ns + 10 ** 9))
+    assert TopicState(state_path).arrays is not arrays
+
+
+def test_compute_coherence_treated_batch(tmp_path, monkeypatch):
+    docs = make_random_docs()
+    untreated_state_path = tmp_path / 'sub.state.txt.gz'
+    write_random_topic_state(untreated_state_path, docs)
+    state_paths = {}
+    for seed in range(3):
+        state_path = tmp_path / f'sub.{seed}.state.txt.gz'
+        write_random_topic_state(state_path, docs, seed=seed + 1)
+        state_paths[f'sub.{seed}'] = state_path
+    convert_topic_state(state_paths['sub.0'], get_topic_state_arrays_path(state_paths['sub.0']))
+    summary_path = tmp_path / 'sub.summary'
+    Corpus('random', docs).summary.save(summary_path)
+    stop_list_path = tmp_path / 'stop.txt'
+    save_word_list(stop_list_path, sorted(set(docs[0].tokens))[:3])
+
+    expected_scores = dict(
+        (name, compute_coherence_treated(
+            summary_path, untreated_state_path, state_path,
+            untreated_stop_list_path=stop_list_path)['coherence'])
+        for (name, state_path) in state_paths.items()
+    )
+    # the untreated inputs are loaded once, in this process
+    load_calls = []
+    load = TopicKeyInference.load.__func__
+    monkeypatch.setattr(TopicKeyInference, 'load', classmethod(
+        lambda cls, *args, **kwargs: load_calls.append(args) or load(cls, *args, **kwargs)))
+    for num_processes in (1, 2):
+        assert compute_coherence_treated_batch(
+            summary_path, untreated_state_path, state_paths,
+            untreated_stop_list_path=stop_list_path, num_processes=num_processes,
+        ) == dict(coherence=expected_scores)
+        assert len(load_calls) == 1
+        load_calls.clear()
+
+    collect_subtask_scores(
+        dict(xx=expected_scores, single=0.5), tmp_path / 'coherence.tsv')
+    assert (tmp_path / 'coherence.tsv').read_text().split('\n') == (
+        ['subtask\tscore'] +
+        [f'{name}\t{score}' for (name, score) in expected_scores.items()] +
+        ['single\t0.5', '']
+    )
+
+
+FAKE_TREETAGGER = """
+import sys
+
+# Like the tree-tagger-* wrappers: one sentence per non-blank line, one token per line,
+# with tags that depend on the previous two tokens
+prev_tokens = ['', '']
+for line in sys.stdin:
+    if line.strip():
+        print('<s>')
+        for token in line.split():
+            tag = f'T{(len(prev_tokens[0]) + len(prev_tokens[1])) % 3}'
+            lemma = '<unknown>' if tag == 'T0' else token.lower()
+            print(f'{token}\\t{tag}\\t{lemma}')
+            prev_tokens = [prev_tokens[1], token]
+        print('</s>')
+"""
+
+
+def test_lemmatize_treetagger(tmp_path):
+    program_path = tmp_path / 'tree-tagger-fake'
+    program_path.write_text(f'#!{sys.executable}\n{FAKE_TREETAGGER}')
+    program_path.chmod(0o755)
+    input_path = tmp_path / 'sub.txt'
+    (tmp_path / 'preamble.txt').write_text('preamble text\n\n')
+    docs = make_random_docs(num_docs=40)
+    save_polyglot(input_path, docs)
+    input_path.write_text((tmp_path / 'preamble.txt').read_text() + input_path.read_text())
+
+    lemmatize_treetagger(str(program_path), input_path, tmp_path / 'serial.txt')
+    serial_output = (tmp_path / 'serial.txt').read_bytes()
+    for num_processes in (2, 3, 7):
+        lemmatize_treetagger(
+            str(program_path), input_path, tmp_path / 'parallel.txt', num_processes=num_processes)
+        assert (tmp_path / 'parallel.txt').read_bytes() == serial_output
+
+    parse_treetagger('xx', tmp_path / 'serial.txt', tmp_path / 'parsed.txt')
+    assert [doc.doc_id for doc in load_polyglot(tmp_path / 'parsed.txt')] == [
+        doc.doc_id for doc in docs]
+    for num_processes in (1, 3):
+        lemmatize_parse_treetagger(
+            'xx', str(program_path), input_path, tmp_path / 'streamed.txt',
+            num_processes=num_processes)
+        assert (tmp_path / 'streamed.txt').read_bytes() == (tmp_path / 'parsed.txt').read_bytes()
+
+
+FAKE_UDPIPE = """
+import sys
+
+# Like udpipe --tag --input=horizontal: one sentence per non-blank line, with blank lines
+# starting new paragraphs
+# and reading standard input and writing standard output by default
+paths = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+output_paths = [arg[len('--outfile='):] for arg in sys.argv[1:] if arg.startswith('--outfile=')]
+with (open(paths[1], encoding='utf-8') if paths[1:] else sys.stdin) as in_f, \\
+        (open(output_paths[0], mode='w', encoding='utf-8') if output_paths
+         else sys.stdout) as out_f:
+    out_f.write('# newdoc\\n# newpar\\n')
+    new_par = False
+    sent_id = 0
+    for line in in_f:
+        if line.strip():
+            sent_id += 1
+            if new_par:
+                out_f.write('# newpar\\n')
+            out_f.write(f'# sent_id = {sent_id}\\n# text = {line.strip()}\\n')
+            for (i, token) in enumerate(line.split()):
+                lemma = '_' if len(token) % 4 == 0 else token.lower()
+                out_f.write(f'{i + 1}\\t{token}\\t{lemma}\\tX\\tX\\t_\\t_\\t_\\t_\\t_\\n')
+            out_f.write('\\n')
+        new_par = not line.strip()
+"""
+
+
+def test_lemmatize_udpipe(tmp_path):
+    program_path = tmp_path / 'udpipe'
+    program_path.write_text(f'#!{sys.executable}\n{FAKE_UDPIPE}')
+    program_path.chmod(0o755)
+    model_path = tmp_path / 'model.udpipe'
+    model_path.touch()
+    input_path = tmp_path / 'sub.txt'
+    docs = make_random_docs(num_docs=40)
+    save_polyglot(input_path, docs)
+
+    lemmatize_udpipe(str(program_path), model_path, input_path, tmp_path / 'serial.txt')
+    serial_output = (tmp_path / 'serial.txt').read_bytes()
+    assert serial_output.count(b'# newdoc') == 1
+    for num_processes in (2, 3):
+        lemmatize_udpipe(
+            str(program_path), model_path, input_path, tmp_path / 'parallel.txt',
+            num_processes=num_processes)
+        assert (tmp_path / 'parallel.txt').read_bytes() == serial_output
+
+    parse_udpipe('xx', tmp_path / 'serial.txt', tmp_path / 'parsed.txt')
+    assert [doc.doc_id for doc in load_polyglot(tmp_path / 'parsed.txt')] == [
+        doc.doc_id for doc in docs]
+    for num_processes in (1, 3):
+        lemmatize_parse_udpipe(
+            'xx', str(program_path), model_path, input_path, tmp_path / 'streamed.txt',
+            num_processes=num_processes)
+        assert (tmp_path / 'streamed.txt').read_bytes() == (tmp_path / 'parsed.txt').read_bytes()
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        'model.udpipe', 'parallel.txt', 'parsed.txt', 'serial.txt', 'streamed.txt', 'sub.txt',
+        'udpipe']
+
+
+def test_iter_udpipe_output_bounded(tmp_path):
+    program_path = tmp_path / 'udpipe'
+    program_path.write_text(f'#!{sys.executable}\n{FAKE_UDPIPE}')
+    program_path.chmod(0o755)
+    model_path = tmp_path / 'model.udpipe'
+    model_path.touch()
+    input_path = tmp_path / 'sub.txt'
+    save_polyglot(input_path, make_random_docs(num_docs=40))
+    lemmatize_udpipe(str(program_path), model_path, input_path, tmp_path / 'serial.txt')
+    temp_dir_parent = tmp_path / 'tmp'
+    temp_dir_parent.mkdir()
+
+    num_processes = 2
+    lines = []
+    max_num_shard_outputs = 0
+    for line in iter_udpipe_output(
+            str(program_path), model_path, input_path, num_processes=num_processes,
+            num_shards=12, temp_dir_parent=temp_dir_parent):
+        if not lines:
+            # Give shards started ahead of the first one time to finish
+            time.sleep(1)
+        lines.append(line)
+        max_num_shard_outputs = max(max_num_shard_outputs, sum(
+            len(fnmatch.filter(files, '*.conllu')) for (_, _, files) in os.walk(temp_dir_parent)))
+    assert b''.join(lines) == (tmp_path / 'serial.txt').read_bytes()
+    assert 0 < max_num_shard_outputs <= num_processes + 1
+    assert list(temp_dir_parent.iterdir()) == []
+
+
+def test_lemmatize_parse_tagger_failure(tmp_path):
+    program_path = tmp_path / 'tree-tagger-broken'
+    program_path.write_text('#!/bin/sh\nhead -c 10 > /dev/null\nexit 3\n')
+    program_path.chmod(0o755)
+    input_path = tmp_path / 'sub.txt'
+    save_polyglot(input_path, make_random_docs(num_docs=40))
+    for num_processes in (1, 2):
+        with pytest.raises(subprocess.CalledProcessError):
+            lemmatize_parse_treetagger(
+                'xx', str(program_path), input_path, tmp_path / 'parsed.txt',
+                num_processes=num_processes)
+
+
+def test_lemmatize_parse_tagger_failure_stops(tmp_path):
+    # The first tagger started fails once the other two have started, and they would run for
+    # a minute
+    pids_path = tmp_path / 'pids.txt'
+    program_path = tmp_path / 'tree-tagger-slow'
+    program_path.write_text(
+        f'#!/bin/sh\nif mkdir {tmp_path / "failed"} 2> /dev/null; then\n'
+        f'  while [ "$(cat {pids_path} 2> /dev/null | wc -l)" -lt 2 ]; do sleep 0.1; done\n'
+        f'  exit 3\nfi\n'
+        f'echo $$ >> {pids_path}\nsleep 60\n')
+    program_path.chmod(0o755)
+    input_path = tmp_path / 'sub.txt'
+    save_polyglot(input_path, make_random_docs(num_docs=40))
+    start = time.monotonic()
+    with pytest.raises(subprocess.CalledProcessError):
+        lemmatize_parse_udpipe(
+            'xx', str(program_path), tmp_path / 'model.udpipe', input_path,
+            tmp_path / 'parsed.txt', num_processes=3)
+    assert time.monotonic() - start < 30
+    # Only the chunks running alongside the failed one were started, and they were killed
+    pids = [int(line) for line in pids_path.read_text().split()]
+    assert len(pids) == 2
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                assert f.read().split(')')[-1].split()[0] == 'Z'
+        except FileNotFoundError:
+            pass
+
+
+CONLLU_SAMPLE = """# newdoc
+# newpar
+# sent_id = 1
+1\t[[12]]\t[[12]]\tPUNCT\t_\t_\t_\t_\t_\t_
+
+# sent_id = 2
+# text = della casa
+1-2\tdella\t_\t_\t_\t_\t_\t_\t_\t_
+1\tdi\tdi\tADP\tE\t_\t_\t_\t_\t_
+2\tla\til\tDET\tRD\t_\t_\t_\t_\t_
+2.1\tx\ty\t_\t_\t_\t_\t_\t_\t_
+3\tcasa\t_\tNOUN\tS\t_\t_\t_\t_\t_
+4\t_\t_\t_\t_\t_\t_\t_\t_\t_
+
+# comment only
+
+   # sent_id = 3
+1\t학교에\t+학교+에\tNOUN\tncn+jca\t_\t_\t_\t_\t_
+2\t가다\t가+다\tVERB\tpvg+ef\t_\t_\t_\t_\t_
+3\tword  spaced\tlemma\tX\t_\t_\t_\t_\t_\t_
+4\tshort\tshort\tX
+5\t+a+b+\t+a+b+\tX\t+\t_\t_\t_\t_\t_
+
+
+# sent_id = 4
+1\t[[34]]\t[[34]]\tPUNCT\t_\t_\t_\t_\t_\t_
+
+1\tlast\tlast\tADJ\tA\t_\t_\t_\t_\t_
+"""
+
+
+def conllu_parse_tokens(f, split_lemmas=False):
+    # What parse_udpipe used to read, with conllu.parse_incr
+    for sentence in conllu.parse_incr(f):
+        yield [
+            LemmaData(
+                form=token['form'],
+                lemma=(
+                    token['lemma'].strip('+').split('+')[0]
+                    if split_lemmas and token['xpos'] is not None and '+' in token['xpos']
+                    else token['lemma']
+                ) if token['lemma'] != '_' else None,
+                pos=token['upos'])
+            for token in sentence
+        ]
+
+
+@pytest.mark.parametrize('split_lemmas', [False, True])
+def test_parse_conllu_to_tokens(split_lemmas):
+    expected = [
+        sentence for sentence in conllu_parse_tokens(io.StringIO(CONLLU_SAMPLE), split_lemmas)
+        if sentence
+    ]
+    tokens = list(parse_conllu_to_tokens(io.StringIO(CONLLU_SAMPLE), split_lemmas))
+    assert tokens == expected
+    assert tokens[2][0].lemma == ('학교' if split_lemmas else '+학교+에')
+    assert [token.form for token in tokens[1]] == ['della', 'di', 'la', 'x', 'casa', '_']
+
+
+def test_parse_udpipe(tmp_path):
+    input_path = tmp_path / 'sub.lem-udpipe.txt'
+    input_path.write_text(CONLLU_SAMPLE, encoding='utf-8')
+    parse_udpipe('ko', input_path, tmp_path / 'parsed.txt')
+    assert list(load_polyglot(tmp_path / 'parsed.txt')) == [
+        Doc('12', [
+            ['della', 'di', 'il', 'y', 'casa', '_'],
+            ['학교', '가', 'spaced', 'short', 'a'],
+        ]),
+        Doc('34', [['last']]),
+    ]
+
+
+TREETAGGER_SAMPLE = """<s>
+preamble\tNN\tpreamble
+</s>
+<s>
+[[12]]\tSYM\t[[12]]
+</s>
+<s>
+The\tDT\tthe
+cats\tNNS\tcat
+<unknown-tag>
+sat\tVBD\t<unknown>
+학교에\tNNG_JKB\t학교_에
+[[7]]\tSYM\t[[7]]
+</s>
+
+<s>
+bad line
+</s>
+<s>
+[[\tSYM\t[[
+5\tCD\t5
+]]\tSYM\t]]
+</s>
+<s>
+[[6]]\tSYM\t[[6]]
+</s>
+<s>
+[\tSYM\t[
+x\tNN_NN\ty_z
+</s>
+<s>
+no\tDT\tno
+end\tNN\t<unknown>
+"""
+
+
+def reference_parse_treetagger(lang, f):
+    # What parse_treetagger used to do, with a LemmaData per token
+    sentences = []
+    sentence = []
+    for line in f:
+        line = line.strip()
+        if line == '</s>':
+            if sentence:
+                sentences.append(sentence)
+                sentence = []
+        elif line and line != '<s>':
+            line_tokens = line.split('\t')
+            if len(line_tokens) == 3:
+                (form, pos, lemma) = line_tokens
+                if lemma == '<unknown>':
+                    lemma = None
+                elif lang == 'ko' and '_' in pos:
+                    lemma = lemma.split('_')[0]
+                sentence.append(LemmaData(form=form, pos=pos, lemma=lemma))
+            elif line.startswith('<') and line.endswith('>'):
+                sentence.append(LemmaData(form=line))
+    if sentence:
+        sentences.append(sentence)
+    return list(parse_polyglot_lemmas(sentences))
+
+
+@pytest.mark.parametrize('lang', ['en', 'ko'])
+def test_parse_treetagger(tmp_path, lang):
+    input_path = tmp_path / 'sub.lem-treetagger.txt'
+    input_path.write_text(TREETAGGER_SAMPLE, encoding='utf-8')
+    parse_treetagger(lang, input_path, tmp_path / 'parsed.txt')
+    docs = list(load_polyglot(tmp_path / 'parsed.txt'))
+    with open(input_path, encoding='utf-8') as f:
+        assert docs == reference_parse_treetagger(lang, f)
+    assert docs == [
+        Doc('12', [
+            ['the', 'cat', '<unknown-tag>', 'sat', '학교' if lang == 'ko' else '학교_에', '[[7]]'],
+        ]),
+        Doc('6', [['[', 'y' if lang == 'ko' else 'y_z'], ['no', 'end']]),
+    ]